@@ -2,9 +2,10 @@
 
 cd /scratch/jb6504/diboson_mining/scripts
 
-sbatch --array=0-0 submit_alices_all_tight.sh
-sbatch --array=0-0 submit_alices_phi_tight.sh
-# sbatch --array=0-9 submit_alices_all_loose.sh
-# sbatch --array=0-0 submit_scandal_all_tight.sh
-# sbatch --array=0-9 submit_scandal_all_phi.sh
-# sbatch --array=0-9 submit_scandal_all_loose.sh
+# Sweeps are defined in sweep.py, each array task trains its share of the models that do not exist yet
+sbatch --array=0-0 --job-name=als submit_sweep.sh alices_all_tight
+sbatch --array=0-0 --job-name=als-phi --cpus-per-task=4 submit_sweep.sh alices_phi_tight
+# sbatch --array=0-9 --job-name=als-loose submit_sweep.sh alices_all_loose
+# sbatch --array=0-0 --job-name=scandal submit_sweep.sh scandal_all_tight
+# Small trainings are packed into one allocation: ten runs with one observable, four at a time on 8 CPUs
+# sbatch --array=0-0 --job-name=scandal-phi submit_sweep.sh scandal_all_tight --grid "filename=scandal_phi_tight_{i}" "observables=(26,)" "i=[0,1,2,3,4,5,6,7,8,9]" --workers 4
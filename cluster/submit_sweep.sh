@@ -0,0 +1,17 @@
+#!/bin/bash
+
+# Usage: sbatch --array=0-<parts - 1> [--cpus-per-task=...] submit_sweep.sh <sweep> [--grid ...] [--workers ...]
+
+#SBATCH --job-name=sweep
+#SBATCH --output=log_%x_%a.log
+#SBATCH --nodes=1
+#SBATCH --cpus-per-task=8
+#SBATCH --mem=16GB
+#SBATCH --time=3-00:00:00
+#SBATCH --requeue
+#SBATCH --open-mode=append
+
+source activate madminer
+cd /scratch/jb6504/diboson_mining/scripts
+
+python -u ./sweep.py "$@" --cpus ${SLURM_CPUS_PER_TASK}
@@ -0,0 +1,256 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import sys
+import ast
+import logging
+import argparse
+import itertools
+from collections import OrderedDict
+import six
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from diboson_mining.parallel import run_in_parallel
+from train import train, is_trained
+
+logger = logging.getLogger('diboson_mining.sweep')
+
+# Each sweep maps arguments of train() to values. Lists are grid axes, the sweep consists of one training for every
+# combination of their values. All other values are the same for every task, so fixed sequences (for instance the
+# observables) are given as tuples. The filename is formatted with the arguments of each task.
+SWEEPS = OrderedDict(
+    [
+        (
+            'alices_all_tight',
+            OrderedDict([('filename', 'alices_all_tight_{i}'), ('method', 'alices'), ('alpha', 0.0001), ('i', [0])]),
+        ),
+        (
+            'alices_phi_tight',
+            OrderedDict(
+                [
+                    ('filename', 'alices_phi_tight_{i}'),
+                    ('method', 'alices'),
+                    ('alpha', 0.0001),
+                    ('observables', (26,)),
+                    ('i', [0]),
+                ]
+            ),
+        ),
+        (
+            'alices_all_loose',
+            OrderedDict(
+                [
+                    ('filename', 'alices_all_loose_{i}'),
+                    ('method', 'alices'),
+                    ('alpha', 0.0001),
+                    ('tight_cuts', False),
+                    ('i', list(range(10))),
+                ]
+            ),
+        ),
+        (
+            'scandal_all_tight',
+            OrderedDict(
+                [
+                    ('filename', 'scandal_all_tight_{i}'),
+                    ('method', 'scandal'),
+                    ('n_mades', 3),
+                    ('n_layers', 1),
+                    ('alpha', 0.01),
+                    ('i', [0]),
+                ]
+            ),
+        ),
+    ]
+)
+
+
+def expand_grid(sweep):
+    """
+    Expands a sweep (see `SWEEPS`) into a list of tasks, one OrderedDict of train() arguments per combination of the
+    values of the grid axes. Raises a ValueError if two tasks would write the same model.
+    """
+
+    for key in ['filename', 'method']:
+        if key not in sweep:
+            raise ValueError('Sweep does not define the {}'.format(key))
+
+    axes = [key for key, value in six.iteritems(sweep) if isinstance(value, list)]
+
+    tasks = []
+    for values in itertools.product(*[sweep[key] for key in axes]):
+        task = OrderedDict(sweep)
+        task.update(zip(axes, values))
+        for key, value in six.iteritems(task):
+            if isinstance(value, tuple):
+                task[key] = list(value)
+        task['filename'] = task['filename'].format(**task)
+        tasks.append(task)
+
+    models = [(task['method'], task['filename'], task.get('i', 0)) for task in tasks]
+    duplicates = sorted(set(model for model in models if models.count(model) > 1))
+    if len(duplicates) > 0:
+        raise ValueError('Several tasks would write the same models {}, extend the filename'.format(duplicates))
+
+    return tasks
+
+
+def run_sweep(sweep, n_workers=1, n_cpus=1, part=0, n_parts=1, seed=None, dry_run=False):
+    """
+    Trains all models of a sweep that do not exist yet, several of them at the same time in a local worker pool.
+
+    Parameters
+    ----------
+    sweep : str or OrderedDict
+        Name of a sweep in `SWEEPS` or a sweep definition.
+
+    n_workers : int, optional
+        Number of trainings that run at the same time. Default value: 1.
+
+    n_cpus : int, optional
+        CPUs of the allocation, split evenly between the workers. Default value: 1.
+
+    part : int, optional
+        With n_parts > 1, the tasks are distributed over several allocations (for instance a SLURM job array) and
+        only every n_parts-th task, starting from task part, is run here. The assignment does not depend on which
+        models exist already, so it stays the same when a job is requeued. Default value: 0.
+
+    n_parts : int, optional
+        Number of parts. Default value: 1.
+
+    seed : int or None, optional
+        Base seed for the random states. Before the training of the i-th task of the grid, numpy's random state is
+        seeded with (seed, i) and torch's random state from numpy, so every task gets its own train / validation
+        split, shuffling, and initialization, independent of n_workers, n_parts, and the models that exist already.
+        If None, a seed is drawn from numpy's global random state. Default value: None.
+
+    dry_run : bool, optional
+        If True, the tasks are only listed. Default value: False.
+
+    Returns
+    -------
+    n_failed : int
+        Number of failed trainings.
+
+    """
+
+    if isinstance(sweep, six.string_types):
+        sweep = SWEEPS[sweep]
+
+    tasks = list(enumerate(expand_grid(sweep)))[part::n_parts]
+    pending = [(i_task, task) for i_task, task in tasks if not is_trained(**_model_args(task))]
+    logger.info(
+        '%s tasks in this part of the sweep, %s of them are already trained', len(tasks), len(tasks) - len(pending)
+    )
+    for _, task in pending:
+        logger.info('  %s', ', '.join('{}={}'.format(key, value) for key, value in six.iteritems(task)))
+
+    if dry_run or len(pending) == 0:
+        return 0
+
+    n_workers = max(1, min(n_workers, len(pending)))
+    n_cpus_per_task = max(1, n_cpus // n_workers)
+    if seed is None:
+        seed = np.random.randint(np.iinfo(np.int32).max)
+    logger.info('Running %s trainings with %s CPUs each, base seed %s', n_workers, n_cpus_per_task, seed)
+
+    # The seeds depend on the position in the whole grid, not on the position among the pending tasks
+    results = run_in_parallel(
+        _train_task,
+        [dict(task=task, n_cpus=n_cpus_per_task, seed=[seed, i_task]) for i_task, task in pending],
+        n_workers=n_workers,
+    )
+
+    n_failed = sum(not success for success in results)
+    logger.info('Finished sweep: %s trainings succeeded, %s failed', len(results) - n_failed, n_failed)
+    return n_failed
+
+
+def parse_grid(arguments):
+    """
+    Parses command-line arguments of the form 'key=value' into a sweep. The values are Python literals with the same
+    meaning as in `SWEEPS`, for instance 'alpha=[0.001,0.0001]' for a grid axis or 'observables=(26,)' for a fixed
+    value. Values that are not literals are used as strings, for instance 'method=alices'.
+    """
+
+    sweep = OrderedDict()
+    for argument in arguments:
+        key, separator, value = argument.partition('=')
+        if not separator:
+            raise ValueError('Cannot parse {}, expected key=value'.format(argument))
+        sweep[key] = _parse_value(value)
+    return sweep
+
+
+def _parse_value(value):
+    try:
+        return ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        return value
+
+
+def _model_args(task):
+    return dict((key, task[key]) for key in ['filename', 'method', 'i', 'base_dir'] if key in task)
+
+
+def _train_task(task, n_cpus, seed):
+    # Another job may have finished this training since the sweep was started
+    if is_trained(**_model_args(task)):
+        logger.info('Skipping %s, already trained', task['filename'])
+        return True
+
+    logger.info('Starting training %s', task['filename'])
+    np.random.seed(seed)
+    torch.manual_seed(np.random.randint(np.iinfo(np.int32).max))
+    try:
+        train(n_cpus=n_cpus, resume=True, **task)
+    except Exception:
+        logger.exception('Training %s failed', task['filename'])
+        return False
+    logger.info('Finished training %s', task['filename'])
+    return True
+
+
+if __name__ == '__main__':
+    # Parse arguments
+    parser = argparse.ArgumentParser(description='Trains a grid of models, several at the same time')
+
+    parser.add_argument('sweep', type=str, nargs='?', default=None, help='Name of a sweep in SWEEPS')
+    parser.add_argument(
+        '--grid',
+        type=str,
+        nargs='+',
+        default=[],
+        help='Additional or changed train() arguments, for instance alpha=[0.001,0.0001] or observables=(26,)',
+    )
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--cpus', type=int, default=int(os.environ.get('SLURM_CPUS_PER_TASK', 1)))
+    parser.add_argument(
+        '--part',
+        type=int,
+        default=int(os.environ.get('SLURM_ARRAY_TASK_ID', 0)) - int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0)),
+    )
+    parser.add_argument('--parts', type=int, default=int(os.environ.get('SLURM_ARRAY_TASK_COUNT', 1)))
+    parser.add_argument('--seed', type=int, default=1234, help='Base seed, every task is seeded with (seed, i_task)')
+    parser.add_argument('--list', action='store_true', help='Only list the tasks')
+
+    args = parser.parse_args()
+
+    # Sweep definition
+    sweep = OrderedDict() if args.sweep is None else OrderedDict(SWEEPS[args.sweep])
+    sweep.update(parse_grid(args.grid))
+
+    # Start trainings
+    n_failed = run_sweep(
+        sweep,
+        n_workers=args.workers,
+        n_cpus=args.cpus,
+        part=args.part,
+        n_parts=args.parts,
+        seed=args.seed,
+        dry_run=args.list,
+    )
+    sys.exit(1 if n_failed > 0 else 0)
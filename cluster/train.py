@@ -1,8 +1,15 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from madminer.ml import MLForge
+import os
+import sys
+import time
 import logging
 import argparse
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from diboson_mining.ml import MLForge
 
 logging.basicConfig(
     format='%(asctime)-5.5s %(name)-20.20s %(levelname)-7.7s %(message)s',
@@ -10,10 +17,31 @@ logging.basicConfig(
     level=logging.INFO
 )
 for key in logging.Logger.manager.loggerDict:
-    if "madminer" not in key:
+    if "madminer" not in key and "diboson_mining" not in key:
         logging.getLogger(key).setLevel(logging.WARNING)
 
 
+def split_cpus(n_cpus, n_loader_workers=None):
+    """ Splits a CPU budget into torch threads and background data-loading threads """
+
+    if n_loader_workers is None:
+        n_loader_workers = 0 if n_cpus < 2 else max(1, n_cpus // 4)
+    n_threads = max(1, n_cpus - n_loader_workers)
+    return n_threads, n_loader_workers
+
+
+def model_filename(filename, method='alices', i=0, base_dir='/scratch/jb6504/diboson_mining/'):
+    """ Path of the trained model files (without the suffixes added by `MLForge.save()`) """
+
+    return base_dir + 'models/{}_{}_{}'.format(method, filename, i)
+
+
+def is_trained(filename, method='alices', i=0, base_dir='/scratch/jb6504/diboson_mining/'):
+    """ Whether the model has been trained and saved completely """
+
+    return os.path.exists(model_filename(filename, method, i, base_dir) + '_model.pt')
+
+
 def train(
         filename,
         method='alices',
@@ -26,9 +54,17 @@ def train(
         alpha=0.001,
         grad_x_regularization=None,
         base_dir='/scratch/jb6504/diboson_mining/',
+        n_cpus=1,
+        n_loader_workers=None,
+        resume=False,
 ):
     sample_dir = base_dir + 'samples/'
-    model_dir = base_dir + 'models/'
+
+    # CPU budget
+    n_threads, n_loader_workers = split_cpus(n_cpus, n_loader_workers)
+    torch.set_num_threads(n_threads)
+    logging.info('Using %s CPUs: %s torch threads, %s data loading threads', n_cpus, n_threads, n_loader_workers)
+    start_wall, start_cpu = time.time(), _cpu_time()
 
     # Labels
     cut_label = '_tight' if tight_cuts else ''
@@ -41,7 +77,8 @@ def train(
     else:
         raise ValueError('Unknown method {}'.format(method))
 
-    # Input data
+    # Input data: a sample container with all arrays, or the separate .npy files
+    container_filename = sample_dir + 'train_{}{}/train_{}.h5'.format(sample_type, cut_label, i)
     x_filename = sample_dir + 'train_{}{}/x_train_{}.npy'.format(sample_type, cut_label, i)
     if method in ["nde", "scandal", "sally", "sallino"]:
         theta0_filename = sample_dir + 'train_{}{}/theta0_train_{}.npy'.format(sample_type, cut_label, i)
@@ -57,6 +94,13 @@ def train(
         r_xz_filename = sample_dir + 'train_{}{}/r_xz_train_{}.npy'.format(sample_type, cut_label, i)
     else:
         r_xz_filename = None
+    if os.path.exists(container_filename):
+        x_filename = container_filename
+        theta0_filename, t_xz0_filename, r_xz_filename, y_filename = None, None, None, None
+
+    # Checkpoints after every epoch, so that a pre-empted or requeued job can continue with resume=True
+    model_prefix = model_filename(filename, method, i, base_dir)
+    checkpoint_filename = model_prefix + '_checkpoint.pt'
 
     # Network architecture
     n_hidden = tuple([100 for _ in range(n_layers)])
@@ -86,9 +130,32 @@ def train(
         validation_split=0.5,
         grad_x_regularization=grad_x_regularization,
         limit_samplesize=n_samples,
+        n_loader_workers=n_loader_workers,
+        memmap=True,
+        checkpoint_filename=checkpoint_filename,
+        resume=resume,
     )
 
-    ml.save(model_dir + '{}_{}_{}'.format(method, filename, i), True)
+    ml.save(model_prefix, True)
+    os.remove(checkpoint_filename)
+
+    # Effective utilization of the CPU budget
+    wall_time, cpu_time = time.time() - start_wall, _cpu_time() - start_cpu
+    logging.info(
+        'Wall time %.0f s, CPU time %.0f s: %.2f CPUs busy on average, %.0f%% of the budget of %s CPUs',
+        wall_time,
+        cpu_time,
+        cpu_time / wall_time,
+        100. * cpu_time / wall_time / n_cpus,
+        n_cpus,
+    )
+
+
+def _cpu_time():
+    """ User and system CPU time of this process (all threads) """
+
+    times = os.times()
+    return times[0] + times[1]
 
 
 if __name__ == '__main__':
@@ -105,6 +172,9 @@ if __name__ == '__main__':
     parser.add_argument('--layers', type=int, default=3)
     parser.add_argument('--alpha', type=float, default=0.001)
     parser.add_argument('--gradx', type=float, default=None)
+    parser.add_argument('--cpus', type=int, default=int(os.environ.get('SLURM_CPUS_PER_TASK', 1)))
+    parser.add_argument('--loaderworkers', type=int, default=None)
+    parser.add_argument('--resume', action='store_true', help='Continue from the checkpoint of an interrupted run')
 
     args = parser.parse_args()
 
@@ -119,4 +189,7 @@ if __name__ == '__main__':
         n_layers=args.layers,
         alpha=args.alpha,
         grad_x_regularization=args.gradx,
+        n_cpus=args.cpus,
+        n_loader_workers=args.loaderworkers,
+        resume=args.resume,
     )
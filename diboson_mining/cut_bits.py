@@ -0,0 +1,269 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import ast
+import logging
+from collections import OrderedDict
+from contextlib import contextmanager
+import six
+import h5py
+import numpy as np
+
+from madminer.utils.interfaces.madminer_hdf5 import madminer_event_loader
+
+from diboson_mining.expressions import ExpressionPlan
+
+logger = logging.getLogger(__name__)
+
+# The pass / fail results of up to 64 cuts are packed into one unsigned integer per event
+MAX_CUT_BITS = 64
+
+# Key of the packed cut bits in the observable values of parse_delphes_root_file()
+CUT_BITS_KEY = '__cut_bits__'
+
+
+def pack_cut_bits(cut_values):
+    """ Packs boolean arrays with shape (n_events,), one per cut, into one uint64 array with shape (n_events,) """
+
+    if len(cut_values) > MAX_CUT_BITS:
+        raise ValueError('At most {} cut bits are supported, got {}'.format(MAX_CUT_BITS, len(cut_values)))
+
+    bits = np.zeros(len(cut_values[0]) if len(cut_values) > 0 else 0, dtype=np.uint64)
+    for i, values in enumerate(cut_values):
+        bits |= values.astype(np.uint64) << np.uint64(i)
+    return bits
+
+
+def unpack_cut_bit(bits, i):
+    """ Pass / fail result of the i-th cut from packed cut bits, as boolean array """
+
+    return (bits >> np.uint64(i)) & np.uint64(1) == 1
+
+
+def save_cut_bits(filename, cut_bits, cut_names, cut_definitions, selections=None):
+    """
+    Saves the packed cut bits of all events together with the cut names and definitions (and optionally named
+    selections) in a MadMiner file that already contains the events.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the MadMiner file.
+
+    cut_bits : ndarray
+        Packed cut bits with shape `(n_events,)` and dtype uint64, see `pack_cut_bits()`.
+
+    cut_names : list of str
+        Names of the cuts, the i-th name belongs to bit i.
+
+    cut_definitions : list of str
+        Definitions of the cuts.
+
+    selections : OrderedDict or None, optional
+        Maps selection names to expressions of cut names, see `selection_mask()`. Default value: None.
+
+    Returns
+    -------
+        None
+
+    """
+
+    selections = OrderedDict() if selections is None else selections
+
+    with h5py.File(filename, 'a') as f:
+        n_events = f['samples/observations'].shape[0]
+        if len(cut_bits) != n_events:
+            raise ValueError('Number of cut bits and events do not match: {}, {}'.format(len(cut_bits), n_events))
+
+        for key in ['samples/cut_bits', 'cut_bits']:
+            if key in f:
+                del f[key]
+
+        f.create_dataset('samples/cut_bits', data=np.asarray(cut_bits, dtype=np.uint64))
+        f.create_dataset('cut_bits/names', data=[_ascii(name) for name in cut_names], dtype='S256')
+        f.create_dataset('cut_bits/definitions', data=[_ascii(cut) for cut in cut_definitions], dtype='S256')
+        f.create_dataset('cut_bits/selection_names', data=[_ascii(name) for name in selections], dtype='S256')
+        f.create_dataset(
+            'cut_bits/selection_expressions', data=[_ascii(expr) for expr in six.itervalues(selections)], dtype='S256'
+        )
+
+    logger.debug('Saved %s cut bits and %s selections to %s', len(cut_names), len(selections), filename)
+
+
+def has_cut_bits(filename):
+    """ Whether a MadMiner file contains cut bits """
+
+    with h5py.File(filename, 'r') as f:
+        return 'samples/cut_bits' in f and 'cut_bits/names' in f
+
+
+def load_cut_bit_setup(filename):
+    """
+    Loads the cut definitions and named selections from a MadMiner file.
+
+    Returns
+    -------
+    cuts : OrderedDict
+        Maps the cut names (in the order of the bits) to their definitions.
+
+    selections : OrderedDict
+        Maps the selection names to their expressions.
+
+    """
+
+    with h5py.File(filename, 'r') as f:
+        if 'cut_bits/names' not in f:
+            raise RuntimeError('No cut bits found in {}'.format(filename))
+
+        cuts = OrderedDict(zip(_strings(f['cut_bits/names']), _strings(f['cut_bits/definitions'])))
+        selections = OrderedDict(
+            zip(_strings(f['cut_bits/selection_names']), _strings(f['cut_bits/selection_expressions']))
+        )
+
+    return cuts, selections
+
+
+def selection_mask(filename, selection, start=0, end=None):
+    """
+    Evaluates a selection on the cut bits stored in a MadMiner file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the MadMiner file, for instance saved by `ColumnarDelphesProcessor.save()` after
+        `ColumnarDelphesProcessor.add_cut_bit()`.
+
+    selection : str
+        Name of a selection stored in the file, name of a single cut bit, or a Python expression that combines cut
+        names and stored selections with `and`, `or`, and `not`, for instance `'not (pt_a and pt_l)'`.
+
+    start : int, optional
+        First event. Default value: 0.
+
+    end : int or None, optional
+        End of the event range. If None, all events from start on are used. Default value: None.
+
+    Returns
+    -------
+    mask : ndarray
+        Boolean array with shape `(end - start,)` that is True for the events passing the selection.
+
+    """
+
+    cuts, selections = load_cut_bit_setup(filename)
+    with h5py.File(filename, 'r') as f:
+        bits = f['samples/cut_bits'][start:end]
+
+    namespace = _CutBitNamespace(bits, cuts, selections)
+    mask = namespace[selection] if selection in cuts or selection in selections else namespace.evaluate(selection)
+
+    logger.debug('%s / %s events pass selection %s', np.sum(mask), len(mask), selection)
+
+    return mask
+
+
+def selected_event_loader(filename, mask, start=0, end=None, batch_size=100000, **kwargs):
+    """
+    Like MadMiner's `madminer_event_loader()`, but only yields the events for which mask (a boolean array with one
+    entry per event in the file) is True. start, end, and batch_size refer to the events in the file, so the batches
+    can be smaller than batch_size. Empty batches are skipped, but at least one (possibly empty) batch is yielded.
+    """
+
+    if end is None:
+        end = len(mask)
+
+    current = start
+    n_yielded = 0
+    for observations, weights in madminer_event_loader(filename, start=start, end=end, batch_size=batch_size, **kwargs):
+        this_mask = mask[current : current + len(observations)]
+        current += len(observations)
+
+        if not np.any(this_mask) and (n_yielded > 0 or current < min(end, len(mask))):
+            continue
+
+        n_yielded += 1
+        yield observations[this_mask], weights[this_mask]
+
+
+@contextmanager
+def selected_events(module, filename, mask):
+    """
+    Context manager that restricts MadMiner code in module (for instance `madminer.fisherinformation`) to the events
+    passing a selection, by replacing the module's `madminer_event_loader()` with `selected_event_loader()` for
+    filename while the context is active. If mask is None, nothing is changed.
+    """
+
+    if mask is None:
+        yield
+        return
+
+    loader = module.madminer_event_loader
+
+    def selected_loader(this_filename, *args, **kwargs):
+        if this_filename != filename:
+            return loader(this_filename, *args, **kwargs)
+        return selected_event_loader(this_filename, mask, *args, **kwargs)
+
+    module.madminer_event_loader = selected_loader
+    try:
+        yield
+    finally:
+        module.madminer_event_loader = loader
+
+
+class _CutBitNamespace(object):
+    """ Cut bits (and stored selections) as boolean arrays for the evaluation of selection expressions """
+
+    def __init__(self, bits, cuts, selections):
+        self.bits = bits
+        self.cuts = list(cuts.keys())
+        self.selections = selections
+        self.n_events = len(bits)
+        self._cache = {}
+        self._evaluating = set()
+
+    def __getitem__(self, name):
+        if name in self._cache:
+            return self._cache[name]
+
+        if name in self.cuts:
+            value = unpack_cut_bit(self.bits, self.cuts.index(name))
+        elif name in self.selections:
+            if name in self._evaluating:
+                raise ValueError('Selection {} is defined through itself'.format(name))
+            self._evaluating.add(name)
+            value = self.evaluate(self.selections[name])
+            self._evaluating.remove(name)
+        else:
+            raise KeyError(name)
+
+        self._cache[name] = value
+        return value
+
+    def evaluate(self, expression):
+        try:
+            names = {node.id for node in ast.walk(ast.parse(expression, mode='eval')) if isinstance(node, ast.Name)}
+        except SyntaxError:
+            raise ValueError('Cannot parse selection {}'.format(expression))
+
+        unknown = [name for name in names if name not in self.cuts and name not in self.selections]
+        if len(unknown) > 0:
+            raise ValueError(
+                'Selection {} uses unknown names {}. Cut bits: {}, selections: {}'.format(
+                    expression, unknown, self.cuts, list(self.selections.keys())
+                )
+            )
+
+        result = ExpressionPlan([expression]).evaluate([expression], self)[expression]
+        if result is None:
+            raise ValueError('Selection {} can only combine cut bits with and, or, and not'.format(expression))
+
+        values, valid = result
+        return values.astype(np.bool_) & valid
+
+
+def _ascii(string):
+    return string.encode('ascii', 'ignore')
+
+
+def _strings(dataset):
+    return [value.decode('ascii') if isinstance(value, bytes) else str(value) for value in dataset[()]]
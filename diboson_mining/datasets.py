@@ -0,0 +1,446 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import json
+import logging
+from collections import OrderedDict
+import six
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CONTAINER_FORMAT = 'diboson_mining.samples.v1'
+
+
+class NpyWriter(object):
+    """
+    Writes an .npy file incrementally. The file is created with its final shape as a memory map, and chunks of rows
+    are written one after another (along the first axis) and flushed to disk right away, so the memory use only
+    depends on the chunk size.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the .npy file.
+
+    shape : tuple of int
+        Final shape of the array.
+
+    dtype : dtype, optional
+        Data type. Default value: np.float64.
+
+    """
+
+    def __init__(self, filename, shape, dtype=np.float64):
+        self.filename = filename
+        self.shape = tuple(shape)
+        self.n_written = 0
+        self._array = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype, shape=self.shape)
+
+    def write(self, chunk):
+        """ Appends the rows in chunk """
+
+        end = self.n_written + len(chunk)
+        if end > self.shape[0]:
+            raise ValueError(
+                'Cannot write {} rows into {}, which has {} rows'.format(end, self.filename, self.shape[0])
+            )
+
+        self._array[self.n_written : end] = chunk
+        self._array.flush()
+        self.n_written = end
+
+    def close(self):
+        """ Closes the file. All rows have to be written at this point. """
+
+        if self._array is None:
+            return
+
+        self._array.flush()
+        self._array = None
+
+        if self.n_written != self.shape[0]:
+            raise RuntimeError(
+                'Only {} of {} rows have been written to {}'.format(self.n_written, self.shape[0], self.filename)
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class IndexedArray(object):
+    """
+    Read-only array whose rows are looked up in a shared table: row i is `table[indices[i]]`. Rows are only resolved
+    when they are accessed, so many samples drawn from the same events (or parameter points) do not need their own
+    copies.
+
+    Slicing and fancy indexing along the first axis return ndarrays, `np.asarray()` resolves all rows.
+
+    Parameters
+    ----------
+    table : ndarray or memmap
+        Shared table with shape `(n_rows_table, ...)`.
+
+    indices : ndarray or memmap
+        Row of the table for each element with shape `(n_rows,)`.
+
+    """
+
+    def __init__(self, table, indices):
+        self.table = table
+        self.indices = indices
+
+    @property
+    def shape(self):
+        return (len(self.indices),) + tuple(self.table.shape[1:])
+
+    @property
+    def dtype(self):
+        return self.table.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            rows, rest = item[0], item[1:]
+        else:
+            rows, rest = item, ()
+
+        indices = np.asarray(self.indices[rows])
+
+        if indices.ndim == 0:
+            resolved = np.asarray(self.table[indices])
+        else:
+            # Read the table in ascending order (friendlier to memory maps), then restore the requested order
+            flat_indices = indices.ravel()
+            order = np.argsort(flat_indices, kind='mergesort')
+            resolved = np.empty((len(flat_indices),) + self.shape[1:], dtype=self.dtype)
+            resolved[order] = self.table[flat_indices[order]]
+            resolved = resolved.reshape(indices.shape + self.shape[1:])
+
+        if rest:
+            resolved = resolved[(slice(None),) * indices.ndim + rest]
+        return resolved
+
+    def __array__(self, dtype=None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype)
+
+    def __repr__(self):
+        return 'IndexedArray(shape={}, dtype={})'.format(self.shape, self.dtype)
+
+
+def load_samples(folder, filename, split=None, mmap_mode='r'):
+    """
+    Loads the samples saved by the `diboson_mining.sampling.SampleAugmenter` functions. Arrays saved as `.npy` files
+    `<name>_<filename>.npy` are memory-mapped. Arrays saved with index_only=True (event indices and parameter point
+    assignments `<name>_index_<filename>.npy` into the shared tables `<name>_table_<filename>.npy`) are returned as
+    IndexedArray, which resolves the rows lazily.
+
+    Parameters
+    ----------
+    folder : str
+        Folder with the samples.
+
+    filename : str
+        Filename of the samples, for instance 'train'.
+
+    split : int or None, optional
+        If not None, load the split `<filename>_<split>` (saved with n_splits). Default value: None.
+
+    mmap_mode : {None, 'r', 'r+', 'c'}, optional
+        Memory-map mode for the .npy files, None loads them into memory. Default value: 'r'.
+
+    Returns
+    -------
+    samples : OrderedDict
+        Maps names (for instance 'x', 'theta', 't_xz') to ndarray, memmap, or IndexedArray.
+
+    """
+
+    split_filename = filename if split is None else '{}_{}'.format(filename, split)
+    suffix = '_' + split_filename + '.npy'
+
+    names = sorted(name[: -len(suffix)] for name in os.listdir(folder) if name.endswith(suffix))
+    names = [name for name in names if not name.endswith('_table')]
+    if not names:
+        raise IOError('No samples {} found in {}'.format(split_filename, folder))
+
+    samples = OrderedDict()
+    for name in names:
+        array = np.load(os.path.join(folder, name + suffix), mmap_mode=mmap_mode)
+        if name.endswith('_index'):
+            name = name[: -len('_index')]
+            table = np.load(os.path.join(folder, '{}_table_{}.npy'.format(name, filename)), mmap_mode=mmap_mode)
+            array = IndexedArray(table, array)
+        samples[name] = array
+
+    logger.debug('Loaded samples %s from %s: %s', split_filename, folder, ', '.join(samples.keys()))
+
+    return samples
+
+
+class ContainerWriter(object):
+    """
+    Writes samples into a single HDF5 container. Every array is stored as a chunked dataset with the same number of
+    rows per chunk, so that training can read a few whole chunks at a time. The root group has a JSON manifest with
+    the names, dtypes, and shapes of the arrays and with provenance information (how the samples were made).
+
+    Like NpyWriter, the arrays are written chunk by chunk along the first axis.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the container (.h5).
+
+    n_samples : int
+        Number of samples, i.e. rows of each array written with `write()`.
+
+    chunk_rows : int, optional
+        Number of rows per HDF5 chunk. Default value: 4096.
+
+    provenance : dict or None, optional
+        Provenance information (for instance the source file, the theta sampler, and the cuts). Has to be JSON
+        serializable (numpy values are converted). Default value: None.
+
+    """
+
+    def __init__(self, filename, n_samples, chunk_rows=4096, provenance=None):
+        self.filename = filename
+        self.n_samples = n_samples
+        self.chunk_rows = chunk_rows
+        self.provenance = provenance if provenance is not None else {}
+        self.n_written = OrderedDict()
+        self.arrays = OrderedDict()
+
+        self._file = h5py.File(filename, 'w')
+
+    def write(self, chunk):
+        """ Appends the rows in chunk, a dict {name: ndarray} """
+
+        for name, array in six.iteritems(chunk):
+            array = np.asarray(array)
+            if name not in self.arrays:
+                self._create(name, (self.n_samples,) + array.shape[1:], array.dtype)
+                self.n_written[name] = 0
+
+            start = self.n_written[name]
+            end = start + len(array)
+            if end > self.n_samples:
+                raise ValueError(
+                    'Cannot write {} rows of {} into {}, which has {} rows'.format(
+                        end, name, self.filename, self.n_samples
+                    )
+                )
+            self._file['samples/' + name][start:end] = array
+            self.n_written[name] = end
+
+    def add_array(self, name, array):
+        """ Writes a complete array at once, which does not need to have n_samples rows (for instance a table) """
+
+        array = np.asarray(array)
+        self._create(name, array.shape, array.dtype)
+        self._file['samples/' + name][...] = array
+
+    def close(self):
+        """ Writes the manifest and closes the file. All rows have to be written at this point. """
+
+        if self._file is None:
+            return
+
+        try:
+            for name, n_written in six.iteritems(self.n_written):
+                if n_written != self.n_samples:
+                    raise RuntimeError(
+                        'Only {} of {} rows of {} have been written to {}'.format(
+                            n_written, self.n_samples, name, self.filename
+                        )
+                    )
+
+            manifest = OrderedDict(
+                [
+                    ('format', CONTAINER_FORMAT),
+                    ('n_samples', self.n_samples),
+                    ('chunk_rows', self.chunk_rows),
+                    ('arrays', self.arrays),
+                    ('provenance', self.provenance),
+                ]
+            )
+            self._file.attrs['manifest'] = json.dumps(manifest, default=_to_json)
+        finally:
+            self._file.close()
+            self._file = None
+
+    def _create(self, name, shape, dtype):
+        chunk_rows = max(1, min(self.chunk_rows, shape[0]))
+        self._file.create_dataset('samples/' + name, shape=shape, dtype=dtype, chunks=(chunk_rows,) + shape[1:])
+        self.arrays[name] = OrderedDict([('dtype', dtype.str), ('shape', list(shape)), ('chunk_rows', chunk_rows)])
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ContainerArray(object):
+    """
+    Read-only view of one array in a sample container, which is read lazily. Arbitrary row indices are supported
+    (they are sorted and deduplicated before HDF5 is asked for them). The file is opened on first access, so
+    instances can be pickled and sent to other processes.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the container.
+
+    name : str
+        Name of the array.
+
+    shape : tuple of int
+        Shape of the array.
+
+    dtype : dtype
+        Data type of the array.
+
+    chunk_rows : int
+        Number of rows per HDF5 chunk.
+
+    """
+
+    def __init__(self, filename, name, shape, dtype, chunk_rows):
+        self.filename = filename
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.chunk_rows = chunk_rows
+        self._file = None
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            rows, rest = item[0], item[1:]
+        else:
+            rows, rest = item, ()
+
+        dataset = self._dataset()
+
+        if isinstance(rows, slice):
+            resolved, n_row_dims = dataset[rows], 1
+        elif np.ndim(rows) == 0:
+            resolved, n_row_dims = dataset[int(rows)], 0
+        else:
+            rows = np.asarray(rows)
+            if rows.dtype == np.bool_:
+                rows = np.flatnonzero(rows)
+            rows = np.where(rows < 0, rows + self.shape[0], rows)
+            unique_rows, inverse = np.unique(rows.ravel(), return_inverse=True)
+            if len(unique_rows) > 0:
+                resolved = dataset[unique_rows][inverse]
+            else:
+                resolved = np.empty((0,) + self.shape[1:], self.dtype)
+            resolved, n_row_dims = resolved.reshape(rows.shape + self.shape[1:]), rows.ndim
+
+        if rest:
+            resolved = resolved[(slice(None),) * n_row_dims + rest]
+        return resolved
+
+    def __array__(self, dtype=None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'] = None
+        return state
+
+    def __repr__(self):
+        return 'ContainerArray({}:{}, shape={}, dtype={})'.format(self.filename, self.name, self.shape, self.dtype)
+
+    def _dataset(self):
+        if self._file is None:
+            self._file = h5py.File(self.filename, 'r')
+        return self._file['samples/' + self.name]
+
+
+def is_sample_container(filename):
+    """ Checks whether filename is a sample container written by ContainerWriter """
+
+    if filename is None or not os.path.isfile(filename) or not h5py.is_hdf5(filename):
+        return False
+    with h5py.File(filename, 'r') as file:
+        return 'manifest' in file.attrs
+
+
+def read_manifest(filename):
+    """ Returns the manifest of a sample container as OrderedDict """
+
+    with h5py.File(filename, 'r') as file:
+        manifest = file.attrs['manifest']
+    if isinstance(manifest, bytes):
+        manifest = manifest.decode('utf-8')
+    manifest = json.loads(manifest, object_pairs_hook=OrderedDict)
+
+    if manifest.get('format') != CONTAINER_FORMAT:
+        raise IOError('{} is not a sample container (format {})'.format(filename, manifest.get('format')))
+    return manifest
+
+
+def load_container(filename):
+    """
+    Loads the arrays in a sample container (as written by `SampleAugmenter` with container=True) lazily.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the container.
+
+    Returns
+    -------
+    samples : OrderedDict
+        Maps names (for instance 'x', 'theta', 't_xz') to ContainerArray instances, or to IndexedArray instances for
+        samples saved with index_only=True.
+
+    """
+
+    manifest = read_manifest(filename)
+    folder = os.path.dirname(filename)
+
+    samples, tables = OrderedDict(), {}
+    for name, info in six.iteritems(manifest['arrays']):
+        array = ContainerArray(filename, name, info['shape'], info['dtype'], info['chunk_rows'])
+        if 'table' in info:
+            if info['table_file'] not in tables:
+                tables[info['table_file']] = load_container(os.path.join(folder, info['table_file']))
+            name = info['table']
+            array = IndexedArray(tables[info['table_file']][name], array)
+        samples[name] = array
+
+    logger.debug('Loaded sample container %s: %s', filename, ', '.join(samples.keys()))
+
+    return samples
+
+
+def _to_json(value):
+    """ Fallback for values that json does not know, such as numpy numbers and arrays """
+
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
@@ -0,0 +1,513 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+from collections import OrderedDict
+import six
+import numpy as np
+
+from madminer.delphes import DelphesProcessor
+from madminer.utils.interfaces.lhe import extract_nuisance_parameters_from_lhe_file
+
+from diboson_mining.delphes_root import parse_delphes_root_file, parse_delphes_root_file_in_chunks
+from diboson_mining.cut_bits import MAX_CUT_BITS, CUT_BITS_KEY, save_cut_bits
+from diboson_mining.lhe import read_lhe_weights, lhe_weights_as_dict
+
+logger = logging.getLogger(__name__)
+
+
+class ColumnarDelphesProcessor(DelphesProcessor):
+    """
+    DelphesProcessor that reads the Delphes objects into columns (one array per particle property) and can evaluate
+    observables on all events at once.
+
+    In addition to the per-event observables of `DelphesProcessor`, `add_observable_from_function()` accepts
+    vectorized functions with `vectorized=True`. Such functions receive `ParticleColumns` for leptons, photons, and
+    jets and a `LorentzArray` for MET, and return an ndarray with one value per event. With
+    `add_observables_from_function()`, one vectorized function can define several observables that share
+    intermediate results. Several named selections can be defined with `add_selection()`, they are all applied in
+    the same pass over the Delphes files and saved separately. With `add_cut_bit()`, the pass / fail result of
+    individual cuts is stored per event as a bitset in the saved files, and `add_cut_bit_selection()` defines named
+    selections on these bits, which `SampleAugmenter` and `FisherInformation` can apply later (for instance the
+    tight and anti-tight subsets of a loose sample). Everything else (samples, Delphes runs, weights) works
+    exactly like in `DelphesProcessor`. Generator truth is not supported.
+    """
+
+    def __init__(self, filename):
+        super(ColumnarDelphesProcessor, self).__init__(filename)
+
+        self.observables_vectorized = OrderedDict()
+        self.observables_outputs = OrderedDict()
+
+        self.selections = OrderedDict()
+        self.selection_observations = OrderedDict()
+        self.selection_weights = OrderedDict()
+
+        self.cut_bits = OrderedDict()
+        self.cut_bit_selections = OrderedDict()
+        self.selection_cut_bits = OrderedDict()
+
+    def add_observable(self, name, definition, required=False, default=None):
+        super(ColumnarDelphesProcessor, self).add_observable(name, definition, required, default)
+        self.observables_vectorized[name] = False
+        self.observables_outputs[name] = None
+
+    def add_observable_from_function(self, name, fn, required=False, default=None, vectorized=False):
+        """
+        Adds an observable defined through a function.
+
+        Parameters
+        ----------
+        name : str
+            Name of the observable.
+
+        fn : function
+            A function with signature `observable(leptons, photons, jets, met)`. If vectorized is False, the input
+            arguments are lists of MadMinerParticle instances for a single event, a float is returned, and a
+            `RuntimeError` signals that the observable is not defined. If vectorized is True, the function is called
+            once with `ParticleColumns` for leptons, photons, and jets and a `LorentzArray` for met, and returns an
+            ndarray with shape `(n_events,)`, using NaN for events where the observable is not defined.
+
+        required : bool, optional
+            Whether the observable is required. Default value: False.
+
+        default : float or None, optional
+            Placeholder value for events where the observable is not defined. Default value: None.
+
+        vectorized : bool, optional
+            Whether fn works on whole columns of events. Default value: False.
+
+        Returns
+        -------
+            None
+
+        """
+
+        super(ColumnarDelphesProcessor, self).add_observable_from_function(name, fn, required, default)
+        self.observables_vectorized[name] = vectorized
+        self.observables_outputs[name] = None
+
+    def add_observables_from_function(self, names, fn, required=False, default=None):
+        """
+        Adds several observables that are calculated together by one vectorized function, so that intermediate
+        results (for instance a neutrino reconstruction) are computed only once per event.
+
+        Parameters
+        ----------
+        names : list of str
+            Names of the observables.
+
+        fn : function
+            A function with signature `observables(leptons, photons, jets, met)`, where leptons, photons, and jets
+            are `ParticleColumns` and met is a `LorentzArray`. It returns a dict with an ndarray with shape
+            `(n_events,)` for each name, using NaN for events where an observable is not defined. It is called once
+            per Delphes file.
+
+        required : bool or list of bool, optional
+            Whether the observables are required. Default value: False.
+
+        default : float or None or list, optional
+            Placeholder values for events where the observables are not defined. Default value: None.
+
+        Returns
+        -------
+            None
+
+        """
+
+        if not isinstance(required, list):
+            required = [required for _ in names]
+        if not isinstance(default, list):
+            default = [default for _ in names]
+
+        for name, this_required, this_default in zip(names, required, default):
+            self.add_observable_from_function(name, fn, this_required, this_default, vectorized=True)
+            self.observables_outputs[name] = name
+
+    def reset_observables(self):
+        super(ColumnarDelphesProcessor, self).reset_observables()
+        self.observables_vectorized = OrderedDict()
+        self.observables_outputs = OrderedDict()
+
+    def add_selection(self, name, cuts, pass_if_not_parsed=False):
+        """
+        Adds a named selection, i.e. a set of cuts that is applied in addition to (and independently of) the cuts
+        defined with `add_cut()`. `analyse_delphes_samples()` calculates the observables only once and applies every
+        selection to them, the results for each selection can then be saved with `save(filename, selection=name)`.
+
+        Parameters
+        ----------
+        name : str
+            Name of the selection.
+
+        cuts : list of str
+            Cuts in the same format as for `add_cut()`.
+
+        pass_if_not_parsed : bool or list of bool, optional
+            Whether the cuts are passed if they cannot be parsed. Default value: False.
+
+        Returns
+        -------
+            None
+
+        """
+
+        if not isinstance(pass_if_not_parsed, list):
+            pass_if_not_parsed = [pass_if_not_parsed for _ in cuts]
+
+        logger.debug('Adding selection %s with cuts %s', name, cuts)
+        self.selections[name] = (list(cuts), pass_if_not_parsed)
+
+    def reset_selections(self):
+        """ Resets all selections defined with `add_selection()`. """
+
+        self.selections = OrderedDict()
+
+    def add_cut_bit(self, name, cut, pass_if_not_parsed=False):
+        """
+        Adds a cut whose pass / fail result is stored for every event as one bit of a per-event bitset. Unlike the
+        cuts from `add_cut()` and `add_selection()`, it does not remove any events. The bits are saved in the MadMiner
+        file (as `samples/cut_bits`, together with the cut names and definitions), and selections built from them
+        can be applied later, see `add_cut_bit_selection()` and `diboson_mining.cut_bits.selection_mask()`. The bits
+        are only evaluated for events that pass at least one selection.
+
+        Parameters
+        ----------
+        name : str
+            Name of the cut bit, has to be a valid Python identifier.
+
+        cut : str
+            Cut in the same format as for `add_cut()`.
+
+        pass_if_not_parsed : bool, optional
+            Whether the cut is passed if it cannot be parsed. Default value: False.
+
+        Returns
+        -------
+            None
+
+        """
+
+        if name not in self.cut_bits and len(self.cut_bits) >= MAX_CUT_BITS:
+            raise RuntimeError('At most {} cut bits are supported'.format(MAX_CUT_BITS))
+
+        logger.debug('Adding cut bit %s: %s', name, cut)
+        self.cut_bits[name] = (cut, pass_if_not_parsed)
+
+    def add_cut_bit_selection(self, name, expression):
+        """
+        Adds a named selection on the cut bits from `add_cut_bit()`, which is saved in the MadMiner file and can be
+        passed by name to `SampleAugmenter` and `FisherInformation`.
+
+        Parameters
+        ----------
+        name : str
+            Name of the selection.
+
+        expression : str
+            Python expression that combines the names of cut bits and of previously added selections with `and`, `or`,
+            and `not`, for instance `'not tight'`.
+
+        Returns
+        -------
+            None
+
+        """
+
+        logger.debug('Adding cut bit selection %s: %s', name, expression)
+        self.cut_bit_selections[name] = expression
+
+    def reset_cut_bits(self):
+        """ Resets all cut bits and cut bit selections. """
+
+        self.cut_bits = OrderedDict()
+        self.cut_bit_selections = OrderedDict()
+
+    def analyse_delphes_samples(
+        self,
+        generator_truth=False,
+        delete_delphes_files=False,
+        reference_benchmark=None,
+        parse_lhe_events_as_xml=True,
+        chunk_size=None,
+        n_workers=1,
+    ):
+        """
+        Main function that parses the Delphes samples (ROOT files), checks acceptance and cuts, and extracts
+        the observables and weights. Like `DelphesProcessor.analyse_delphes_samples()`, but every Delphes file is read
+        only once for the cuts from `add_cut()` and all selections from `add_selection()`. Cuts are evaluated
+        cheapest first, and observables defined through functions are only calculated for the events that pass the
+        cheaper cuts. If selections are defined but no cuts were added with `add_cut()`, only the selections are
+        analysed.
+
+        Parameters
+        ----------
+        generator_truth : bool, optional
+            Not supported, has to be False. Default value: False.
+
+        delete_delphes_files : bool, optional
+            If True, the Delphes ROOT files will be deleted after extracting the information from them. Default value:
+            False.
+
+        reference_benchmark : str or None, optional
+            Reference benchmark for the rescaling of the nuisance benchmarks. If None, the first one will be used.
+            Default value: None.
+
+        parse_lhe_events_as_xml : bool, optional
+            Ignored, kept for compatibility with `DelphesProcessor`: the weights are always streamed from the LHE file
+            with `read_lhe_weights()`. Default value: True.
+
+        chunk_size : int or None, optional
+            If not None, each Delphes file is split into ranges of chunk_size events that are analysed in parallel
+            and merged in order afterwards. Default value: None.
+
+        n_workers : int, optional
+            Number of worker processes for the chunks. Default value: 1.
+
+        Returns
+        -------
+            None
+
+        """
+
+        if reference_benchmark is None:
+            reference_benchmark = self.benchmark_names_phys[0]
+        self.reference_benchmark = reference_benchmark
+
+        self.nuisance_parameters = None
+        self.selection_observations = OrderedDict([(selection, None) for selection in self._all_selections()])
+        self.selection_weights = OrderedDict([(selection, None) for selection in self._all_selections()])
+        self.selection_cut_bits = OrderedDict([(selection, None) for selection in self._all_selections()])
+
+        for (
+            delphes_file,
+            weight_labels,
+            is_background,
+            sampling_benchmark,
+            lhe_file,
+            lhe_file_for_weights,
+            k_factor,
+        ) in zip(
+            self.delphes_sample_filenames,
+            self.hepmc_sample_weight_labels,
+            self.hepmc_is_backgrounds,
+            self.hepmc_sampled_from_benchmark,
+            self.lhe_sample_filenames,
+            self.lhe_sample_filenames_for_weights,
+            self.sample_k_factors,
+        ):
+            logger.info('Analysing Delphes sample %s', delphes_file)
+
+            results = self._analyse_delphes_sample(
+                delete_delphes_files,
+                delphes_file,
+                generator_truth,
+                is_background,
+                k_factor,
+                lhe_file,
+                lhe_file_for_weights,
+                parse_lhe_events_as_xml,
+                reference_benchmark,
+                sampling_benchmark,
+                weight_labels,
+                chunk_size=chunk_size,
+                n_workers=n_workers,
+            )
+
+            for selection, (this_observations, this_weights) in six.iteritems(results):
+                if this_observations is None:
+                    continue
+
+                if len(self.cut_bits) > 0:
+                    # The observable values can be shared between selections, so they are copied without the bits
+                    this_cut_bits = this_observations[CUT_BITS_KEY]
+                    this_observations = OrderedDict(
+                        [(key, values) for key, values in six.iteritems(this_observations) if key != CUT_BITS_KEY]
+                    )
+                    previous = self.selection_cut_bits[selection]
+                    self.selection_cut_bits[selection] = (
+                        this_cut_bits if previous is None else np.hstack([previous, this_cut_bits])
+                    )
+
+                self.selection_observations[selection] = _merge(
+                    self.selection_observations[selection], this_observations, 'Observable'
+                )
+                self.selection_weights[selection] = _merge(self.selection_weights[selection], this_weights, 'Weight')
+
+        self.observations = self.selection_observations.get(None)
+        self.weights = self.selection_weights.get(None)
+
+    def save(self, filename_out, selection=None):
+        """
+        Saves the observable definitions, observable values, and event weights in a MadMiner file. If cut bits were
+        defined with `add_cut_bit()`, the cut bits of the events and the cut bit selections are saved as well.
+
+        Parameters
+        ----------
+        filename_out : str
+            Path to where the results should be saved.
+
+        selection : str or None, optional
+            Name of a selection defined with `add_selection()`. If None, the events passing the cuts from `add_cut()`
+            are saved. Default value: None.
+
+        Returns
+        -------
+            None
+
+        """
+
+        if selection is None:
+            super(ColumnarDelphesProcessor, self).save(filename_out)
+        else:
+            logger.info('Saving events passing selection %s to %s', selection, filename_out)
+
+            observations, weights = self.observations, self.weights
+            self.observations = self.selection_observations[selection]
+            self.weights = self.selection_weights[selection]
+            try:
+                super(ColumnarDelphesProcessor, self).save(filename_out)
+            finally:
+                self.observations, self.weights = observations, weights
+
+        cut_bits = self.selection_cut_bits.get(selection)
+        if len(self.cut_bits) > 0 and cut_bits is not None:
+            save_cut_bits(
+                filename_out,
+                cut_bits,
+                list(self.cut_bits.keys()),
+                [cut for cut, _ in six.itervalues(self.cut_bits)],
+                self.cut_bit_selections,
+            )
+
+    def _all_selections(self):
+        """ The named selections, plus the cuts from `add_cut()` (as selection None) if there are any """
+
+        selections = OrderedDict()
+        if len(self.cuts) > 0 or len(self.selections) == 0:
+            selections[None] = (self.cuts, self.cuts_default_pass)
+        selections.update(self.selections)
+        return selections
+
+    def _analyse_delphes_sample(
+        self,
+        delete_delphes_files,
+        delphes_file,
+        generator_truth,
+        is_background,
+        k_factor,
+        lhe_file,
+        lhe_file_for_weights,
+        parse_lhe_events_as_xml,
+        reference_benchmark,
+        sampling_benchmark,
+        weight_labels,
+        chunk_size=None,
+        n_workers=1,
+    ):
+        """ Returns an OrderedDict that maps each selection (None for the default cuts) to (observations, weights) """
+
+        if generator_truth:
+            raise NotImplementedError('ColumnarDelphesProcessor does not support generator truth, use DelphesProcessor')
+
+        # Nuisance parameters
+        nuisance_parameters = extract_nuisance_parameters_from_lhe_file(lhe_file, self.systematics)
+        if self.nuisance_parameters is None:
+            self.nuisance_parameters = nuisance_parameters
+        elif dict(self.nuisance_parameters) != dict(nuisance_parameters):
+            raise RuntimeError(
+                'Different LHE files have different definitions of nuisance parameters / benchmarks!\n'
+                'Previous: {}\nNew:{}'.format(self.nuisance_parameters, nuisance_parameters)
+            )
+
+        # Observables and weights from Delphes ROOT file
+        kwargs = dict(
+            observables=self.observables,
+            observables_required=self.observables_required,
+            observables_defaults=self.observables_defaults,
+            selections=self._all_selections(),
+            weight_labels=weight_labels,
+            cut_bits=self.cut_bits if len(self.cut_bits) > 0 else None,
+            observables_vectorized=self.observables_vectorized,
+            observables_outputs=self.observables_outputs,
+            delete_delphes_sample_file=delete_delphes_files,
+            acceptance_eta_max_a=self.acceptance_eta_max_a,
+            acceptance_eta_max_e=self.acceptance_eta_max_e,
+            acceptance_eta_max_mu=self.acceptance_eta_max_mu,
+            acceptance_eta_max_j=self.acceptance_eta_max_j,
+            acceptance_pt_min_a=self.acceptance_pt_min_a,
+            acceptance_pt_min_e=self.acceptance_pt_min_e,
+            acceptance_pt_min_mu=self.acceptance_pt_min_mu,
+            acceptance_pt_min_j=self.acceptance_pt_min_j,
+        )
+        if chunk_size is None:
+            selection_results = parse_delphes_root_file(delphes_file, **kwargs)
+        else:
+            selection_results = parse_delphes_root_file_in_chunks(
+                delphes_file, chunk_size, n_workers=n_workers, **kwargs
+            )
+
+        # Weights from LHE file (streamed into one array, parsed once for all selections)
+        lhe_weights = None
+        if lhe_file_for_weights is not None:
+            lhe_weights = lhe_weights_as_dict(*read_lhe_weights(lhe_file_for_weights, sampling_benchmark))
+
+        results = OrderedDict()
+
+        for selection, (this_observations, this_weights, cut_filter) in six.iteritems(selection_results):
+            if this_observations is None:
+                logger.debug('No observations in this Delphes file pass selection %s, skipping it', selection)
+                results[selection] = (None, None)
+                continue
+
+            if lhe_weights is not None:
+                this_weights = OrderedDict()
+                for key, weights in six.iteritems(lhe_weights):
+                    this_weights[key] = weights if cut_filter is None else weights[cut_filter]
+
+            if this_weights is None:
+                raise RuntimeError('Could not extract weights from Delphes ROOT file or LHE file.')
+
+            results[selection] = (
+                this_observations,
+                self._finalize_weights(this_weights, k_factor, is_background, reference_benchmark, sampling_benchmark),
+            )
+
+        return results
+
+    def _finalize_weights(self, weights, k_factor, is_background, reference_benchmark, sampling_benchmark):
+        """ Applies k factors, background handling, and the nuisance rescaling exactly like DelphesProcessor """
+
+        if k_factor is not None:
+            for key in weights:
+                weights[key] = k_factor * weights[key]
+
+        if is_background:
+            benchmarks_weight = list(six.itervalues(weights))[0]
+            for benchmark_name in self.benchmark_names_phys:
+                weights[benchmark_name] = benchmarks_weight
+
+        reference_weights = weights[reference_benchmark]
+        sampling_weights = weights[sampling_benchmark]
+        for key in weights:
+            if key not in self.benchmark_names_phys:
+                weights[key] = reference_weights / sampling_weights * weights[key]
+
+        return weights
+
+
+def _merge(previous, new, label):
+    """ Appends the events in the OrderedDict new to those in previous (or returns new if previous is None) """
+
+    if previous is None:
+        return new
+
+    if len(previous) != len(new):
+        raise ValueError(
+            'Number of {}s in different files incompatible: {} vs {}'.format(label, len(previous), len(new))
+        )
+
+    for key in previous:
+        assert key in new, '{} {} not found in sample!'.format(label, key)
+        previous[key] = np.hstack([previous[key], new[key]])
+
+    return previous
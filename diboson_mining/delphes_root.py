@@ -0,0 +1,816 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import ast
+import logging
+from collections import OrderedDict
+import six
+import numpy as np
+import uproot
+
+from madminer.utils.particle import MadMinerParticle
+from madminer.utils.various import math_commands
+
+from diboson_mining.vectors import LorentzArray
+from diboson_mining.expressions import ExpressionPlan, ColumnNamespace
+from diboson_mining.cut_bits import CUT_BITS_KEY, pack_cut_bits
+from diboson_mining.parallel import run_in_parallel
+
+logger = logging.getLogger(__name__)
+
+# Names of the particle objects in MadMiner's eval() namespace
+_PARTICLE_NAMES = {'e', 'mu', 'l', 'a', 'j', 'met', 'visible', 'all', 'boost_to_com'}
+
+# Compiled expressions, see _expression_plan()
+_expression_plans = {}
+
+
+class ParticleColumns(object):
+    """
+    All particles of one type (e.g. all photons) in a set of events, stored as padded arrays with shape
+    `(n_events, n_max)` and sorted by descending pT within each event.
+
+    `columns[i]` returns a `LorentzArray` for the i-th hardest particle in every event, whose `valid` mask marks
+    the events that have more than i particles. This mirrors `l[0]`, `a[1]`, ... for the per-event lists of
+    `MadMinerParticle` objects.
+
+    `event_random` optionally holds one uniform random number per event, drawn for all events before any observable
+    is calculated. Observables with a random choice per event (like the neutrino solution in `calculate_phi`) use it,
+    so that their values do not depend on which events are evaluated and in which order.
+    """
+
+    def __init__(self, x, y, z, t, counts, pdgid, tau_tag=None, b_tag=None, event_random=None):
+        self.x = x
+        self.y = y
+        self.z = z
+        self.t = t
+        self.counts = counts
+        self.pdgid = pdgid
+        self.tau_tag = np.zeros(x.shape, dtype=np.bool_) if tau_tag is None else tau_tag
+        self.b_tag = np.zeros(x.shape, dtype=np.bool_) if b_tag is None else b_tag
+        self.event_random = event_random
+
+    @property
+    def n_events(self):
+        return self.x.shape[0]
+
+    @property
+    def n_max(self):
+        return self.x.shape[1]
+
+    def __getitem__(self, i):
+        if i < 0 or i >= self.n_max:
+            nans = np.nan * np.ones(self.n_events)
+            zeros = np.zeros(self.n_events, dtype=np.int64)
+            return LorentzArray(
+                nans, nans, nans, nans, valid=np.zeros(self.n_events, dtype=np.bool_), pdgid=zeros, charge=0. * zeros
+            )
+
+        pdgid = self.pdgid[:, i]
+        return LorentzArray(
+            self.x[:, i],
+            self.y[:, i],
+            self.z[:, i],
+            self.t[:, i],
+            valid=self.counts > i,
+            pdgid=pdgid,
+            charge=_charge_from_pdgid(pdgid),
+        )
+
+    def select(self, rows):
+        """ Returns ParticleColumns for a subset of events """
+
+        return ParticleColumns(
+            self.x[rows],
+            self.y[rows],
+            self.z[rows],
+            self.t[rows],
+            self.counts[rows],
+            self.pdgid[rows],
+            tau_tag=self.tau_tag[rows],
+            b_tag=self.b_tag[rows],
+            event_random=None if self.event_random is None else self.event_random[rows],
+        )
+
+    def particles(self, event):
+        """ Returns the particles in one event as list of MadMinerParticle instances """
+
+        particles = []
+        for i in range(self.counts[event]):
+            particle = MadMinerParticle()
+            particle.setpxpypze(self.x[event, i], self.y[event, i], self.z[event, i], self.t[event, i])
+            particle.set_pdgid(self.pdgid[event, i])
+            if self.tau_tag[event, i] or self.b_tag[event, i]:
+                particle.set_tags(bool(self.tau_tag[event, i]), bool(self.b_tag[event, i]), False)
+            particles.append(particle)
+        return particles
+
+    def total(self):
+        """ Returns the sum of all particles in each event as LorentzArray """
+
+        return LorentzArray(
+            np.nansum(self.x, axis=1), np.nansum(self.y, axis=1), np.nansum(self.z, axis=1), np.nansum(self.t, axis=1)
+        )
+
+
+def parse_delphes_root_file(
+    delphes_sample_file,
+    observables,
+    observables_required,
+    observables_defaults,
+    selections,
+    weight_labels=None,
+    cut_bits=None,
+    observables_vectorized=None,
+    observables_outputs=None,
+    acceptance_pt_min_e=None,
+    acceptance_pt_min_mu=None,
+    acceptance_pt_min_a=None,
+    acceptance_pt_min_j=None,
+    acceptance_eta_max_e=None,
+    acceptance_eta_max_mu=None,
+    acceptance_eta_max_a=None,
+    acceptance_eta_max_j=None,
+    delete_delphes_sample_file=False,
+    entrystart=None,
+    entrystop=None,
+):
+    """
+    Extracts observables and weights from a Delphes ROOT file (or the events from entrystart to entrystop in it),
+    reading the particles into columns.
+
+    Observables flagged in `observables_vectorized` are evaluated on these columns. Observables and cuts given as
+    expression strings are compiled into a vectorized `ExpressionPlan` (which calculates common subexpressions only
+    once), expressions that cannot be vectorized and non-vectorized functions are evaluated event by event exactly
+    like in MadMiner. For vectorized functions that return several
+    observables at once, `observables_outputs` maps the observable names to the keys of the returned dict.
+
+    `selections` is an OrderedDict that maps selection names to tuples `(cuts, cuts_default_pass)`. The observables
+    are evaluated lazily: the cuts and the checks of required observables are sorted by the cost of the observables
+    they depend on, and each of them is only evaluated for the events that survived the previous ones in at least one
+    selection. Observables defined through functions are thus only calculated for events that pass the cheap cuts,
+    and all remaining observables only for events that pass at least one selection. Cuts that appear in several
+    selections are evaluated only once. So that random observables do not depend on the cuts and their order, one
+    uniform random number and one seed per event are drawn for all events before the evaluation: vectorized
+    functions find the former in `ParticleColumns.event_random`, and numpy's random state is seeded with the latter
+    before each event-by-event evaluation of a function (and restored afterwards).
+
+    `cut_bits` is an optional OrderedDict that maps cut names to tuples `(cut, default_pass)`. These cuts are
+    evaluated for all events that pass at least one selection, and their pass / fail results are packed into one
+    uint64 per event, which is stored in the observable values under the key `CUT_BITS_KEY`.
+
+    Returns an OrderedDict that maps each selection name to a tuple `(observable_values, weights, filter)`, where
+    observable_values and weights are None if no event passes the selection.
+    """
+
+    logger.debug('Parsing Delphes file %s', delphes_sample_file)
+
+    tree = uproot.open(str(delphes_sample_file))['Delphes']
+    if entrystart is not None or entrystop is not None:
+        tree = _TreeRange(tree, entrystart, entrystop)
+
+    # Weights
+    weights = None
+    if weight_labels is not None:
+        try:
+            weights = tree.array('Weight.Weight')
+        except KeyError:
+            raise RuntimeError('Extracting weights from Delphes ROOT file failed, parse weights from the LHE file!')
+        n_events = len(weights)
+        weights = np.array(weights).reshape((n_events, -1)).T
+
+    # Particles
+    objects = read_delphes_objects(
+        tree,
+        acceptance_pt_min_e=acceptance_pt_min_e,
+        acceptance_pt_min_mu=acceptance_pt_min_mu,
+        acceptance_pt_min_a=acceptance_pt_min_a,
+        acceptance_pt_min_j=acceptance_pt_min_j,
+        acceptance_eta_max_e=acceptance_eta_max_e,
+        acceptance_eta_max_mu=acceptance_eta_max_mu,
+        acceptance_eta_max_a=acceptance_eta_max_a,
+        acceptance_eta_max_j=acceptance_eta_max_j,
+    )
+    n_events = len(objects['met'])
+    logger.debug('Found %s events', n_events)
+
+    # Random numbers for all events, drawn before any cut is applied
+    event_random = np.random.rand(n_events)
+    event_seeds = np.random.randint(np.iinfo(np.int32).max, size=n_events)
+    for key in ['e', 'mu', 'l', 'a', 'j']:
+        objects[key].event_random = event_random
+
+    # Expression strings, compiled into one vectorized plan
+    expressions = [definition for definition in six.itervalues(observables) if isinstance(definition, six.string_types)]
+    for cuts, _ in six.itervalues(selections):
+        expressions += cuts
+    if cut_bits is not None:
+        expressions += [cut for cut, _ in six.itervalues(cut_bits)]
+    plan = _expression_plan(expressions)
+
+    observable_values = _LazyObservables(
+        objects,
+        plan,
+        observables,
+        observables_defaults,
+        observables_vectorized,
+        observables_outputs,
+        event_seeds=event_seeds,
+    )
+
+    # Cuts and required observables, cheapest first
+    passed = OrderedDict([(selection, np.ones(n_events, dtype=np.bool_)) for selection in selections])
+
+    for check, check_selections in _order_checks(observable_values, observables_required, selections):
+        events = np.zeros(n_events, dtype=np.bool_)
+        for selection in check_selections:
+            events |= passed[selection]
+        if not np.any(events):
+            continue
+
+        values_this_check = check.evaluate(observable_values, events)
+        logger.debug('  %s / %s events pass %s', np.sum(values_this_check), np.sum(events), check)
+
+        for selection in check_selections:
+            passed[selection] &= values_this_check
+
+    # Remaining observables, only for events that pass at least one selection
+    events = np.zeros(n_events, dtype=np.bool_)
+    for selection in selections:
+        events |= passed[selection]
+    observable_values.evaluate(list(observables.keys()), events)
+
+    for obs_name, values_this_observable in six.iteritems(observable_values.values):
+        logger.debug('  First 10 values for observable %s:\n%s', obs_name, values_this_observable[events][:10])
+
+    # Cut bits, also only for events that pass at least one selection
+    values = observable_values.values
+    if cut_bits is not None:
+        observable_names = list(observables.keys())
+        cut_values = []
+        for cut, default_pass in six.itervalues(cut_bits):
+            this_cut = _Cut(cut, default_pass, observable_names)
+            cut_values.append(this_cut.evaluate(observable_values, events))
+            logger.debug('  %s / %s events pass %s', np.sum(cut_values[-1]), np.sum(events), this_cut)
+
+        values = OrderedDict(values)
+        values[CUT_BITS_KEY] = pack_cut_bits(cut_values)
+
+    # Apply selections
+    has_required = any(observables_required[obs_name] for obs_name in observables)
+    results = OrderedDict()
+
+    for selection, (cuts, _) in six.iteritems(selections):
+        if selection is not None:
+            logger.info('  Selection %s:', selection)
+
+        results[selection] = filter_events(
+            values,
+            weights,
+            weight_labels,
+            passed[selection] if has_required or len(cuts) > 0 else None,
+        )
+
+    if delete_delphes_sample_file:
+        logger.debug('  Deleting %s', delphes_sample_file)
+        os.remove(delphes_sample_file)
+
+    return results
+
+
+class _LazyObservables(object):
+    """
+    Observable values that are only calculated for the events where they are needed. `values` maps each observable
+    name to an ndarray with shape `(n_events,)`, which is NaN for events that have not been evaluated yet.
+
+    Expression strings are evaluated with a vectorized `ExpressionPlan` where possible and considered cheap (cost 0),
+    observables defined through functions or expressions that have to be evaluated event by event are expensive
+    (cost 1). If event_seeds is given, numpy's random state is seeded with the seed of each event before a function
+    is evaluated for it, and restored afterwards.
+    """
+
+    def __init__(
+        self,
+        objects,
+        plan,
+        observables,
+        observables_defaults,
+        observables_vectorized=None,
+        observables_outputs=None,
+        event_seeds=None,
+    ):
+        self.objects = objects
+        self.plan = plan
+        self.observables = observables
+        self.observables_defaults = observables_defaults
+        self.observables_vectorized = {} if observables_vectorized is None else observables_vectorized
+        self.observables_outputs = {} if observables_outputs is None else observables_outputs
+        self.per_event_objects = _PerEventObjects(objects)
+        self.event_seeds = event_seeds
+
+        n_events = len(objects['met'])
+        self.values = OrderedDict([(obs_name, np.nan * np.ones(n_events)) for obs_name in observables])
+        self.evaluated = {obs_name: np.zeros(n_events, dtype=np.bool_) for obs_name in observables}
+
+    def cost(self, obs_name):
+        return 0 if self._is_compiled(obs_name) else 1
+
+    def evaluate(self, obs_names, events):
+        """ Makes sure that the observables obs_names are calculated for all events in the boolean mask events """
+
+        # Compiled expressions that are needed for the same events are evaluated together, sharing subexpressions
+        compiled = OrderedDict()
+        for obs_name in obs_names:
+            todo = events & ~self.evaluated[obs_name]
+            if self._is_compiled(obs_name) and np.any(todo):
+                compiled.setdefault(todo.tobytes(), (todo, []))[1].append(obs_name)
+
+        for todo, this_obs_names in six.itervalues(compiled):
+            self._calculate_compiled(this_obs_names, todo)
+
+        for obs_name in obs_names:
+            todo = events & ~self.evaluated[obs_name]
+            if not np.any(todo):
+                continue
+
+            rows = np.flatnonzero(todo)
+            for name, values in six.iteritems(self._calculate(obs_name, rows)):
+                self.values[name][rows] = values
+                self.evaluated[name] |= todo
+
+    def namespace(self, rows, observables=None):
+        """ ColumnNamespace for a subset of events, observables maps names to values for these events """
+
+        return ColumnNamespace(_select_objects(self.objects, rows), observables)
+
+    def _is_compiled(self, obs_name):
+        definition = self.observables[obs_name]
+        return isinstance(definition, six.string_types) and self.plan.is_vectorized(definition)
+
+    def _calculate_compiled(self, obs_names, todo):
+        rows = np.flatnonzero(todo)
+        results = self.plan.evaluate([self.observables[obs_name] for obs_name in obs_names], self.namespace(rows))
+
+        for obs_name in obs_names:
+            result = results[self.observables[obs_name]]
+            if result is None:  # Not vectorizable after all, will be evaluated event by event
+                continue
+
+            values, valid = result
+            self.values[obs_name][rows] = np.where(valid, values.astype(np.float64), self._default(obs_name))
+            self.evaluated[obs_name] |= todo
+
+    def _calculate(self, obs_name, rows):
+        """ Returns a dict that maps obs_name (and observables calculated together with it) to values for rows """
+
+        obs_definition = self.observables[obs_name]
+
+        # Several observables from one vectorized function
+        if self.observables_outputs.get(obs_name) is not None:
+            objects = _select_objects(self.objects, rows)
+            outputs = obs_definition(objects['l'], objects['a'], objects['j'], objects['met'])
+            return {
+                name: _apply_default(outputs[self.observables_outputs[name]], self._default(name))
+                for name in self.observables
+                if self.observables[name] is obs_definition and self.observables_outputs.get(name) is not None
+            }
+
+        default = self._default(obs_name)
+
+        if self.observables_vectorized.get(obs_name, False):
+            objects = _select_objects(self.objects, rows)
+            return {obs_name: evaluate_vectorized_observable(obs_definition, objects, default)}
+
+        values = []
+        random_state = np.random.get_state()
+
+        for event in rows:
+            if isinstance(obs_definition, six.string_types):
+                try:
+                    values.append(eval(obs_definition, self.per_event_objects(event)))
+                except (SyntaxError, NameError, TypeError, ZeroDivisionError, IndexError):
+                    values.append(default)
+            else:
+                variables = self.per_event_objects(event)
+                if self.event_seeds is not None:
+                    np.random.seed(self.event_seeds[event])
+                try:
+                    values.append(obs_definition(variables['l'], variables['a'], variables['j'], variables['met']))
+                except RuntimeError:
+                    values.append(default)
+
+        np.random.set_state(random_state)
+
+        return {obs_name: np.array(values, dtype=np.float64)}
+
+    def _default(self, obs_name):
+        default = self.observables_defaults[obs_name]
+        return np.nan if default is None else default
+
+
+class _Cut(object):
+    """
+    A cut string, evaluated with the vectorized `ExpressionPlan` or, if that is not possible, event by event in
+    MadMiner's namespace (extended by the observables it uses)
+    """
+
+    def __init__(self, cut, default_pass, observable_names):
+        self.cut = cut
+        self.default_pass = default_pass
+
+        names = _names_in_expression(cut)
+        self.dependencies = [obs_name for obs_name in observable_names if obs_name in names]
+        self.needs_particles = len(names & _PARTICLE_NAMES) > 0
+
+    def __str__(self):
+        return 'cut {}'.format(self.cut)
+
+    def evaluate(self, observable_values, events):
+        observable_values.evaluate(self.dependencies, events)
+
+        values = np.zeros(len(events), dtype=np.bool_)
+
+        if observable_values.plan.is_vectorized(self.cut):
+            rows = np.flatnonzero(events)
+            namespace = observable_values.namespace(
+                rows, {obs_name: observable_values.values[obs_name][rows] for obs_name in self.dependencies}
+            )
+            result = observable_values.plan.evaluate([self.cut], namespace)[self.cut]
+
+            if result is not None:
+                cut_values, valid = result
+                values[rows] = np.where(valid, cut_values.astype(np.bool_), self.default_pass)
+                return values
+
+        for event in np.flatnonzero(events):
+            if self.needs_particles:
+                variables = observable_values.per_event_objects(event)
+            else:
+                variables = math_commands()
+            for obs_name in self.dependencies:
+                variables[obs_name] = observable_values.values[obs_name][event]
+
+            try:
+                values[event] = eval(self.cut, variables)
+            except (SyntaxError, NameError, TypeError, ZeroDivisionError, IndexError):
+                values[event] = self.default_pass
+
+        return values
+
+
+class _RequiredObservable(object):
+    """ Check that a required observable is defined (finite) """
+
+    def __init__(self, obs_name):
+        self.dependencies = [obs_name]
+
+    def __str__(self):
+        return 'required observable {}'.format(self.dependencies[0])
+
+    def evaluate(self, observable_values, events):
+        observable_values.evaluate(self.dependencies, events)
+        return events & np.isfinite(observable_values.values[self.dependencies[0]])
+
+
+def _order_checks(observable_values, observables_required, selections):
+    """
+    Builds the dependency graph between cuts (plus the checks of required observables) and observables, and returns a
+    list of tuples `(check, selections)`, sorted by the cost of the observables each check needs. Checks with the
+    same cost keep their order, with the required-observable checks (which are cheap themselves) first.
+    """
+
+    observable_names = list(observable_values.observables.keys())
+    all_selections = list(selections.keys())
+
+    checks = []
+    for obs_name in observable_names:
+        if observables_required[obs_name]:
+            checks.append((_RequiredObservable(obs_name), all_selections))
+
+    cut_selections = OrderedDict()
+    for selection, (cuts, cuts_default_pass) in six.iteritems(selections):
+        for cut, default_pass in zip(cuts, cuts_default_pass):
+            cut_selections.setdefault((cut, default_pass), []).append(selection)
+    for (cut, default_pass), this_selections in six.iteritems(cut_selections):
+        checks.append((_Cut(cut, default_pass, observable_names), this_selections))
+
+    def sort_key(item):
+        i, (check, _) = item
+        cost = max([observable_values.cost(obs_name) for obs_name in check.dependencies] + [0])
+        return cost, i
+
+    return [check for _, check in sorted(enumerate(checks), key=sort_key)]
+
+
+def _names_in_expression(expression):
+    try:
+        tree = ast.parse(expression, mode='eval')
+    except SyntaxError:
+        return set()
+    return {node.id for node in ast.walk(tree) if isinstance(node, ast.Name)}
+
+
+class _TreeRange(object):
+    """ Wraps a Delphes tree such that array() only reads the entries from entrystart to entrystop """
+
+    def __init__(self, tree, entrystart, entrystop):
+        self.tree = tree
+        self.entrystart = entrystart
+        self.entrystop = entrystop
+
+    def array(self, name):
+        return self.tree.array(name, entrystart=self.entrystart, entrystop=self.entrystop)
+
+
+def _select_objects(objects, rows):
+    """ Restricts the objects from read_delphes_objects() to some events """
+
+    if len(rows) == len(objects['met']):
+        return objects
+    return {key: value[rows] if key == 'met' else value.select(rows) for key, value in six.iteritems(objects)}
+
+
+def _expression_plan(expressions):
+    """ Returns an ExpressionPlan for a list of expressions, which is compiled only once for all Delphes files """
+
+    key = tuple(expressions)
+    if key not in _expression_plans:
+        _expression_plans[key] = ExpressionPlan(expressions)
+    return _expression_plans[key]
+
+
+def parse_delphes_root_file_in_chunks(
+    delphes_sample_file, chunk_size, n_workers=1, delete_delphes_sample_file=False, **kwargs
+):
+    """
+    Like `parse_delphes_root_file()`, but splits the Delphes file into ranges of chunk_size events, which are analysed
+    in parallel by n_workers processes. The observables, weights, and filters of the chunks are merged in order.
+
+    Every chunk seeds numpy's random state with a seed drawn from the current random state and its index, so the
+    results depend on the random state and chunk_size, but not on n_workers. All other keyword arguments are passed
+    to `parse_delphes_root_file()`.
+    """
+
+    n_events = uproot.open(str(delphes_sample_file))['Delphes'].numentries
+    if n_events <= chunk_size:
+        return parse_delphes_root_file(
+            delphes_sample_file, delete_delphes_sample_file=delete_delphes_sample_file, **kwargs
+        )
+
+    tasks = []
+    for start in range(0, n_events, chunk_size):
+        task = dict(kwargs, delphes_sample_file=delphes_sample_file)
+        task.update({'entrystart': start, 'entrystop': min(start + chunk_size, n_events)})
+        tasks.append(task)
+    logger.debug('Analysing %s events in %s chunks', n_events, len(tasks))
+
+    seed = np.random.randint(np.iinfo(np.int32).max)
+    chunk_results = run_in_parallel(parse_delphes_root_file, tasks, n_workers=n_workers, seed=seed)
+
+    if delete_delphes_sample_file:
+        logger.debug('  Deleting %s', delphes_sample_file)
+        os.remove(delphes_sample_file)
+
+    return merge_delphes_results(chunk_results)
+
+
+def merge_delphes_results(chunk_results):
+    """ Concatenates the results of parse_delphes_root_file() for consecutive ranges of events of one file """
+
+    results = OrderedDict()
+
+    for selection in chunk_results[0]:
+        observable_values, weights, filters = None, None, []
+
+        for chunk_result in chunk_results:
+            this_observable_values, this_weights, this_filter = chunk_result[selection]
+            filters.append(this_filter)
+            if this_observable_values is None:
+                continue
+
+            observable_values = _concatenate(observable_values, this_observable_values)
+            if this_weights is not None:
+                weights = _concatenate(weights, this_weights)
+
+        combined_filter = None if any(this_filter is None for this_filter in filters) else np.hstack(filters)
+        results[selection] = observable_values, weights, combined_filter
+
+    return results
+
+
+def _concatenate(previous, new):
+    if previous is None:
+        return new
+    return OrderedDict([(key, np.hstack([values, new[key]])) for key, values in six.iteritems(previous)])
+
+
+def filter_events(observable_values, weights, weight_labels, combined_filter):
+    """ Applies a filter (or None) to observables and weights, returns (observable_values, weights_dict, filter) """
+
+    if combined_filter is not None:
+        n_pass = np.sum(combined_filter)
+
+        if n_pass == 0:
+            logger.warning('  No observations remainining!')
+            return None, None, combined_filter
+
+        logger.info('  %s / %s events pass everything', n_pass, combined_filter.size)
+
+        observable_values = OrderedDict(
+            [(obs_name, values[combined_filter]) for obs_name, values in six.iteritems(observable_values)]
+        )
+        if weights is not None:
+            weights = weights[:, combined_filter]
+
+    weights_dict = None
+    if weights is not None:
+        weights_dict = OrderedDict()
+        for weight_label, this_weights in zip(weight_labels, weights):
+            weights_dict[weight_label] = this_weights
+
+    return observable_values, weights_dict, combined_filter
+
+
+def evaluate_vectorized_observable(fn, objects, default=np.nan):
+    """
+    Evaluates an observable function with signature `fn(leptons, photons, jets, met)` on whole columns:
+    leptons, photons, and jets are `ParticleColumns`, met is a `LorentzArray`. The function returns an ndarray with
+    shape `(n_events,)` and marks events where the observable is not defined with NaN, which are then replaced by
+    `default`.
+    """
+
+    return _apply_default(fn(objects['l'], objects['a'], objects['j'], objects['met']), default)
+
+
+def _apply_default(values, default):
+    values = np.asarray(values, dtype=np.float64)
+    if not np.isnan(default):
+        values = np.where(np.isnan(values), default, values)
+    return values
+
+
+def read_delphes_objects(
+    tree,
+    acceptance_pt_min_e=None,
+    acceptance_pt_min_mu=None,
+    acceptance_pt_min_a=None,
+    acceptance_pt_min_j=None,
+    acceptance_eta_max_e=None,
+    acceptance_eta_max_mu=None,
+    acceptance_eta_max_a=None,
+    acceptance_eta_max_j=None,
+):
+    """ Reads the reconstructed objects from a Delphes tree into ParticleColumns (keys e, mu, l, a, j, met) """
+
+    electrons = _read_particles(
+        tree, 'Electron', acceptance_pt_min_e, acceptance_eta_max_e, mass=0.000511, pdgid_positive_charge=-11
+    )
+    muons = _read_particles(
+        tree, 'Muon', acceptance_pt_min_mu, acceptance_eta_max_mu, mass=0.105, pdgid_positive_charge=-13
+    )
+    photons = _read_particles(tree, 'Photon', acceptance_pt_min_a, acceptance_eta_max_a, pdgid=22)
+    jets = _read_particles(tree, 'Jet', acceptance_pt_min_j, acceptance_eta_max_j, pdgid=9)
+    leptons = _merge_particles(muons, electrons)
+
+    met_pt = _pad(tree.array('MissingET.MET'), 1)[0][:, 0]
+    met_phi = _pad(tree.array('MissingET.Phi'), 1)[0][:, 0]
+    met = LorentzArray.from_ptetaphim(met_pt, 0., met_phi, 0., pdgid=np.zeros(met_pt.shape, dtype=np.int64))
+
+    return {'e': electrons, 'mu': muons, 'l': leptons, 'a': photons, 'j': jets, 'met': met}
+
+
+class _PerEventObjects(object):
+    """ Builds the eval() namespace of MadMiner (lists of MadMinerParticle) for single events, on demand """
+
+    def __init__(self, objects):
+        self.objects = objects
+
+    def __call__(self, event):
+        particles = {key: self.objects[key].particles(event) for key in ['e', 'mu', 'l', 'a', 'j']}
+
+        met = MadMinerParticle()
+        met.setpxpypze(
+            self.objects['met'].x[event], self.objects['met'].y[event], 0., self.objects['met'].t[event]
+        )
+        met.set_pdgid(0)
+
+        visible = MadMinerParticle()
+        for p in particles['e'] + particles['j'] + particles['mu'] + particles['a']:
+            visible += p
+        all_momentum = visible + met
+
+        variables = math_commands()
+        variables.update(particles)
+        variables.update(
+            {
+                'met': met,
+                'visible': visible,
+                'all': all_momentum,
+                'boost_to_com': lambda momentum: momentum.boost(all_momentum.boost_vector()),
+            }
+        )
+        return variables
+
+
+def _charge_from_pdgid(pdgid):
+    return np.where(np.isin(pdgid, [11, 13, 15, -24]), -1., np.where(np.isin(pdgid, [-11, -13, -15, 24]), 1., 0.))
+
+
+def _pad(jagged, n_max, fill=np.nan):
+    """ Turns a jagged array (one entry per event) into an ndarray with shape (n_events, n_max) """
+
+    counts = np.asarray(jagged.counts)
+    starts = np.asarray(jagged.starts)
+    content = np.asarray(jagged.content, dtype=np.float64)
+
+    padded = np.full((len(counts), n_max), fill)
+    for i in range(n_max):
+        has_particle = counts > i
+        padded[has_particle, i] = content[starts[has_particle] + i]
+
+    return padded, counts
+
+
+def _read_particles(tree, branch, pt_min, eta_max, mass=None, pdgid=None, pdgid_positive_charge=None):
+    pts = tree.array(branch + '.PT')
+    n_max = max(1, int(np.max(np.asarray(pts.counts), initial=0)))
+
+    pt, counts = _pad(pts, n_max)
+    eta, _ = _pad(tree.array(branch + '.Eta'), n_max)
+    phi, _ = _pad(tree.array(branch + '.Phi'), n_max)
+
+    if pdgid_positive_charge is not None:
+        charge, _ = _pad(tree.array(branch + '.Charge'), n_max, fill=0.)
+        pdgids = np.where(charge >= 0., pdgid_positive_charge, -pdgid_positive_charge)
+    else:
+        pdgids = pdgid * np.ones((len(counts), n_max))
+
+    if mass is None and branch == 'Jet':
+        masses, _ = _pad(tree.array('Jet.Mass'), n_max)
+        momenta = LorentzArray.from_ptetaphim(pt, eta, phi, masses)
+    elif mass is None:
+        energies, _ = _pad(tree.array(branch + '.E'), n_max)
+        momenta = LorentzArray.from_ptetaphie(pt, eta, phi, energies)
+    else:
+        momenta = LorentzArray.from_ptetaphim(pt, eta, phi, mass * np.ones_like(pt))
+
+    tau_tag, b_tag = None, None
+    if branch == 'Jet':
+        tau_tag = _read_tag(tree, 'Jet.TauTag', n_max)
+        b_tag = _read_tag(tree, 'Jet.BTag', n_max)
+
+    # Acceptance cuts
+    accepted = np.arange(n_max)[np.newaxis, :] < counts[:, np.newaxis]
+    if pt_min is not None:
+        accepted &= pt >= pt_min
+    if eta_max is not None:
+        accepted &= np.abs(eta) <= eta_max
+
+    return _compact(momenta, pdgids.astype(np.int64), accepted, pt, tau_tag, b_tag)
+
+
+def _read_tag(tree, name, n_max):
+    try:
+        tags, _ = _pad(tree.array(name), n_max, fill=0.)
+    except KeyError:
+        logger.warning('Did not find %s information in Delphes ROOT file.', name)
+        return None
+    return tags >= 1
+
+
+def _compact(momenta, pdgids, accepted, pt, tau_tag=None, b_tag=None):
+    """ Removes rejected particles and sorts the remaining ones by descending pT """
+
+    sort_key = np.where(accepted, -np.nan_to_num(pt), np.inf)
+    order = np.argsort(sort_key, axis=1, kind='mergesort')
+
+    def reorder(values):
+        return None if values is None else np.take_along_axis(values, order, axis=1)
+
+    accepted = reorder(accepted)
+    mask = np.where(accepted, 1., np.nan)
+
+    return ParticleColumns(
+        reorder(momenta.x) * mask,
+        reorder(momenta.y) * mask,
+        reorder(momenta.z) * mask,
+        reorder(momenta.t) * mask,
+        counts=np.sum(accepted, axis=1),
+        pdgid=np.where(accepted, reorder(pdgids), 0),
+        tau_tag=None if tau_tag is None else reorder(tau_tag) & accepted,
+        b_tag=None if b_tag is None else reorder(b_tag) & accepted,
+    )
+
+
+def _merge_particles(first, second):
+    """ Combines two ParticleColumns (e.g. muons and electrons into leptons), sorted by descending pT """
+
+    x = np.hstack((first.x, second.x))
+    y = np.hstack((first.y, second.y))
+    z = np.hstack((first.z, second.z))
+    t = np.hstack((first.t, second.t))
+    pdgids = np.hstack((first.pdgid, second.pdgid))
+    accepted = np.isfinite(x)
+    pt = (x ** 2 + y ** 2) ** 0.5
+
+    return _compact(LorentzArray(x, y, z, t), pdgids, accepted, pt)
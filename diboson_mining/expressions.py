@@ -0,0 +1,469 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+import ast
+import logging
+import operator
+import six
+import numpy as np
+
+from diboson_mining.vectors import LorentzArray
+
+logger = logging.getLogger(__name__)
+
+# Kinematic properties of MadMinerParticle / LorentzVector that LorentzArray provides with the same definition
+_PARTICLE_PROPERTIES = {
+    'x', 'y', 'z', 't', 'px', 'py', 'pz', 'e', 'p', 'pt', 'perp', 'perp2', 'et', 'm', 'm2', 'mass', 'mass2', 'eta',
+    'pseudorapidity', 'pdgid', 'charge',
+}
+_PARTICLE_METHODS = {'phi'}
+
+if sys.version_info >= (3, 8):
+    _CONSTANT_NODES = (ast.Constant,)
+else:
+    _CONSTANT_NODES = tuple(getattr(ast, name) for name in ['Num', 'NameConstant'] if hasattr(ast, name))
+
+_BINARY_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+_COMPARISON_OPERATORS = {
+    ast.Eq: operator.eq,
+    ast.NotEq: operator.ne,
+    ast.Lt: operator.lt,
+    ast.LtE: operator.le,
+    ast.Gt: operator.gt,
+    ast.GtE: operator.ge,
+}
+
+
+class NotVectorizable(Exception):
+    """ Raised when an expression (or one of its parts) cannot be evaluated on columns """
+
+
+class ExpressionPlan(object):
+    """
+    Compiles a set of expression strings (observable definitions or cuts in MadMiner's syntax, e.g. `'(l[0] +
+    a[0]).m'` or `'pt_a1 >= 300.'`) into one vectorized NumPy evaluation plan.
+
+    Every expression is parsed once into a sequence of steps. Identical subexpressions, for instance `l[0] + a[0]`
+    in `'(l[0] + a[0]).m'` and `'(l[0] + a[0]).pt'`, map onto the same step and are calculated only once per call of
+    `evaluate()`, no matter how many expressions use them.
+
+    The steps work on whole columns: particle collections are `ParticleColumns`, single particles and `met`,
+    `visible`, and `all` are `LorentzArray`s, observables are ndarrays. Alongside each value, a mask tracks the events
+    in which the per-event `eval()` would not have raised an exception (missing particles, division by zero, ...),
+    where MadMiner uses the default value instead. Expressions that use anything that has no vectorized equivalent
+    are marked as not vectorizable and have to be evaluated event by event.
+
+    Parameters
+    ----------
+    expressions : iterable of str
+        The expressions.
+
+    """
+
+    def __init__(self, expressions):
+        self.steps = []
+        self.outputs = {}
+        self._step_indices = {}
+
+        for expression in expressions:
+            if expression in self.outputs:
+                continue
+            try:
+                self.outputs[expression] = self._compile(ast.parse(expression.strip(), mode='eval').body)
+            except (SyntaxError, NotVectorizable):
+                logger.debug('Expression %s cannot be vectorized', expression)
+                self.outputs[expression] = None
+
+        logger.debug('Compiled %s expressions into %s steps', len(self.outputs), len(self.steps))
+
+    def is_vectorized(self, expression):
+        return self.outputs.get(expression) is not None
+
+    def evaluate(self, expressions, namespace):
+        """
+        Evaluates expressions on columns.
+
+        Parameters
+        ----------
+        expressions : list of str
+            Expressions, which have to be part of the plan.
+
+        namespace : dict-like
+            Maps the names in the expressions to columns with shape `(n_events,)` (or `ParticleColumns`,
+            `LorentzArray`, scalars, functions).
+
+        Returns
+        -------
+        results : dict
+            Maps each expression to a tuple `(values, valid)`, where values is an ndarray with shape `(n_events,)` and
+            valid a boolean mask of the events in which the expression is defined. Expressions that cannot be
+            vectorized map to None.
+
+        """
+
+        results = {}
+        memo = {}
+
+        with np.errstate(all='ignore'):
+            for expression in expressions:
+                step = self.outputs[expression]
+                if step is None:
+                    results[expression] = None
+                    continue
+
+                try:
+                    values, valid = self._evaluate_step(step, namespace, memo)
+                    results[expression] = _as_column(values, valid, namespace.n_events)
+                except NotVectorizable as e:
+                    logger.debug('Expression %s cannot be vectorized: %s', expression, e)
+                    self.outputs[expression] = None
+                    results[expression] = None
+
+        return results
+
+    def _add_step(self, *step):
+        """ Adds a step unless an identical one (same operation on the same inputs) exists, returns its index """
+
+        if step not in self._step_indices:
+            self._step_indices[step] = len(self.steps)
+            self.steps.append(step)
+        return self._step_indices[step]
+
+    def _compile(self, node):
+        if isinstance(node, ast.Name):
+            if node.id in ('True', 'False', 'None'):  # Python 2
+                value = {'True': True, 'False': False, 'None': None}[node.id]
+                return self._add_step('constant', type(value).__name__, value)
+            return self._add_step('name', node.id)
+
+        if _is_constant(node):
+            value = _constant_value(node)
+            if not isinstance(value, (bool, int, float) + six.integer_types):
+                raise NotVectorizable('Constant {!r}'.format(value))
+            return self._add_step('constant', type(value).__name__, value)
+
+        if isinstance(node, ast.Attribute):
+            return self._add_step('attribute', self._compile(node.value), node.attr)
+
+        if isinstance(node, ast.Subscript):
+            index = node.slice.value if sys.version_info < (3, 9) else node.slice
+            if not _is_constant(index) or not isinstance(_constant_value(index), six.integer_types):
+                raise NotVectorizable('Only constant integer indices are supported')
+            if _constant_value(index) < 0:
+                raise NotVectorizable('Negative indices are not supported')
+            return self._add_step('subscript', self._compile(node.value), _constant_value(index))
+
+        if isinstance(node, ast.Call):
+            if node.keywords or getattr(node, 'starargs', None) or getattr(node, 'kwargs', None):
+                raise NotVectorizable('Keyword arguments are not supported')
+            return self._add_step(
+                'call', self._compile(node.func), tuple(self._compile(arg) for arg in node.args)
+            )
+
+        if isinstance(node, ast.BinOp):
+            if type(node.op) not in _BINARY_OPERATORS:
+                raise NotVectorizable('Operator {}'.format(type(node.op).__name__))
+            return self._add_step('binary', type(node.op), self._compile(node.left), self._compile(node.right))
+
+        if isinstance(node, ast.UnaryOp):
+            if not isinstance(node.op, (ast.USub, ast.UAdd, ast.Not)):
+                raise NotVectorizable('Operator {}'.format(type(node.op).__name__))
+            return self._add_step('unary', type(node.op), self._compile(node.operand))
+
+        if isinstance(node, ast.Compare):
+            if any(type(op) not in _COMPARISON_OPERATORS for op in node.ops):
+                raise NotVectorizable('Comparison operator')
+            return self._add_step(
+                'compare',
+                tuple(type(op) for op in node.ops),
+                tuple(self._compile(operand) for operand in [node.left] + node.comparators),
+            )
+
+        if isinstance(node, ast.BoolOp):
+            return self._add_step('boolean', type(node.op), tuple(self._compile(value) for value in node.values))
+
+        if isinstance(node, ast.IfExp):
+            return self._add_step(
+                'if', self._compile(node.test), self._compile(node.body), self._compile(node.orelse)
+            )
+
+        raise NotVectorizable('Syntax {}'.format(type(node).__name__))
+
+    def _evaluate_step(self, index, namespace, memo):
+        if index in memo:
+            result = memo[index]
+            if isinstance(result, NotVectorizable):
+                raise result
+            return result
+
+        try:
+            result = self._run_step(self.steps[index], namespace, memo)
+        except NotVectorizable as e:
+            memo[index] = e
+            raise
+
+        memo[index] = result
+        return result
+
+    def _run_step(self, step, namespace, memo):
+        kind = step[0]
+
+        def run(index):
+            return self._evaluate_step(index, namespace, memo)
+
+        if kind == 'constant':
+            return step[2], None
+
+        if kind == 'name':
+            try:
+                return namespace[step[1]], None
+            except KeyError:
+                raise NotVectorizable('Name {}'.format(step[1]))
+
+        if kind == 'attribute':
+            value, valid = run(step[1])
+            if not isinstance(value, LorentzArray):
+                raise NotVectorizable('Attribute {} of {}'.format(step[2], type(value).__name__))
+            if step[2] in _PARTICLE_METHODS:
+                return _Function(getattr(value, step[2]), n_args=0), _combine(valid, value.valid)
+            if step[2] not in _PARTICLE_PROPERTIES or getattr(value, step[2]) is None:
+                raise NotVectorizable('Attribute {}'.format(step[2]))
+            return getattr(value, step[2]), _combine(valid, value.valid)
+
+        if kind == 'subscript':
+            value, valid = run(step[1])
+            if not hasattr(value, 'select') or not hasattr(value, 'counts'):
+                raise NotVectorizable('Indexing {}'.format(type(value).__name__))
+            particle = value[step[2]]
+            return particle, _combine(valid, particle.valid)
+
+        if kind == 'call':
+            function, valid = run(step[1])
+            if not isinstance(function, _Function):
+                raise NotVectorizable('Calling {}'.format(type(function).__name__))
+            args = [run(arg) for arg in step[2]]
+            for _, arg_valid in args:
+                valid = _combine(valid, arg_valid)
+            values, call_valid = function([arg for arg, _ in args])
+            return values, _combine(valid, call_valid)
+
+        if kind == 'binary':
+            (left, left_valid), (right, right_valid) = run(step[2]), run(step[3])
+            valid = _combine(left_valid, right_valid)
+
+            if isinstance(left, LorentzArray) and isinstance(right, LorentzArray) and step[1] in (ast.Add, ast.Sub):
+                result = left + right if step[1] is ast.Add else left - right
+                return result, valid
+
+            left, right = _numeric(left), _numeric(right)
+            if step[1] in (ast.Div, ast.FloorDiv, ast.Mod):
+                valid = _combine(valid, np.asarray(right) != 0)
+            elif step[1] is ast.Pow:
+                valid = _combine(valid, ~((np.asarray(left) == 0) & (np.asarray(right) < 0)))
+            return _BINARY_OPERATORS[step[1]](left, right), valid
+
+        if kind == 'unary':
+            operand, valid = run(step[2])
+            if step[1] is ast.Not:
+                return np.logical_not(_numeric(operand)), valid
+            operand = _numeric(operand)
+            return (-operand if step[1] is ast.USub else +operand), valid
+
+        if kind == 'compare':
+            operands = [run(operand) for operand in step[2]]
+            result, valid = True, None
+            for op, (left, left_valid), (right, right_valid) in zip(step[1], operands[:-1], operands[1:]):
+                result = result & _COMPARISON_OPERATORS[op](_numeric(left), _numeric(right))
+                valid = _combine(valid, _combine(left_valid, right_valid))
+            return result, valid
+
+        if kind == 'boolean':
+            # Python's and / or return one of the operands, later operands are only evaluated if needed
+            operands = [run(operand) for operand in step[2]]
+            result, valid = operands[-1]
+            result = _numeric(result)
+            for value, value_valid in reversed(operands[:-1]):
+                value = _numeric(value)
+                if step[1] is ast.And:
+                    result, valid = np.where(value, result, value), _combine(value_valid, _where(value, valid, None))
+                else:
+                    result, valid = np.where(value, value, result), _combine(value_valid, _where(value, None, valid))
+            return result, valid
+
+        if kind == 'if':
+            test, test_valid = run(step[1])
+            (body, body_valid), (orelse, orelse_valid) = run(step[2]), run(step[3])
+            test = _numeric(test)
+            return (
+                np.where(test, _numeric(body), _numeric(orelse)),
+                _combine(test_valid, _where(test, body_valid, orelse_valid)),
+            )
+
+        raise NotVectorizable('Step {}'.format(kind))
+
+
+class ColumnNamespace(object):
+    """
+    Names available in the expressions, calculated on demand from the columns of a set of events: the particle
+    collections e, mu, l, a, j (`ParticleColumns`), met, visible, and all (`LorentzArray`), MadMiner's math commands,
+    some builtins, and optionally observables (ndarrays).
+    """
+
+    def __init__(self, objects, observables=None):
+        self.objects = objects
+        self.observables = {} if observables is None else observables
+        self.n_events = len(objects['met'])
+        self._cache = {}
+
+    def __getitem__(self, name):
+        if name in self.observables:
+            return self.observables[name]
+        if name in self.objects:
+            return self.objects[name]
+        if name in self._cache:
+            return self._cache[name]
+
+        if name == 'visible':
+            value = self.objects['e'].total()
+            for key in ['j', 'mu', 'a']:
+                value = value + self.objects[key].total()
+        elif name == 'all':
+            value = self['visible'] + self.objects['met']
+        elif name in _FUNCTIONS:
+            value = _FUNCTIONS[name]
+        elif name == 'pi':
+            value = np.pi
+        else:
+            raise KeyError(name)
+
+        self._cache[name] = value
+        return value
+
+
+class _Function(object):
+    """ Vectorized function, returns (values, valid) """
+
+    def __init__(self, fn, n_args=1, domain=None):
+        self.fn = fn
+        self.n_args = n_args
+        self.domain = domain
+
+    def __call__(self, args):
+        if self.n_args is not None and len(args) != self.n_args:
+            raise NotVectorizable('Wrong number of arguments')
+        if self.n_args == 0:
+            return self.fn(), None
+
+        args = [_numeric(arg) for arg in args]
+        valid = None if self.domain is None else self.domain(*args)
+        return self.fn(*args), valid
+
+
+def _python_min(*args):
+    result = args[0]
+    for arg in args[1:]:
+        result = np.where(arg < result, arg, result)
+    return result
+
+
+def _python_max(*args):
+    result = args[0]
+    for arg in args[1:]:
+        result = np.where(arg > result, arg, result)
+    return result
+
+
+class _Length(_Function):
+    def __init__(self):
+        super(_Length, self).__init__(None)
+
+    def __call__(self, args):
+        if len(args) != 1 or not hasattr(args[0], 'counts'):
+            raise NotVectorizable('len() is only supported for particle collections')
+        return args[0].counts, None
+
+
+# Vectorized versions of MadMiner's math commands and of the builtins that make sense for numbers
+_FUNCTIONS = {
+    'acos': _Function(np.arccos, domain=lambda x: np.abs(x) <= 1.),
+    'asin': _Function(np.arcsin, domain=lambda x: np.abs(x) <= 1.),
+    'atan': _Function(np.arctan),
+    'atan2': _Function(np.arctan2, n_args=2),
+    'ceil': _Function(np.ceil),
+    'cos': _Function(np.cos),
+    'cosh': _Function(np.cosh),
+    'exp': _Function(np.exp),
+    'floor': _Function(np.floor),
+    'log': _Function(np.log, domain=lambda x: x > 0.),
+    'pow': _Function(np.power, n_args=2, domain=lambda x, y: ~((x == 0) & (y < 0)) & ((x >= 0) | (y == np.floor(y)))),
+    'sin': _Function(np.sin),
+    'sinh': _Function(np.sinh),
+    'sqrt': _Function(np.sqrt, domain=lambda x: x >= 0.),
+    'tan': _Function(np.tan),
+    'tanh': _Function(np.tanh),
+    'abs': _Function(np.abs),
+    'int': _Function(np.trunc, domain=np.isfinite),
+    'float': _Function(lambda x: np.asarray(x, dtype=np.float64)),
+    'bool': _Function(lambda x: np.asarray(x, dtype=np.bool_)),
+    'min': _Function(_python_min, n_args=None),
+    'max': _Function(_python_max, n_args=None),
+    'len': _Length(),
+}
+
+
+def _is_constant(node):
+    return isinstance(node, _CONSTANT_NODES)
+
+
+def _constant_value(node):
+    return node.value if hasattr(node, 'value') else node.n
+
+
+def _numeric(value):
+    """ Makes sure that a value can be used in arithmetic (numpy refuses e.g. subtracting boolean arrays) """
+
+    if isinstance(value, (LorentzArray, _Function)) or hasattr(value, 'counts'):
+        raise NotVectorizable('{} used as a number'.format(type(value).__name__))
+    if value is None:
+        raise NotVectorizable('None used as a number')
+    value = np.asarray(value)
+    if value.dtype == np.bool_:
+        value = value.astype(np.int64)
+    return value
+
+
+def _combine(valid, other):
+    if valid is None:
+        return other
+    if other is None:
+        return valid
+    return valid & other
+
+
+def _where(condition, valid_if_true, valid_if_false):
+    if valid_if_true is None and valid_if_false is None:
+        return None
+    return np.where(
+        condition,
+        True if valid_if_true is None else valid_if_true,
+        True if valid_if_false is None else valid_if_false,
+    )
+
+
+def _as_column(values, valid, n_events):
+    if isinstance(values, (LorentzArray, _Function)) or hasattr(values, 'counts') or values is None:
+        raise NotVectorizable('Result is a {}'.format(type(values).__name__))
+
+    values = np.broadcast_to(np.asarray(values), (n_events,))
+    if valid is None:
+        valid = np.ones(n_events, dtype=np.bool_)
+    valid = np.broadcast_to(np.asarray(valid, dtype=np.bool_), (n_events,))
+    return values, valid
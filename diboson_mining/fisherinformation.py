@@ -0,0 +1,109 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import numpy as np
+
+from madminer import fisherinformation as madminer_fisherinformation
+from madminer.fisherinformation import FisherInformation as MadMinerFisherInformation
+
+from diboson_mining.cut_bits import selection_mask, selected_events
+from diboson_mining.morphing_cache import cached_observables_and_weights
+
+logger = logging.getLogger(__name__)
+
+
+class FisherInformation(MadMinerFisherInformation):
+    """
+    FisherInformation that can be restricted to the events passing a selection on the cut bits stored in the MadMiner
+    file (see `ColumnarDelphesProcessor.add_cut_bit()`). With `selection`, all methods only see the selected events,
+    for instance the tight or anti-tight subset of a loose sample, without separate analysis runs or sample files.
+    With a `MorphingWeightCache`, the event weights for distributions (`extract_raw_data()` and
+    `extract_observables_and_weights()`) are calculated from the cached morphing component weights. Everything else
+    works exactly like in MadMiner's `FisherInformation`.
+
+    Parameters
+    ----------
+    filename : str
+        Path to MadMiner file (for instance the output of `ColumnarDelphesProcessor.save()`).
+
+    include_nuisance_parameters : bool, optional
+        If True, nuisance parameters are taken into account. Default value: True.
+
+    debug : bool, optional
+        If True, additional detailed debugging output is printed. Default value: False.
+
+    selection : str or None, optional
+        If not None, only the events passing this selection are used. A selection stored in the file, a cut bit, or
+        an expression of them, see `diboson_mining.cut_bits.selection_mask()`. Default value: None.
+
+    morphing_cache : MorphingWeightCache or None, optional
+        If not None, the event weights at parameter points in `extract_raw_data()` and
+        `extract_observables_and_weights()` are calculated from the morphing component weights in this cache,
+        without reading the benchmark weights. Default value: None.
+
+    """
+
+    def __init__(self, filename, include_nuisance_parameters=True, debug=False, selection=None, morphing_cache=None):
+        super(FisherInformation, self).__init__(
+            filename, include_nuisance_parameters=include_nuisance_parameters, debug=debug
+        )
+
+        self.morphing_cache = morphing_cache
+        self.selection = selection
+        self.selection_mask = None
+        if selection is not None:
+            self.selection_mask = selection_mask(filename, selection)
+            logger.info(
+                'Using the %s / %s events passing selection %s', np.sum(self.selection_mask), self.n_samples, selection
+            )
+
+    def calculate_fisher_information_full_truth(self, *args, **kwargs):
+        with self._selected_events():
+            return super(FisherInformation, self).calculate_fisher_information_full_truth(*args, **kwargs)
+
+    def calculate_fisher_information_full_detector(self, *args, **kwargs):
+        with self._selected_events():
+            return super(FisherInformation, self).calculate_fisher_information_full_detector(*args, **kwargs)
+
+    def calculate_fisher_information_rate(self, *args, **kwargs):
+        with self._selected_events():
+            return super(FisherInformation, self).calculate_fisher_information_rate(*args, **kwargs)
+
+    def calculate_fisher_information_hist1d(self, *args, **kwargs):
+        with self._selected_events():
+            return super(FisherInformation, self).calculate_fisher_information_hist1d(*args, **kwargs)
+
+    def calculate_fisher_information_hist2d(self, *args, **kwargs):
+        with self._selected_events():
+            return super(FisherInformation, self).calculate_fisher_information_hist2d(*args, **kwargs)
+
+    def histogram_of_fisher_information(self, *args, **kwargs):
+        with self._selected_events():
+            return super(FisherInformation, self).histogram_of_fisher_information(*args, **kwargs)
+
+    def extract_raw_data(self, theta=None):
+        if theta is not None and self.morphing_cache is not None:
+            x, weights = self._cached_observables_and_weights(np.asarray(theta, dtype=np.float64).reshape((1, -1)))
+            return x, weights[0]
+
+        with self._selected_events():
+            return super(FisherInformation, self).extract_raw_data(theta)
+
+    def extract_observables_and_weights(self, thetas):
+        if self.morphing_cache is not None:
+            return self._cached_observables_and_weights(np.asarray(thetas, dtype=np.float64))
+
+        with self._selected_events():
+            return super(FisherInformation, self).extract_observables_and_weights(thetas)
+
+    def _cached_observables_and_weights(self, thetas):
+        """ Observations and weights with shape (n_thetas, n_events) from the morphing cache """
+
+        return cached_observables_and_weights(
+            self.morphing_cache, self.madminer_filename, self.morpher, thetas, mask=self.selection_mask
+        )
+
+    def _selected_events(self):
+        """ Context in which MadMiner's FisherInformation code only sees the selected events """
+
+        return selected_events(madminer_fisherinformation, self.madminer_filename, self.selection_mask)
@@ -0,0 +1,377 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import io
+import re
+import gzip
+import logging
+from collections import OrderedDict
+import numpy as np
+
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+logger = logging.getLogger(__name__)
+
+# Everything after '#' in a line
+_COMMENT = re.compile(b'#[^\n]*')
+
+
+def open_lhe_file(filename):
+    """
+    Opens an LHE file (plain or gzipped, decided by the extension) for streaming. Everything after a '#' in a line is
+    removed on the fly, since LHE comments can contain characters that break the XML parser.
+
+    Returns a binary file-like object that should be closed after use (it supports the with statement).
+    """
+
+    if str(filename).endswith('.gz'):
+        raw = gzip.open(str(filename), 'rb')
+    else:
+        raw = io.open(str(filename), 'rb')
+    return _CommentStrippingReader(raw)
+
+
+def read_lhe_header(filename):
+    """
+    Reads only the header of an LHE file (the run card, the `initrwgt` weight groups, ...), without touching the
+    events.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the LHE file (.lhe or .lhe.gz).
+
+    Returns
+    -------
+    header : Element
+        The `header` XML element.
+
+    """
+
+    for element in iterparse_lhe_file(filename, tags=('header',)):
+        return element
+
+    raise RuntimeError('No header found in LHE file {}'.format(filename))
+
+
+def iterate_lhe_events(filename, batch_size=1000):
+    """
+    Streams the events of an LHE file in batches, so that the memory use only depends on batch_size and not on the
+    number of events.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the LHE file (.lhe or .lhe.gz), which is decompressed on the fly.
+
+    batch_size : int, optional
+        Number of events per batch. Default value: 1000.
+
+    Yields
+    ------
+    events : list of Element
+        Up to batch_size `event` XML elements. `event.text` contains the tag line and the particles,
+        `event.find('rwgt')` the reweighting weights.
+
+    """
+
+    batch = []
+    n_events = 0
+
+    for event in iterparse_lhe_file(filename, tags=('event',)):
+        batch.append(event)
+        n_events += 1
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+        if n_events % 10000 == 0:
+            logger.debug('%s events parsed', n_events)
+
+    if batch:
+        yield batch
+
+
+def read_lhe_weights(filename, sampling_benchmark, memmap_filename=None, batch_size=1000):
+    """
+    Extracts the event weights (the nominal weight of each event plus all weights in the `rwgt` blocks) from an LHE
+    file into one array with shape `(n_events, n_weights)`.
+
+    The weight ids are mapped to columns once from the `initrwgt` block in the header. The events are streamed, and
+    the weights of each batch of events are converted with a single numpy call and written into a preallocated
+    array, which can be memory-mapped to disk. Like MadMiner's `parse_lhe_file()`, the nominal weight is stored
+    under sampling_benchmark (and replaced by a reweighting weight with the same id, if there is one), and weights
+    are divided by the number of events if the run card sets `event_norm = average`. If an event lacks some of the
+    weights listed in the header, a RuntimeError is raised.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the LHE file (.lhe or .lhe.gz).
+
+    sampling_benchmark : str
+        Name of the benchmark used for sampling, i.e. the label of the nominal weights.
+
+    memmap_filename : str or None, optional
+        If not None, the weights are stored in a memory-mapped file (raw float64 data in C order, without header)
+        at this path instead of in memory. Default value: None.
+
+    batch_size : int, optional
+        Number of events converted at once. Default value: 1000.
+
+    Returns
+    -------
+    weight_names : list of str
+        Labels of the weights.
+
+    weights : ndarray or memmap
+        Weights with shape `(n_events, n_weights)`.
+
+    """
+
+    logger.debug('Extracting weights from LHE file %s', filename)
+
+    weight_ids, weight_names, columns, n_events_expected, normalization = None, None, None, None, 1.
+    weights = None
+    n_events = 0
+
+    batch_texts = []
+    batch_rows = []
+
+    for element in iterparse_lhe_file(filename, tags=('header', 'event')):
+        if element.tag == 'header':
+            n_events_expected, normalization = _parse_run_card(element)
+            initrwgt = element.find('initrwgt')
+            if initrwgt is not None:
+                weight_ids = [weight.get('id') for weight in initrwgt.iter('weight')]
+            continue
+
+        wgts = element.find('rwgt')
+        wgts = [] if wgts is None else list(wgts)
+        ids = tuple(wgt.get('id') for wgt in wgts)
+
+        # Map weight ids to columns (once)
+        if weight_names is None:
+            if weight_ids is None:
+                weight_ids = list(ids)
+            weight_names, columns = _weight_columns(sampling_benchmark, weight_ids)
+            reference_ids = tuple(weight_ids)
+            reference_columns = np.array([columns[weight_id] for weight_id in weight_ids], dtype=np.int64)
+
+            capacity = max(int(n_events_expected or 0), batch_size)
+            weights = _allocate(memmap_filename, (capacity, len(weight_names)))
+
+        if n_events >= weights.shape[0]:
+            weights = _grow(weights, memmap_filename, 2 * weights.shape[0])
+
+        # Nominal weight from the tag line
+        weights[n_events, 0] = float(element.text.split(None, 3)[2])
+
+        # Reweighting weights: bulk conversion for each batch (if the ids come in the usual order)
+        if ids == reference_ids:
+            batch_texts.append([wgt.text for wgt in wgts])
+            batch_rows.append(n_events)
+        else:
+            for wgt_id, wgt in zip(ids, wgts):
+                if wgt_id not in columns:
+                    raise RuntimeError('Weight id {} not found in the LHE header'.format(wgt_id))
+                weights[n_events, columns[wgt_id]] = float(wgt.text)
+
+        n_events += 1
+
+        if len(batch_rows) >= batch_size:
+            _fill_batch(weights, batch_rows, reference_columns, batch_texts)
+            batch_texts, batch_rows = [], []
+
+    if weights is None:
+        raise RuntimeError('No events found in LHE file {}'.format(filename))
+
+    if batch_rows:
+        _fill_batch(weights, batch_rows, reference_columns, batch_texts)
+
+    weights = _truncate(weights, memmap_filename, n_events)
+
+    # Events without some of the weights in the header would otherwise silently get NaNs
+    incomplete = _incomplete_rows(weights, batch_size)
+    if len(incomplete) > 0:
+        missing = [name for name, is_missing in zip(weight_names, np.isnan(weights[incomplete[0]])) if is_missing]
+        raise RuntimeError(
+            '{} events in LHE file {} lack some of the weights in the header, for instance event {} lacks {}'.format(
+                len(incomplete), filename, incomplete[0], missing
+            )
+        )
+
+    if normalization != 1.:
+        weights *= normalization
+
+    n_negative = np.sum(np.any(weights < 0., axis=1))
+    if n_negative > 0:
+        logger.warning('  %s events contain negative weights', n_negative)
+    logger.debug('Extracted %s weights for %s events', len(weight_names), n_events)
+
+    return weight_names, weights
+
+
+def lhe_weights_as_dict(weight_names, weights):
+    """ Turns the output of read_lhe_weights() into an OrderedDict {weight name: ndarray with shape (n_events,)} """
+
+    return OrderedDict([(name, weights[:, i]) for i, name in enumerate(weight_names)])
+
+
+def iterparse_lhe_file(filename, tags=('header', 'event')):
+    """
+    Incrementally parses an LHE file and yields the complete XML elements with one of the given tags (in the order
+    of the file). Elements are detached from the document after they were yielded, so that they can be garbage
+    collected once the caller discards them.
+    """
+
+    with open_lhe_file(filename) as file:
+        root = None
+
+        for action, element in ET.iterparse(file, events=('start', 'end')):
+            if root is None:
+                root = element
+                continue
+            if action != 'end':
+                continue
+
+            if element.tag in tags:
+                yield element
+
+            # Only drop top-level elements: their children are still needed until the parent is complete
+            if element.tag in ('header', 'init', 'event'):
+                root.clear()
+
+
+def _parse_run_card(header):
+    """ Returns the number of events and the weight normalization factor from the run card in the LHE header """
+
+    n_events, norm_is_average = None, None
+
+    run_card = header.find('MGRunCard')
+    if run_card is not None and run_card.text is not None:
+        for line in run_card.text.splitlines():
+            line = line.split('!')[0]
+            if line.count('=') != 1:
+                continue
+            value, key = [item.strip() for item in line.split('=')]
+
+            if key == 'nevents':
+                n_events = float(value)
+            elif key == 'event_norm':
+                norm_is_average = value == 'average'
+
+    if norm_is_average is None:
+        logger.warning(
+            'Cannot read weight normalization mode (entry event_norm) from LHE file header, assuming that events are '
+            'properly normalized. Please check this!'
+        )
+    if norm_is_average:
+        if n_events is None:
+            raise RuntimeError('LHE weights have to be normalized, but the number of events is not in the run card')
+        return n_events, 1. / n_events
+
+    return n_events, 1.
+
+
+def _weight_columns(sampling_benchmark, weight_ids):
+    """ Column 0 is the nominal weight, followed by the reweighting ids (a repeated id shares the column) """
+
+    weight_names = [sampling_benchmark]
+    columns = {sampling_benchmark: 0}
+    for weight_id in weight_ids:
+        if weight_id not in columns:
+            columns[weight_id] = len(weight_names)
+            weight_names.append(weight_id)
+    return weight_names, columns
+
+
+def _fill_batch(weights, rows, columns, texts):
+    values = np.array(texts, dtype=np.float64)
+    weights[np.array(rows)[:, np.newaxis], columns[np.newaxis, :]] = values
+
+
+def _allocate(memmap_filename, shape):
+    """ Weight array filled with NaN, so that weights missing in an event can be detected """
+
+    if memmap_filename is None:
+        return np.full(shape, np.nan, dtype=np.float64)
+    weights = np.memmap(memmap_filename, dtype=np.float64, mode='w+', shape=shape)
+    weights[:] = np.nan
+    return weights
+
+
+def _grow(weights, memmap_filename, n_rows):
+    """ Enlarges the weight array if there are more events than announced in the run card """
+
+    if memmap_filename is None:
+        new_weights = np.full((n_rows, weights.shape[1]), np.nan, dtype=np.float64)
+        new_weights[:weights.shape[0]] = weights
+        return new_weights
+
+    n_old_rows, n_columns = weights.shape
+    weights.flush()
+    del weights
+    weights = np.memmap(memmap_filename, dtype=np.float64, mode='r+', shape=(n_rows, n_columns))
+    weights[n_old_rows:] = np.nan
+    return weights
+
+
+def _truncate(weights, memmap_filename, n_rows):
+    """ Drops the unused rows at the end of the weight array """
+
+    if memmap_filename is None:
+        return weights[:n_rows]
+
+    n_columns = weights.shape[1]
+    weights.flush()
+    del weights
+    with io.open(memmap_filename, 'r+b') as file:
+        file.truncate(n_rows * n_columns * np.dtype(np.float64).itemsize)
+    return np.memmap(memmap_filename, dtype=np.float64, mode='r+', shape=(n_rows, n_columns))
+
+
+def _incomplete_rows(weights, batch_size):
+    """ Indices of the events with NaN weights, checked in batches to keep the memory use low for memory maps """
+
+    batch_size = max(batch_size, 1000)
+    incomplete = [
+        start + np.where(np.any(np.isnan(weights[start : start + batch_size]), axis=1))[0]
+        for start in range(0, weights.shape[0], batch_size)
+    ]
+    return np.concatenate(incomplete) if incomplete else np.zeros(0, dtype=np.int64)
+
+
+class _CommentStrippingReader(object):
+    """ Binary file-like object that removes everything after a '#' in every line while reading """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self._incomplete_line = b''
+
+    def read(self, size=-1):
+        data = self._incomplete_line + self.raw.read(size)
+        self._incomplete_line = b''
+
+        # Keep the end of the last line until the rest of it has been read
+        if size >= 0:
+            last_line_start = data.rfind(b'\n') + 1
+            if 0 < last_line_start < len(data):
+                data, self._incomplete_line = data[:last_line_start], data[last_line_start:]
+            elif last_line_start == 0 and data:
+                rest = self.raw.readline()
+                data = data + rest
+
+        return _COMMENT.sub(b'', data)
+
+    def close(self):
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,89 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import numpy as np
+import torch
+from torch.nn import functional as F
+
+logger = logging.getLogger(__name__)
+
+# The loss functions of MadMiner's ratio_losses and flow_losses with optional per-sample weights. The weighted losses
+# are mean_i(w_i * loss_i), so with weights that average to one they are on the same scale as the unweighted ones.
+# Without weights, they are identical to MadMiner's.
+
+
+def ratio_mse_num(s_hat, log_r_hat, t0_hat, t1_hat, y_true, r_true, t0_true, t1_true, log_r_clip=10., weights=None):
+    r_true = torch.clamp(r_true, np.exp(-log_r_clip), np.exp(log_r_clip))
+    log_r_hat = torch.clamp(log_r_hat, -log_r_clip, log_r_clip)
+    inverse_r_hat = torch.exp(-log_r_hat)
+
+    return _mse((1. - y_true) * inverse_r_hat, (1. - y_true) * (1. / r_true), weights)
+
+
+def ratio_mse_den(s_hat, log_r_hat, t0_hat, t1_hat, y_true, r_true, t0_true, t1_true, log_r_clip=10., weights=None):
+    r_true = torch.clamp(r_true, np.exp(-log_r_clip), np.exp(log_r_clip))
+    log_r_hat = torch.clamp(log_r_hat, -log_r_clip, log_r_clip)
+    r_hat = torch.exp(log_r_hat)
+
+    return _mse(y_true * r_hat, y_true * r_true, weights)
+
+
+def ratio_mse(s_hat, log_r_hat, t0_hat, t1_hat, y_true, r_true, t0_true, t1_true, log_r_clip=10., weights=None):
+    return ratio_mse_num(
+        s_hat, log_r_hat, t0_hat, t1_hat, y_true, r_true, t0_true, t1_true, log_r_clip, weights
+    ) + ratio_mse_den(s_hat, log_r_hat, t0_hat, t1_hat, y_true, r_true, t0_true, t1_true, log_r_clip, weights)
+
+
+def score_mse_num(s_hat, log_r_hat, t0_hat, t1_hat, y_true, r_true, t0_true, t1_true, weights=None):
+    return _mse((1. - y_true) * t0_hat, (1. - y_true) * t0_true, weights)
+
+
+def score_mse_den(s_hat, log_r_hat, t0_hat, t1_hat, y_true, r_true, t0_true, t1_true, weights=None):
+    return _mse(y_true * t1_hat, y_true * t1_true, weights)
+
+
+def score_mse(s_hat, log_r_hat, t0_hat, t1_hat, y_true, r_true, t0_true, t1_true, weights=None):
+    return score_mse_num(
+        s_hat, log_r_hat, t0_hat, t1_hat, y_true, r_true, t0_true, t1_true, weights
+    ) + score_mse_den(s_hat, log_r_hat, t0_hat, t1_hat, y_true, r_true, t0_true, t1_true, weights)
+
+
+def standard_cross_entropy(s_hat, log_r_hat, t0_hat, t1_hat, y_true, r_true, t0_true, t1_true, weights=None):
+    s_hat = 1. / (1. + torch.exp(log_r_hat))
+
+    return F.binary_cross_entropy(s_hat, y_true, weight=_expand(weights, s_hat))
+
+
+def augmented_cross_entropy(s_hat, log_r_hat, t0_hat, t1_hat, y_true, r_true, t0_true, t1_true, weights=None):
+    s_hat = 1. / (1. + torch.exp(log_r_hat))
+    s_true = 1. / (1. + r_true)
+
+    return F.binary_cross_entropy(s_hat, s_true, weight=_expand(weights, s_hat))
+
+
+def local_score_mse(t_hat, t_true, weights=None):
+    return _mse(t_hat, t_true, weights)
+
+
+def flow_negative_log_likelihood(log_p_pred, t_pred, t_true, weights=None):
+    if weights is None:
+        return -torch.mean(log_p_pred)
+    return -torch.mean(weights.view(-1) * log_p_pred.view(-1))
+
+
+def flow_score_mse(log_p_pred, t_pred, t_true, weights=None):
+    return _mse(t_pred, t_true, weights)
+
+
+def _mse(prediction, target, weights=None):
+    if weights is None:
+        return F.mse_loss(prediction, target)
+    return torch.mean(_expand(weights, prediction) * (prediction - target) ** 2)
+
+
+def _expand(weights, like):
+    """ Per-sample weights with shape (n_samples, 1) or (n_samples,), broadcast to the shape of like """
+
+    if weights is None:
+        return None
+    return weights.view((-1,) + (1,) * (like.dim() - 1)).expand_as(like)
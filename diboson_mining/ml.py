@@ -0,0 +1,786 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import logging
+import itertools
+from collections import OrderedDict
+import six
+from six.moves import cPickle as pickle
+import numpy as np
+import torch
+
+from madminer.ml import MLForge as MadMinerMLForge, EnsembleForge as MadMinerEnsembleForge
+from madminer.utils.ml.models.maf import ConditionalMaskedAutoregressiveFlow
+from madminer.utils.ml.models.maf_mog import ConditionalMixtureMaskedAutoregressiveFlow
+from madminer.utils.ml.models.ratio import ParameterizedRatioEstimator, DoublyParameterizedRatioEstimator
+from madminer.utils.ml.models.score import LocalScoreEstimator
+from madminer.utils.various import load_and_check, shuffle
+
+from diboson_mining import losses
+from diboson_mining.datasets import IndexedArray, is_sample_container, load_container
+from diboson_mining.parallel import run_in_parallel, available_cpus
+from diboson_mining.training import BatchLoader, StreamLoader, train_model, log_memory_usage
+from diboson_mining.training import load_checkpoint, get_rng_state, set_rng_state
+
+logger = logging.getLogger(__name__)
+
+# Names of the training arrays in sample containers and streams, in the order in which they are tried
+CONTAINER_ARRAYS = OrderedDict(
+    [
+        ('x', ['x']),
+        ('theta0', ['theta0', 'theta']),
+        ('theta1', ['theta1']),
+        ('y', ['y']),
+        ('r_xz', ['r_xz']),
+        ('t_xz0', ['t_xz0', 't_xz']),
+        ('t_xz1', ['t_xz1']),
+        ('w', ['w']),
+    ]
+)
+
+
+class MLForge(MadMinerMLForge):
+    """
+    MLForge that reads the training data lazily. Training samples can be given as .npy files (like in MadMiner) or
+    as a single sample container written by `diboson_mining.sampling.SampleAugmenter` with container=True. Samples
+    from containers are never loaded completely: the minibatches are built from a few chunks of the container at a
+    time (see `diboson_mining.training.BatchLoader`).
+
+    Alternatively, the training samples can be drawn on the fly from a sample stream such as
+    `SampleAugmenter.stream_samples_train_ratio()`, which then runs in a background thread (see
+    `diboson_mining.training.StreamLoader`).
+
+    Evaluation, saving, and loading work exactly like in MadMiner's `MLForge`.
+
+    Parameters
+    ----------
+    debug : bool, optional
+        If True, additional detailed debugging output is printed. Default value: False.
+
+    """
+
+    def train(
+        self,
+        method,
+        x_filename,
+        y_filename=None,
+        theta0_filename=None,
+        theta1_filename=None,
+        r_xz_filename=None,
+        t_xz0_filename=None,
+        t_xz1_filename=None,
+        features=None,
+        nde_type='mafmog',
+        n_hidden=(100, 100),
+        activation='tanh',
+        maf_n_mades=3,
+        maf_batch_norm=False,
+        maf_batch_norm_alpha=0.1,
+        maf_mog_n_components=10,
+        alpha=1.,
+        trainer='amsgrad',
+        n_epochs=50,
+        batch_size=128,
+        initial_lr=0.001,
+        final_lr=0.0001,
+        nesterov_momentum=None,
+        validation_split=None,
+        early_stopping=True,
+        scale_inputs=True,
+        shuffle_labels=False,
+        grad_x_regularization=None,
+        limit_samplesize=None,
+        return_first_loss=False,
+        buffer_size=100000,
+        sample_stream=None,
+        n_batches_per_epoch=1000,
+        w_filename=None,
+        n_loader_workers=0,
+        memmap=False,
+        checkpoint_filename=None,
+        checkpoint_every=1,
+        resume=False,
+    ):
+        """
+        Trains a neural network to estimate either the likelihood ratio or, if method is 'sally' or 'sallino', the
+        score. See MadMiner's `MLForge.train()` for all parameters that are not listed here.
+
+        Parameters
+        ----------
+        x_filename : str or None
+            Path to an unweighted sample of observations, as saved by the `SampleAugmenter` functions, or to a sample
+            container (.h5) written with container=True. A container provides all training arrays, and the other
+            filenames are then ignored. Can be None if sample_stream is given.
+
+        buffer_size : int, optional
+            Number of samples that are loaded into memory at once if the training data is read from a container.
+            Default value: 100000.
+
+        sample_stream : iterable or None, optional
+            If not None, the training data is not loaded from files but drawn from this stream of minibatches, for
+            instance `SampleAugmenter.stream_samples_train_ratio()`. The minibatches of the stream are used as they
+            are, so batch_size and limit_samplesize are ignored, and shuffle_labels is not supported. The input
+            scaling is calculated from the first 100 minibatches. With validation_split, a fixed validation sample
+            of `validation_split * n_batches_per_epoch` minibatches is taken from the start of the stream. Default
+            value: None.
+
+        n_batches_per_epoch : int, optional
+            Number of minibatches from sample_stream per epoch. Default value: 1000.
+
+        w_filename : str or None, optional
+            Path to per-sample weights, for instance importance weights from `SampleAugmenter` (target_prior) or
+            `diboson_mining.sampling.importance_weights()`. The losses are then weighted averages over the samples.
+            Sample containers and streams with an array 'w' are always weighted. Default value: None.
+
+        n_loader_workers : int, optional
+            Number of background threads that read the training data ahead of the training steps, see
+            `diboson_mining.training.BatchLoader`. Mostly useful for sample containers and other lazy arrays. Default
+            value: 0.
+
+        memmap : bool, optional
+            If True, the .npy files are memory-mapped instead of loaded into memory. The input scaling and the checks
+            for NaNs are then calculated in buffers of buffer_size samples, and the training and validation samples
+            are read by index for each buffer, so the memory use does not grow with the size of the training data.
+            The peak memory use is logged at the end of the training in any case. Default value: False.
+
+        checkpoint_filename : str or None, optional
+            If not None, the complete training state is saved to this file every checkpoint_every epochs, see
+            `diboson_mining.training.train_model()`. Default value: None.
+
+        checkpoint_every : int, optional
+            Number of epochs between checkpoints. Default value: 1.
+
+        resume : bool, optional
+            If True and checkpoint_filename exists, the training continues from the checkpoint instead of starting
+            from scratch. The training data and all other settings have to be the same as in the interrupted
+            training, the train / validation split and the shuffled labels are then recreated exactly. With
+            sample_stream, the stream itself is not part of the checkpoint, so the resumed training sees new samples.
+            Default value: False.
+
+        Returns
+        -------
+        total_losses_train, total_losses_val : list of float
+            Training and validation loss after each epoch.
+
+        """
+
+        logger.info('Starting training')
+        logger.info('  Method:                 %s', method)
+        logger.info('  Training data:          %s', x_filename)
+        if features is not None:
+            logger.info('  Features:               %s', features)
+        logger.info('  Batch size:             %s', batch_size)
+        logger.info('  Trainer:                %s', trainer)
+        logger.info('  Epochs:                 %s', n_epochs)
+        logger.info('  Learning rate:          %s initially, decaying to %s', initial_lr, final_lr)
+        logger.info('  Validation split:       %s', validation_split)
+        logger.info('  Early stopping:         %s', early_stopping)
+
+        # Checkpoint: restore the random state in which the data was split and shuffled
+        checkpoint, checkpoint_extra = None, None
+        if resume and checkpoint_filename is not None and os.path.exists(checkpoint_filename):
+            logger.info('Resuming training from checkpoint %s', checkpoint_filename)
+            checkpoint = load_checkpoint(checkpoint_filename)
+            if checkpoint['extra'].get('method') != method:
+                raise ValueError(
+                    'Checkpoint {} is for method {}, not {}'.format(
+                        checkpoint_filename, checkpoint['extra'].get('method'), method
+                    )
+                )
+            set_rng_state(checkpoint['extra']['data_rng_state'])
+        elif resume:
+            logger.info('No checkpoint found at %s, starting training from scratch', checkpoint_filename)
+        if checkpoint_filename is not None:
+            checkpoint_extra = OrderedDict([('method', method), ('data_rng_state', get_rng_state())])
+            if sample_stream is not None:
+                logger.warning('Sample streams are not part of the checkpoints, a resumed training sees new samples')
+
+        # Load training data
+        stream, n_validation = None, None
+        if sample_stream is not None:
+            if shuffle_labels:
+                raise ValueError('Labels cannot be shuffled for sample streams')
+
+            logger.info('Drawing initial samples from the sample stream')
+            stream = iter(sample_stream)
+            n_validation_batches = 0
+            if validation_split is not None:
+                n_validation_batches = max(1, int(round(validation_split * n_batches_per_epoch)))
+            batches = list(itertools.islice(stream, max(n_validation_batches, 100)))
+            if not batches:
+                raise ValueError('Sample stream is empty')
+            if len(batches) <= n_validation_batches:
+                next_batch = next(stream, None)
+                if next_batch is None:
+                    raise ValueError(
+                        'Sample stream only yields {} minibatches, which are all used for validation'.format(
+                            len(batches)
+                        )
+                    )
+                stream = itertools.chain([next_batch], stream)
+            n_validation = sum(len(batch['x']) for batch in batches[:n_validation_batches])
+            data = _training_arrays(
+                OrderedDict([(name, np.concatenate([batch[name] for batch in batches])) for name in batches[0]])
+            )
+
+            # The other initial minibatches are used for training
+            stream = itertools.chain(batches[n_validation_batches:], stream)
+            limit_samplesize = None
+
+        else:
+            logger.info('Loading training data')
+            data = _load_training_data(
+                x_filename,
+                y_filename,
+                theta0_filename,
+                theta1_filename,
+                r_xz_filename,
+                t_xz0_filename,
+                t_xz1_filename,
+                w_filename,
+                mmap_mode='r' if memmap else None,
+                buffer_size=buffer_size,
+            )
+        _check_training_data(method, nde_type, data)
+        if 'w' in data:
+            w = np.asarray(data['w'])
+            logger.info(
+                'Using sample weights with mean %s, effective sample size %s',
+                np.mean(w),
+                np.sum(w) ** 2 / np.sum(w ** 2),
+            )
+
+        # Infer dimensions of problem
+        n_samples, n_observables = data['x'].shape
+        if 'theta0' in data:
+            n_parameters = data['theta0'].shape[1]
+        else:
+            n_parameters = data['t_xz0'].shape[1]
+        logger.info('Found %s samples with %s parameters and %s observables', n_samples, n_parameters, n_observables)
+
+        # Limit sample size
+        if limit_samplesize is not None and limit_samplesize < n_samples:
+            logger.info('Only using %s of %s training samples', limit_samplesize, n_samples)
+            n_samples = limit_samplesize
+            data = OrderedDict([(name, _first_rows(array, n_samples)) for name, array in six.iteritems(data)])
+
+        # Scale features
+        if scale_inputs:
+            logger.info('Rescaling inputs')
+            self.x_scaling_means, self.x_scaling_stds = _mean_and_std(data['x'], buffer_size)
+            self.x_scaling_stds = np.maximum(self.x_scaling_stds, 1.e-6)
+        else:
+            self.x_scaling_means = np.zeros(n_observables)
+            self.x_scaling_stds = np.ones(n_observables)
+
+        # Shuffle labels
+        if shuffle_labels:
+            logger.info('Shuffling labels')
+            data = _shuffle_labels(data)
+
+        # Features
+        if features is not None:
+            logger.info('Only using %s of %s observables', len(features), n_observables)
+            n_observables = len(features)
+
+        # Save setup
+        self.method = method
+        self.n_observables = n_observables
+        self.n_parameters = n_parameters
+        self.n_hidden = n_hidden
+        self.activation = activation
+        self.maf_n_mades = maf_n_mades
+        self.maf_batch_norm = maf_batch_norm
+        self.maf_batch_norm_alpha = maf_batch_norm_alpha
+        self.features = features
+
+        # Create model
+        logger.info('Creating model for method %s', method)
+        self._create_model(method, nde_type, maf_mog_n_components)
+        loss_functions, loss_weights, loss_labels = _get_losses(method, alpha)
+        calculate_model_score = method in ['rascal', 'cascal', 'alices', 'scandal', 'rascal2', 'cascal2', 'alices2']
+
+        # Train / validation split and minibatches
+        if stream is not None:
+            train_loader = StreamLoader(stream, n_batches_per_epoch, transform=self._transform_stream_batch)
+            validation_loader = None
+            if n_validation > 0:
+                validation_loader = BatchLoader(
+                    data,
+                    np.arange(n_validation),
+                    batch_size,
+                    buffer_size=buffer_size,
+                    transform=self._transform_batch,
+                    n_workers=n_loader_workers,
+                )
+        else:
+            train_loader, validation_loader = self._make_loaders(
+                data, n_samples, validation_split, batch_size, buffer_size, n_loader_workers
+            )
+
+        # Train model
+        logger.info('Training model')
+        try:
+            result = train_model(
+                model=self.model,
+                method_type=self.method_type,
+                loss_functions=loss_functions,
+                train_loader=train_loader,
+                validation_loader=validation_loader,
+                loss_weights=loss_weights,
+                loss_labels=loss_labels,
+                calculate_model_score=calculate_model_score,
+                trainer=trainer,
+                initial_learning_rate=initial_lr,
+                final_learning_rate=final_lr,
+                nesterov_momentum=nesterov_momentum,
+                n_epochs=n_epochs,
+                early_stopping=early_stopping,
+                grad_x_regularization=grad_x_regularization,
+                return_first_loss=return_first_loss,
+                verbose='all' if self.debug else 'some',
+                checkpoint_filename=checkpoint_filename,
+                checkpoint_every=checkpoint_every,
+                checkpoint=checkpoint,
+                checkpoint_extra=checkpoint_extra,
+            )
+        finally:
+            if stream is not None:
+                train_loader.close()
+
+        log_memory_usage()
+
+        return result
+
+    def _make_loaders(self, data, n_samples, validation_split, batch_size, buffer_size, n_workers=0):
+        """ Splits the samples into training and validation samples and returns a BatchLoader for each """
+
+        indices = np.arange(n_samples)
+        if validation_split is not None:
+            assert 0. < validation_split < 1., 'Wrong validation split: {}'.format(validation_split)
+            np.random.shuffle(indices)
+            n_validation = int(np.floor(validation_split * n_samples))
+            train_indices, validation_indices = indices[n_validation:], indices[:n_validation]
+        else:
+            train_indices, validation_indices = indices, None
+
+        train_loader = BatchLoader(
+            data,
+            train_indices,
+            batch_size,
+            buffer_size=buffer_size,
+            transform=self._transform_batch,
+            n_workers=n_workers,
+        )
+        validation_loader = None
+        if validation_indices is not None:
+            validation_loader = BatchLoader(
+                data,
+                validation_indices,
+                batch_size,
+                buffer_size=buffer_size,
+                transform=self._transform_batch,
+                n_workers=n_workers,
+            )
+        return train_loader, validation_loader
+
+    def _transform_batch(self, batch):
+        """ Input scaling and feature selection for one minibatch """
+
+        x = (batch['x'] - self.x_scaling_means) / self.x_scaling_stds
+        if self.features is not None:
+            x = x[:, self.features]
+        batch['x'] = x
+        return batch
+
+    def _transform_stream_batch(self, batch):
+        return self._transform_batch(_training_arrays(batch))
+
+    def _create_model(self, method, nde_type='mafmog', maf_mog_n_components=10):
+        """ Creates the neural network for method, like MadMiner's `MLForge.train()` """
+
+        if method in ['carl', 'rolr', 'rascal', 'alice', 'alices']:
+            self.method_type = 'parameterized'
+            self.model = ParameterizedRatioEstimator(
+                n_observables=self.n_observables,
+                n_parameters=self.n_parameters,
+                n_hidden=self.n_hidden,
+                activation=self.activation,
+            )
+        elif method in ['carl2', 'rolr2', 'rascal2', 'alice2', 'alices2']:
+            self.method_type = 'doubly_parameterized'
+            self.model = DoublyParameterizedRatioEstimator(
+                n_observables=self.n_observables,
+                n_parameters=self.n_parameters,
+                n_hidden=self.n_hidden,
+                activation=self.activation,
+            )
+        elif method in ['sally', 'sallino']:
+            self.method_type = 'local_score'
+            self.model = LocalScoreEstimator(
+                n_observables=self.n_observables,
+                n_parameters=self.n_parameters,
+                n_hidden=self.n_hidden,
+                activation=self.activation,
+            )
+        elif method in ['nde', 'scandal']:
+            self.method_type = 'nde'
+            if nde_type == 'maf':
+                self.model = ConditionalMaskedAutoregressiveFlow(
+                    n_conditionals=self.n_parameters,
+                    n_inputs=self.n_observables,
+                    n_hiddens=self.n_hidden,
+                    n_mades=self.maf_n_mades,
+                    activation=self.activation,
+                    batch_norm=self.maf_batch_norm,
+                    alpha=self.maf_batch_norm_alpha,
+                )
+            elif nde_type == 'mafmog':
+                self.model = ConditionalMixtureMaskedAutoregressiveFlow(
+                    n_conditionals=self.n_parameters,
+                    n_inputs=self.n_observables,
+                    n_components=maf_mog_n_components,
+                    n_hiddens=self.n_hidden,
+                    n_mades=self.maf_n_mades,
+                    activation=self.activation,
+                    batch_norm=self.maf_batch_norm,
+                    alpha=self.maf_batch_norm_alpha,
+                )
+            else:
+                raise RuntimeError('Unknown NDE type {}'.format(nde_type))
+        else:
+            raise RuntimeError('Unknown method {}'.format(method))
+
+
+class EnsembleForge(MadMinerEnsembleForge):
+    """
+    EnsembleForge whose estimators are `diboson_mining.ml.MLForge` instances, so that `train_one()` and `train_all()`
+    accept sample containers. `train_all()` can train the estimators in parallel in a local process pool. See
+    MadMiner's `EnsembleForge` for everything else.
+
+    Parameters
+    ----------
+    estimators : None or int or list of (MLForge or str), optional
+        If int, sets the number of estimators that will be created as new MLForge instances. If list, sets
+        the estimators directly, either from MLForge instances or filenames (that are then loaded with
+        `MLForge.load()`). If None, the ensemble is initialized without estimators. Default value: None.
+
+    debug : bool, optional
+        If True, additional detailed debugging output is printed. Default value: False.
+
+    """
+
+    def __init__(self, estimators=None, debug=False):
+        if isinstance(estimators, int):
+            estimators = [MLForge(debug=debug) for _ in range(estimators)]
+        elif estimators is not None:
+            estimators = [self._make_estimator(estimator, debug) for estimator in estimators]
+
+        super(EnsembleForge, self).__init__(estimators, debug=debug)
+
+    def add_estimator(self, estimator):
+        """
+        Adds an estimator to the ensemble.
+
+        Parameters
+        ----------
+        estimator : MLForge or str
+            The estimator, either as MLForge instance or filename (which is then loaded with `MLForge.load()`).
+
+        Returns
+        -------
+            None
+
+        """
+
+        super(EnsembleForge, self).add_estimator(self._make_estimator(estimator, self.debug))
+
+    def train_all(self, n_workers=1, seed=None, n_threads=None, **kwargs):
+        """
+        Trains all estimators. See `MLForge.train()`.
+
+        With n_workers > 1, the estimators are trained in parallel in a local process pool, each worker with
+        n_threads torch threads. The trained estimators are sent back to this process and replace the ones in the
+        ensemble. With a seed, numpy's and torch's random states are seeded from (seed, i) before the training of
+        estimator i, so that the results do not depend on n_workers (as long as n_threads is the same).
+
+        Parameters
+        ----------
+        n_workers : int, optional
+            Number of worker processes. With 1, the estimators are trained one after another in this process. Default
+            value: 1.
+
+        seed : int or None, optional
+            Base seed for the per-estimator random states. If None and n_workers > 1, a seed is drawn from numpy's
+            global random state, so that the estimators are not initialized identically. If None and n_workers is 1,
+            the random states are not touched. Default value: None.
+
+        n_threads : int or None, optional
+            Number of torch threads used for the training of each estimator. If None, the CPUs available to this
+            process (see `diboson_mining.parallel.available_cpus()`) are split evenly between the workers if
+            n_workers > 1, and torch's setting is kept if n_workers is 1. Default value: None.
+
+        kwargs : dict
+            Parameters for `MLForge.train()`. If a value in this dict is a list, it has to have length `n_estimators`
+            and contain one value of this parameter for each of the estimators. Otherwise the value is used as
+            parameter for the training of all the estimators. Sample streams are only supported with n_workers = 1.
+
+        Returns
+        -------
+        results : list
+            The return values of `MLForge.train()` for each estimator.
+
+        """
+
+        logger.info('Training %s estimators in ensemble', self.n_estimators)
+
+        for key, value in six.iteritems(kwargs):
+            if not isinstance(value, list):
+                kwargs[key] = [value for _ in range(self.n_estimators)]
+            assert len(kwargs[key]) == self.n_estimators, 'Keyword {} has wrong length {}'.format(key, len(value))
+
+        checkpoint_filenames = [filename for filename in kwargs.get('checkpoint_filename', []) if filename is not None]
+        if len(set(checkpoint_filenames)) < len(checkpoint_filenames):
+            raise ValueError('Each estimator needs its own checkpoint_filename')
+
+        self._check_consistency(kwargs)
+
+        parallel = n_workers > 1 and self.n_estimators > 1
+        if parallel:
+            if any(stream is not None for stream in kwargs.get('sample_stream', [])):
+                raise ValueError('Sample streams cannot be sent to worker processes, use n_workers=1')
+            if seed is None:
+                seed = np.random.randint(np.iinfo(np.int32).max)
+            if n_threads is None:
+                n_threads = max(1, available_cpus() // min(n_workers, self.n_estimators))
+            logger.info('Training with %s workers and %s threads per estimator', n_workers, n_threads)
+
+        tasks = []
+        for i, estimator in enumerate(self.estimators):
+            tasks.append(
+                dict(
+                    estimator=estimator,
+                    kwargs=OrderedDict([(key, value[i]) for key, value in six.iteritems(kwargs)]),
+                    i_estimator=i,
+                    n_estimators=self.n_estimators,
+                    n_threads=n_threads,
+                    seed_torch=seed is not None,
+                    serialize=parallel,
+                )
+            )
+
+        results = run_in_parallel(_train_estimator, tasks, n_workers=n_workers if parallel else 1, seed=seed)
+
+        self.estimators = [pickle.loads(estimator) if parallel else estimator for estimator, _ in results]
+        return [result for _, result in results]
+
+    @staticmethod
+    def _make_estimator(estimator, debug):
+        if isinstance(estimator, six.string_types):
+            filename = estimator
+            estimator = MLForge(debug=debug)
+            estimator.load(filename)
+        return estimator
+
+
+def _train_estimator(estimator, kwargs, i_estimator, n_estimators, n_threads=None, seed_torch=False, serialize=False):
+    """
+    Trains one estimator of an ensemble, see `EnsembleForge.train_all()`. Returns the trained estimator (pickled if
+    serialize is True) and the return value of `MLForge.train()`.
+    """
+
+    logger.info('Training estimator %s / %s in ensemble', i_estimator + 1, n_estimators)
+
+    # numpy's random state is already seeded by run_in_parallel()
+    if seed_torch:
+        torch.manual_seed(np.random.randint(np.iinfo(np.int32).max))
+
+    previous_n_threads = torch.get_num_threads()
+    if n_threads is not None:
+        torch.set_num_threads(n_threads)
+    try:
+        result = estimator.train(**kwargs)
+    finally:
+        torch.set_num_threads(previous_n_threads)
+
+    # Plain pickling copies the tensors, instead of sharing them with the parent process through file descriptors
+    if serialize:
+        estimator = pickle.dumps(estimator, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return estimator, result
+
+
+def _load_training_data(
+    x_filename,
+    y_filename,
+    theta0_filename,
+    theta1_filename,
+    r_xz_filename,
+    t_xz0_filename,
+    t_xz1_filename,
+    w_filename=None,
+    mmap_mode=None,
+    buffer_size=100000,
+):
+    """ Returns an OrderedDict with the training arrays, which are lazy for sample containers and with mmap_mode """
+
+    if is_sample_container(x_filename):
+        return _training_arrays(load_container(x_filename))
+
+    data = OrderedDict()
+
+    filenames = [
+        ('x', x_filename),
+        ('theta0', theta0_filename),
+        ('theta1', theta1_filename),
+        ('y', y_filename),
+        ('r_xz', r_xz_filename),
+        ('t_xz0', t_xz0_filename),
+        ('t_xz1', t_xz1_filename),
+        ('w', w_filename),
+    ]
+    for name, filename in filenames:
+        if filename is not None:
+            if mmap_mode is None:
+                data[name] = load_and_check(filename)
+            else:
+                data[name] = np.load(filename, mmap_mode=mmap_mode)
+                _check_values(data[name], filename, buffer_size)
+    for name in ['y', 'w']:
+        if name in data:
+            data[name] = data[name].reshape((-1, 1))
+
+    return data
+
+
+def _training_arrays(samples):
+    """ Renames the arrays of a sample container or a minibatch of a sample stream to the training inputs """
+
+    data = OrderedDict()
+    for name, candidates in six.iteritems(CONTAINER_ARRAYS):
+        for candidate in candidates:
+            if candidate in samples:
+                data[name] = samples[candidate]
+                break
+    return data
+
+
+def _check_training_data(method, nde_type, data):
+    """ Checks that all arrays needed by method are there, like MadMiner's `MLForge.train()` """
+
+    required = []
+    if method in ['carl', 'carl2', 'nde', 'scandal', 'rolr', 'alice', 'rascal', 'alices']:
+        required.append('theta0')
+    if method in ['rolr2', 'alice2', 'rascal2', 'alices2']:
+        required.append('theta0')
+    if method in ['rolr', 'alice', 'rascal', 'alices', 'rolr2', 'alice2', 'rascal2', 'alices2']:
+        required.append('r_xz')
+    if method in ['carl', 'carl2', 'rolr', 'alice', 'rascal', 'alices', 'rolr2', 'alice2', 'rascal2', 'alices2']:
+        required.append('y')
+    if method in ['scandal', 'rascal', 'alices', 'rascal2', 'alices2', 'sally', 'sallino']:
+        required.append('t_xz0')
+    if method in ['carl2', 'rolr2', 'alice2', 'rascal2', 'alices2']:
+        required.append('theta1')
+    if method in ['rascal2', 'alices2']:
+        required.append('t_xz1')
+
+    missing = [name for name in required if name not in data]
+    if 'x' not in data or missing:
+        raise ValueError('Missing training data for method {}: {}'.format(method, ', '.join(['x'] + missing)))
+
+    if method in ['nde', 'scandal'] and nde_type not in ['maf', 'mafmog']:
+        raise ValueError('Unknown NDE type {}'.format(nde_type))
+
+
+def _get_losses(method, alpha):
+    """ Loss functions, weights, and labels for method, like MadMiner's `MLForge.train()` """
+
+    if method in ['carl', 'carl2']:
+        return [losses.standard_cross_entropy], [1.], ['xe']
+    if method in ['rolr', 'rolr2']:
+        return [losses.ratio_mse], [1.], ['mse_r']
+    if method == 'rascal':
+        return [losses.ratio_mse, losses.score_mse_num], [1., alpha], ['mse_r', 'mse_score']
+    if method == 'rascal2':
+        return [losses.ratio_mse, losses.score_mse], [1., alpha], ['mse_r', 'mse_score']
+    if method in ['alice', 'alice2']:
+        return [losses.augmented_cross_entropy], [1.], ['improved_xe']
+    if method == 'alices':
+        return [losses.augmented_cross_entropy, losses.score_mse_num], [1., alpha], ['improved_xe', 'mse_score']
+    if method == 'alices2':
+        return [losses.augmented_cross_entropy, losses.score_mse], [1., alpha], ['improved_xe', 'mse_score']
+    if method in ['sally', 'sallino']:
+        return [losses.local_score_mse], [1.], ['mse_score']
+    if method == 'nde':
+        return [losses.flow_negative_log_likelihood], [1.], ['nll']
+    if method == 'scandal':
+        return [losses.flow_negative_log_likelihood, losses.flow_score_mse], [1., alpha], ['nll', 'mse_score']
+    raise ValueError('Unknown method {}'.format(method))
+
+
+def _check_values(array, filename, buffer_size, warning_threshold=1.e9):
+    """ The checks of MadMiner's `load_and_check()` for NaNs, Infs, and large numbers, in buffers of rows """
+
+    n_nans, n_infs, n_finite = 0, 0, 0
+    smallest, largest = np.inf, -np.inf
+    for start in range(0, len(array), buffer_size):
+        values = np.asarray(array[start : start + buffer_size])
+        n_nans += np.sum(np.isnan(values))
+        n_infs += np.sum(np.isinf(values))
+        n_finite += np.sum(np.isfinite(values))
+        if np.any(np.isfinite(values)) or np.any(np.isinf(values)):
+            smallest = min(smallest, np.nanmin(values))
+            largest = max(largest, np.nanmax(values))
+
+    if n_nans + n_infs > 0:
+        logger.warning(
+            'Warning: file %s contains %s NaNs and %s Infs, compared to %s finite numbers!',
+            filename,
+            n_nans,
+            n_infs,
+            n_finite,
+        )
+
+    if np.abs(smallest) > warning_threshold or np.abs(largest) > warning_threshold:
+        logger.warning('Warning: file %s has some large numbers, rangin from %s to %s', filename, smallest, largest)
+
+
+def _in_memory(array):
+    return isinstance(array, np.ndarray) and not isinstance(array, np.memmap)
+
+
+def _first_rows(array, n_rows):
+    if isinstance(array, np.ndarray):
+        return array[:n_rows]
+    return IndexedArray(array, np.arange(n_rows))
+
+
+def _mean_and_std(x, buffer_size):
+    """ Mean and standard deviation of each column, for lazy arrays in two passes over buffers of rows """
+
+    if _in_memory(x):
+        return np.mean(x, axis=0), np.std(x, axis=0)
+
+    n_samples = len(x)
+    buffers = [slice(start, min(start + buffer_size, n_samples)) for start in range(0, n_samples, buffer_size)]
+
+    mean = sum(np.sum(np.asarray(x[rows], dtype=np.float64), axis=0) for rows in buffers) / n_samples
+    variance = sum(np.sum((np.asarray(x[rows], dtype=np.float64) - mean) ** 2, axis=0) for rows in buffers) / n_samples
+    return mean, variance ** 0.5
+
+
+def _shuffle_labels(data):
+    """ Shuffles y, r_xz, t_xz0, and t_xz1 together, while the observations (and parameters) stay in order """
+
+    labels = [name for name in ['y', 'r_xz', 't_xz0', 't_xz1'] if name in data]
+    data = OrderedDict(data)
+
+    if all(_in_memory(data[name]) for name in labels):
+        for name, shuffled in zip(labels, shuffle(*[data[name] for name in labels])):
+            data[name] = shuffled
+        return data
+
+    permutation = np.random.permutation(len(data['x']))
+    for name in labels:
+        data[name] = IndexedArray(data[name], permutation)
+    return data
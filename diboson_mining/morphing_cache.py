@@ -0,0 +1,250 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import io
+import hashlib
+import logging
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class MorphingWeightCache(object):
+    """
+    On-disk cache for the per-event morphing component weights of MadMiner files.
+
+    With morphing, the weight of event i at the parameter point theta is `sum_c W_ic f_c(theta)`, where
+    `f_c(theta) = prod_p theta_p ** k_cp` are the morphing components and `W = w_benchmarks . morphing_matrix^T` are the
+    component weights of each event. The cache stores W for each combination of sample file (identified by its path,
+    size, and modification time) and morphing setup. The weights at any later theta (or at a batch of thetas) are then
+    calculated from the cache without reading the benchmark weights from the MadMiner file again, see
+    `cached_observables_and_weights()`, which `SampleAugmenter.extract_raw_data()` and
+    `FisherInformation.extract_observables_and_weights()` use.
+
+    Each entry is a .npy file in cache_dir, which is memory-mapped when it is used. When the total size of the
+    entries exceeds max_size, the least recently used ones are deleted.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Directory for the cache files. Is created if it does not exist.
+
+    max_size : float, optional
+        Maximal total size of the cache files in bytes. Default value: 20.e9.
+
+    """
+
+    def __init__(self, cache_dir, max_size=20.e9):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def component_weights(self, filename, morpher, start_event=0, end_event=None, batch_size=100000):
+        """
+        Returns the morphing component weights for the events in a MadMiner file, calculating and caching them if
+        necessary.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the MadMiner file.
+
+        morpher : Morpher
+            Morphing setup (for instance `SampleAugmenter.morpher`).
+
+        start_event : int, optional
+            Index of the first event to consider. Default value: 0.
+
+        end_event : int or None, optional
+            Index of the last event to consider. If None, use the last event. Default value: None.
+
+        batch_size : int, optional
+            Number of events whose weights are read from the MadMiner file at once when the entry is created. Default
+            value: 100000.
+
+        Returns
+        -------
+        component_weights : memmap
+            Read-only component weights with shape `(n_events, n_components)`.
+
+        """
+
+        key = self._key(filename, morpher, start_event, end_event)
+        cache_filename = os.path.join(self.cache_dir, key + '.npy')
+
+        if os.path.exists(cache_filename):
+            logger.debug('Loading morphing component weights for %s from %s', filename, cache_filename)
+            os.utime(cache_filename, None)
+            return np.load(cache_filename, mmap_mode='r')
+
+        logger.info('Calculating morphing component weights for %s', filename)
+
+        # Write to a temporary file first, so that other processes never see incomplete entries
+        temp_filename = '{}.{}.tmp'.format(cache_filename, os.getpid())
+        morphing_matrix = morpher.morphing_matrix  # Shape (n_components, n_benchmarks_phys)
+        n_components, n_basis = morphing_matrix.shape
+
+        # Only the weights of the physical benchmarks are read, not the observations
+        chunks = []
+        with h5py.File(filename, 'r') as file:
+            weights = file['samples/weights']
+            end = weights.shape[0] if end_event is None else min(end_event, weights.shape[0])
+            for start in range(start_event, end, batch_size):
+                chunks.append(weights[start : min(start + batch_size, end), :n_basis].dot(morphing_matrix.T))
+        component_weights = np.vstack(chunks) if chunks else np.zeros((0, n_components))
+
+        with io.open(temp_filename, 'wb') as file:
+            np.save(file, component_weights)
+        os.rename(temp_filename, cache_filename)
+
+        self._evict(keep=cache_filename)
+
+        return np.load(cache_filename, mmap_mode='r')
+
+    def weights(self, filename, morpher, thetas, start_event=0, end_event=None):
+        """
+        Returns the event weights at a batch of parameter points.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the MadMiner file.
+
+        morpher : Morpher
+            Morphing setup.
+
+        thetas : ndarray
+            Parameter points with shape `(n_thetas, n_parameters)`.
+
+        start_event : int, optional
+            Index of the first event to consider. Default value: 0.
+
+        end_event : int or None, optional
+            Index of the last event to consider. If None, use the last event. Default value: None.
+
+        Returns
+        -------
+        weights : ndarray
+            Event weights with shape `(n_events, n_thetas)`.
+
+        """
+
+        component_weights = self.component_weights(filename, morpher, start_event, end_event)
+        return component_weights.dot(morphing_component_factors(morpher, thetas).T)
+
+    def clear(self):
+        """ Deletes all cache entries """
+
+        for cache_filename, _, _ in self._entries():
+            os.remove(cache_filename)
+
+    def _key(self, filename, morpher, start_event, end_event):
+        """ Identifies the sample file by path, size, and modification time, so it never has to be hashed """
+
+        path = os.path.abspath(filename)
+        stat = os.stat(path)
+
+        key = hashlib.sha1()
+        key.update('{}:{}:{!r}'.format(path, stat.st_size, stat.st_mtime).encode('utf-8'))
+        key.update(np.ascontiguousarray(morpher.components, dtype=np.int64).tobytes())
+        key.update(np.ascontiguousarray(morpher.morphing_matrix, dtype=np.float64).tobytes())
+        key.update('{}:{}'.format(start_event, end_event).encode('ascii'))
+        return key.hexdigest()
+
+    def _entries(self):
+        """ Returns (filename, size, last access) for all cache entries """
+
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy'):
+                continue
+            cache_filename = os.path.join(self.cache_dir, name)
+            stat = os.stat(cache_filename)
+            entries.append((cache_filename, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self, keep=None):
+        """ Deletes the least recently used entries until the cache fits into max_size """
+
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total_size = sum(size for _, size, _ in entries)
+
+        for cache_filename, size, _ in entries:
+            if total_size <= self.max_size:
+                break
+            if cache_filename == keep:
+                continue
+            logger.debug('Removing %s from the morphing weight cache', cache_filename)
+            os.remove(cache_filename)
+            total_size -= size
+
+
+def morphing_component_factors(morpher, thetas):
+    """
+    Calculates the morphing components `f_c(theta) = prod_p theta_p ** k_cp` for a batch of parameter points.
+
+    Parameters
+    ----------
+    morpher : Morpher
+        Morphing setup.
+
+    thetas : ndarray
+        Parameter points with shape `(n_thetas, n_parameters)` or `(n_parameters,)`.
+
+    Returns
+    -------
+    factors : ndarray
+        Component factors with shape `(n_thetas, n_components)` (or `(n_components,)` for a single theta).
+
+    """
+
+    thetas = np.asarray(thetas, dtype=np.float64)
+    components = np.asarray(morpher.components)
+    return np.prod(thetas[..., np.newaxis, :] ** components, axis=-1)
+
+
+def cached_observables_and_weights(cache, filename, morpher, thetas, mask=None):
+    """
+    Returns the observations of the events in a MadMiner file and their weights at a batch of parameter points, with
+    the weights calculated from the morphing component weights in a `MorphingWeightCache`. Only the observations are
+    read from the MadMiner file, and the weights at all thetas are one matrix product.
+
+    Parameters
+    ----------
+    cache : MorphingWeightCache
+        The cache.
+
+    filename : str
+        Path to the MadMiner file.
+
+    morpher : Morpher
+        Morphing setup.
+
+    thetas : ndarray
+        Parameter points with shape `(n_thetas, n_parameters)`.
+
+    mask : ndarray or None, optional
+        If not None, boolean array with one entry per event in the file, only the events where it is True are
+        returned. Default value: None.
+
+    Returns
+    -------
+    x : ndarray
+        Observations with shape `(n_events, n_observables)`.
+
+    weights : ndarray
+        Event weights with shape `(n_thetas, n_events)`.
+
+    """
+
+    component_weights = cache.component_weights(filename, morpher)
+    with h5py.File(filename, 'r') as file:
+        x = file['samples/observations'][()]
+
+    if mask is not None:
+        x, component_weights = x[mask], component_weights[mask]
+
+    return x, morphing_component_factors(morpher, thetas).dot(component_weights.T)
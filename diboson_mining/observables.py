@@ -0,0 +1,153 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from collections import OrderedDict
+import numpy as np
+
+from diboson_mining.vectors import LorentzArray
+
+# W mass used in the neutrino reconstruction
+MW = 80.4
+
+# Observables returned by calculate_wgamma_observables()
+WGAMMA_OBSERVABLES = ['mt', 'phi_minus', 'phi_plus', 'phi']
+
+
+def calculate_wgamma_observables(leptons, photons, jets, met):
+    """
+    Calculates mT and the resurrection phi for both neutrino solutions and for a random choice between them, sharing
+    the W-mass constrained neutrino reconstruction and the Wgamma frames between all of them. Vectorized: leptons,
+    photons, and jets are `ParticleColumns`, met is a `LorentzArray`.
+
+    Returns
+    -------
+    observables : OrderedDict
+        Arrays with shape `(n_events,)` for the keys in `WGAMMA_OBSERVABLES`, with NaN where they are not defined.
+        The random choice for 'phi' uses `leptons.event_random`, see `calculate_phi()`.
+
+    """
+
+    reco = _reconstruct_neutrino(leptons, photons, met)
+
+    phi_plus = _calculate_phi_in_special_frame(reco, reco['eta_v_plus'])
+    phi_minus = _calculate_phi_in_special_frame(reco, reco['eta_v_minus'])
+
+    # Random choice between the two solutions (both are the same in the "other" case)
+    phi = np.where(_pick_plus(reco, leptons), phi_plus, phi_minus)
+
+    return OrderedDict([('mt', reco['mt']), ('phi_minus', phi_minus), ('phi_plus', phi_plus), ('phi', phi)])
+
+
+def calculate_mt(leptons, photons, jets, met):
+    """
+    Transverse mass of the lepton-MET system. Vectorized: leptons, photons, and jets are `ParticleColumns`, met is a
+    `LorentzArray`, and the result has shape `(n_events,)`, with NaN for events without lepton.
+    """
+
+    l = leptons[0]
+
+    cos_delta_phi = np.cos(l.phi() - met.phi())
+    mt = (2 * l.pt * met.pt * (1. - cos_delta_phi)) ** 0.5
+
+    return np.where(l.valid, mt, np.nan)
+
+
+def calculate_phi(leptons, photons, jets, met, eta_solution=0):
+    """
+    Resurrection phi (1708.07823), i.e. the azimuthal angle of the lepton in the special Wgamma frame, after a W-mass
+    constrained reconstruction of the neutrino. Vectorized version of the per-event definition: the input arguments
+    are `ParticleColumns` (and a `LorentzArray` for met), the result has shape `(n_events,)` with NaN for events
+    without lepton or photon.
+
+    If eta_solution is 0, one of the two neutrino solutions is picked at random, based on the per-event random numbers
+    in `leptons.event_random` (see `ParticleColumns`), so the choice for an event does not depend on which other
+    events are evaluated. Without them, the random numbers are drawn from numpy's global random state in the same
+    order as in the per-event implementation. To calculate several of these observables,
+    calculate_wgamma_observables() is faster.
+    """
+
+    reco = _reconstruct_neutrino(leptons, photons, met)
+
+    if eta_solution > 0:
+        eta_v = reco['eta_v_plus']
+    elif eta_solution < 0:
+        eta_v = reco['eta_v_minus']
+    else:
+        eta_v = np.where(_pick_plus(reco, leptons), reco['eta_v_plus'], reco['eta_v_minus'])
+
+    return _calculate_phi_in_special_frame(reco, eta_v)
+
+
+def calculate_phi_minus(leptons, photons, jets, met):
+    return calculate_phi(leptons, photons, jets, met, eta_solution=-1)
+
+
+def calculate_phi_plus(leptons, photons, jets, met):
+    return calculate_phi(leptons, photons, jets, met, eta_solution=1)
+
+
+def _pick_plus(reco, leptons):
+    """ Random choice of the plus solution in the "normal" case, from the per-event random numbers if available """
+
+    if leptons.event_random is not None:
+        return reco['normal'] & (leptons.event_random > 0.5)
+
+    pick_plus = np.zeros(len(reco['l']), dtype=np.bool_)
+    pick_plus[reco['normal']] = np.random.rand(np.sum(reco['normal'])) > 0.5
+    return pick_plus
+
+
+def _reconstruct_neutrino(leptons, photons, met):
+    """ W-mass constrained neutrino rapidity, both solutions (identical in the "other" case without solution) """
+
+    l = leptons[0]
+    a = photons[0]
+    valid = l.valid & a.valid
+
+    # Transverse mass and Delta
+    mt = calculate_mt(leptons, photons, None, met)
+    has_pt = (met.pt > 0.) & (l.pt > 0.)
+    deltasq = np.where(has_pt, (MW ** 2 - mt ** 2) / np.where(has_pt, 2. * met.pt * l.pt, 1.), 0.)
+    deltasq = np.where(valid, deltasq, 0.)
+
+    # "Normal" case: two solutions, "other" case: eta_v = eta_l
+    normal = deltasq > 0.
+    deltasq = np.where(normal, deltasq, 0.)
+    temp = np.log(1 + deltasq ** 0.5 * (2 + deltasq) ** 0.5 + deltasq)
+
+    return {
+        'l': l,
+        'a': a,
+        'met': met,
+        'valid': valid,
+        'mt': mt,
+        'normal': normal,
+        'eta_v_plus': l.eta + temp,
+        'eta_v_minus': l.eta - temp,
+    }
+
+
+def _calculate_phi_in_special_frame(reco, eta_v):
+    l, a, met = reco['l'], reco['a'], reco['met']
+
+    # v particle, W and Wgamma reconstruction
+    v = LorentzArray.from_ptetaphim(met.pt, eta_v, met.phi(), np.zeros(len(l)))
+    w = l + v
+    vv = w + a
+
+    # Boost into VV frame
+    l_ = l.boost(vv.boostvector)
+    w_ = w.boost(vv.boostvector)
+    r_ = vv
+
+    # Calculate axes of "special frame" (1708.07823)
+    z_ = w_.vector.unit()
+    x_ = (r_.vector - z_ * r_.vector.dot(z_)).unit()
+    y_ = z_.cross(x_)
+
+    # Calculate x and y components of lepton wrt special x_, y_, z_ system
+    lx_ = l_.vector.dot(x_)
+    ly_ = l_.vector.dot(y_)
+
+    phi = np.arctan2(ly_, lx_)
+
+    return np.where(reco['valid'], phi, np.nan)
@@ -0,0 +1,77 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import logging
+import multiprocessing
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def available_cpus():
+    """
+    Number of CPUs this process may run on. Under a batch system like SLURM, this is the allocation of the job
+    rather than all cores of the node. Falls back to the number of cores where the CPU affinity is not available.
+    """
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def run_in_parallel(fn, tasks, n_workers=1, seed=None):
+    """
+    Calls `fn(**task)` for every task in a local process pool and returns the results in the order of the tasks.
+
+    Before each task, numpy's global random state is seeded with `(seed, i_task)`. Random numbers used in the task
+    (for instance the random neutrino solution in `calculate_phi`) then only depend on the seed and the position of
+    the task in the list, so the results are identical for any number of workers.
+
+    Parameters
+    ----------
+    fn : function
+        Function that processes one task. Has to be defined at module level, so that it can be sent to the worker
+        processes.
+
+    tasks : list of dict
+        Keyword arguments for fn, one dict per task.
+
+    n_workers : int, optional
+        Number of worker processes. With 1, the tasks are processed sequentially in the current process. Default value:
+        1.
+
+    seed : int or None, optional
+        Base seed for the random numbers. If None, the random state is not touched. Default value: None.
+
+    Returns
+    -------
+    results : list
+        Return values of fn for each task.
+
+    """
+
+    jobs = [(fn, task, None if seed is None else [seed, i_task]) for i_task, task in enumerate(tasks)]
+
+    # Worker processes of a pool cannot start their own pool, nested calls run sequentially
+    if n_workers <= 1 or len(jobs) <= 1 or multiprocessing.current_process().daemon:
+        return [_run_task(job) for job in jobs]
+
+    n_workers = min(n_workers, len(jobs))
+    logger.info('Processing %s tasks with %s workers', len(jobs), n_workers)
+
+    pool = multiprocessing.Pool(processes=n_workers)
+    try:
+        results = pool.map(_run_task, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return results
+
+
+def _run_task(job):
+    fn, task, seed = job
+    if seed is not None:
+        np.random.seed(seed)
+    return fn(**task)
@@ -0,0 +1,1700 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import logging
+import shutil
+import six
+from collections import OrderedDict
+import h5py
+import numpy as np
+
+from madminer import sampling as madminer_sampling
+from madminer.sampling import SampleAugmenter as MadMinerSampleAugmenter
+from madminer.utils.interfaces.madminer_hdf5 import madminer_event_loader
+from madminer.utils.analysis import get_theta_value, get_theta_benchmark_matrix, get_dtheta_benchmark_matrix
+from madminer.utils.analysis import calculate_augmented_data, parse_theta, mdot
+from madminer.utils.various import create_missing_folders, balance_thetas
+
+from diboson_mining.cut_bits import has_cut_bits, load_cut_bit_setup, selection_mask, selected_event_loader
+from diboson_mining.cut_bits import selected_events
+from diboson_mining.datasets import NpyWriter, IndexedArray, ContainerWriter, load_container
+from diboson_mining.morphing_cache import morphing_component_factors, cached_observables_and_weights
+from diboson_mining.parallel import run_in_parallel
+
+logger = logging.getLogger(__name__)
+
+
+def combine_and_shuffle(
+    input_filenames,
+    output_filename,
+    k_factors=None,
+    overwrite_existing_file=True,
+    shuffle_sample=True,
+    memory_budget=2.e9,
+    random_state=None,
+):
+    """
+    Combines multiple MadMiner files into one and shuffles the order of the events, like MadMiner's
+    `combine_and_shuffle()`, but in bounded memory.
+
+    The events are read and written in chunks, and the k factors are applied to each chunk on the fly. The shuffling
+    is done out of core in two passes: every event is first assigned to a random bucket, the chunks are scattered
+    into the bucket regions of the output file, and then every bucket is shuffled in memory. Together, this yields a
+    uniformly random permutation of all events, while only one chunk or bucket is in memory at any time.
+
+    As in MadMiner, all samples have to be generated with the same setup (benchmarks, observables), the setup is copied
+    from the first file. If all input files contain cut bits with the same cuts (see
+    `ColumnarDelphesProcessor.add_cut_bit()`), the cut bits are combined and shuffled together with the events.
+
+    Parameters
+    ----------
+    input_filenames : list of str
+        List of paths to the input MadMiner files.
+
+    output_filename : str
+        Path to the combined MadMiner file.
+
+    k_factors : float or list of float, optional
+        Multiplies the weights in input_filenames with a universal factor (if k_factors is a float) or with independent
+        factors (if it is a list of float). Default value: None.
+
+    overwrite_existing_file : bool, optional
+        If True and if the output file exists, it is overwritten. Default value: True.
+
+    shuffle_sample : bool, optional
+        If True, the output shuffle will be shuffled. Default value: True.
+
+    memory_budget : float, optional
+        Approximate maximal memory (in bytes) used for event data. Default value: 2.e9.
+
+    random_state : numpy.random.RandomState or None, optional
+        Random state for the shuffling. If None, numpy's global random state is used. Default value: None.
+
+    Returns
+    -------
+        None
+
+    """
+
+    logger.debug('Combining and shuffling samples')
+
+    if len(input_filenames) > 1:
+        logger.warning(
+            'Careful: this tool assumes that all samples are generated with the same setup, including'
+            ' identical benchmarks (and thus morphing setup). If it is used with samples with different'
+            ' settings, there will be wrong results! There are no explicit cross checks in place yet.'
+        )
+
+    # k factors
+    if k_factors is None:
+        k_factors = [1. for _ in input_filenames]
+    elif isinstance(k_factors, (float, int)):
+        k_factors = [float(k_factors) for _ in input_filenames]
+
+    if random_state is None:
+        random_state = np.random
+
+    # Sizes
+    n_samples_per_file = []
+    n_observables, n_weights = None, None
+    for filename in input_filenames:
+        with h5py.File(filename, 'r') as f:
+            n_samples_per_file.append(f['samples/observations'].shape[0])
+            n_observables = f['samples/observations'].shape[1]
+            n_weights = f['samples/weights'].shape[1]
+    n_samples = sum(n_samples_per_file)
+
+    with_cut_bits = all(has_cut_bits(filename) for filename in input_filenames)
+    if with_cut_bits and any(
+        load_cut_bit_setup(filename)[0] != load_cut_bit_setup(input_filenames[0])[0] for filename in input_filenames
+    ):
+        logger.warning('Input files have different cut bits, the cut bits are not combined')
+        with_cut_bits = False
+
+    # Two copies of a chunk / bucket can be in memory at the same time
+    bytes_per_event = 8 * (n_observables + n_weights + int(with_cut_bits))
+    chunk_size = max(1, int(memory_budget / (2 * bytes_per_event)))
+    n_buckets = max(1, int(np.ceil(n_samples / chunk_size))) if shuffle_sample else 1
+    logger.info(
+        'Combining %s events from %s files in chunks of %s events and %s buckets',
+        n_samples,
+        len(input_filenames),
+        chunk_size,
+        n_buckets,
+    )
+
+    # Random bucket for each event, each bucket is a contiguous region of the output
+    if shuffle_sample:
+        buckets = random_state.randint(n_buckets, size=n_samples).astype(np.min_scalar_type(n_buckets))
+        bucket_sizes = np.bincount(buckets, minlength=n_buckets)
+    else:
+        buckets = None
+        bucket_sizes = np.array([n_samples])
+    bucket_ends = np.cumsum(bucket_sizes)
+    bucket_positions = bucket_ends - bucket_sizes
+
+    # Copy setup from first file
+    logger.info('Copying setup from %s to %s', input_filenames[0], output_filename)
+    try:
+        shutil.copyfile(input_filenames[0], output_filename)
+    except IOError:
+        if not overwrite_existing_file:
+            raise
+
+    with h5py.File(output_filename, 'a') as f_out:
+        if 'samples' in f_out:
+            del f_out['samples']
+        if not with_cut_bits and 'cut_bits' in f_out:
+            del f_out['cut_bits']
+        observations_out = f_out.create_dataset('samples/observations', (n_samples, n_observables), dtype=np.float64)
+        weights_out = f_out.create_dataset('samples/weights', (n_samples, n_weights), dtype=np.float64)
+        cut_bits_out = None
+        if with_cut_bits:
+            cut_bits_out = f_out.create_dataset('samples/cut_bits', (n_samples,), dtype=np.uint64)
+
+        # First pass: chunked reads, k factors, scatter into buckets
+        offset = 0
+        for i, (filename, k_factor, n_samples_this_file) in enumerate(
+            zip(input_filenames, k_factors, n_samples_per_file)
+        ):
+            logger.info(
+                'Loading samples from file %s / %s at %s, multiplying weights with k factor %s',
+                i + 1,
+                len(input_filenames),
+                filename,
+                k_factor,
+            )
+
+            with h5py.File(filename, 'r') as f_in:
+                for start in range(0, n_samples_this_file, chunk_size):
+                    end = min(start + chunk_size, n_samples_this_file)
+                    observations = f_in['samples/observations'][start:end]
+                    weights = k_factor * f_in['samples/weights'][start:end]
+                    cut_bits = None if cut_bits_out is None else f_in['samples/cut_bits'][start:end]
+
+                    if buckets is None:
+                        chunk_buckets = np.zeros(end - start, dtype=np.intp)
+                    else:
+                        chunk_buckets = buckets[offset + start : offset + end]
+
+                    order = np.argsort(chunk_buckets, kind='mergesort')
+                    chunk_bucket_sizes = np.bincount(chunk_buckets, minlength=n_buckets)
+                    chunk_bucket_ends = np.cumsum(chunk_bucket_sizes)
+
+                    for bucket in np.flatnonzero(chunk_bucket_sizes):
+                        rows = order[chunk_bucket_ends[bucket] - chunk_bucket_sizes[bucket] : chunk_bucket_ends[bucket]]
+                        position = bucket_positions[bucket]
+                        observations_out[position : position + len(rows)] = observations[rows]
+                        weights_out[position : position + len(rows)] = weights[rows]
+                        if cut_bits_out is not None:
+                            cut_bits_out[position : position + len(rows)] = cut_bits[rows]
+                        bucket_positions[bucket] += len(rows)
+
+            offset += n_samples_this_file
+
+        # Second pass: shuffle each bucket in memory
+        if shuffle_sample:
+            for bucket_start, bucket_end in zip(bucket_ends - bucket_sizes, bucket_ends):
+                if bucket_end - bucket_start <= 1:
+                    continue
+                permutation = random_state.permutation(bucket_end - bucket_start)
+                observations_out[bucket_start:bucket_end] = observations_out[bucket_start:bucket_end][permutation]
+                weights_out[bucket_start:bucket_end] = weights_out[bucket_start:bucket_end][permutation]
+                if cut_bits_out is not None:
+                    cut_bits_out[bucket_start:bucket_end] = cut_bits_out[bucket_start:bucket_end][permutation]
+
+
+def extract_cross_sections(filenames, theta, n_workers=1, **kwargs):
+    """
+    Calculates the total cross sections for the same thetas in several MadMiner files (for instance with different
+    cuts), in parallel with `SampleAugmenter.extract_cross_sections()`.
+
+    Parameter points drawn from a prior are drawn once, so all files use the same thetas.
+
+    Parameters
+    ----------
+    filenames : list of str
+        Paths to the MadMiner files.
+
+    theta : tuple
+        Parameter points, see `SampleAugmenter.extract_cross_sections()`.
+
+    n_workers : int, optional
+        Number of worker processes, at most one per file. Default value: 1.
+
+    kwargs
+        Further keyword arguments for `SampleAugmenter`, for instance include_nuisance_parameters.
+
+    Returns
+    -------
+    results : list of tuple
+        Tuple (thetas, xsecs, xsec_uncertainties) for each file.
+
+    """
+
+    if theta[0] == 'random':
+        _, theta_values, _ = parse_theta(theta, 1)
+        theta = ('thetas', theta_values)
+
+    tasks = [dict(filename=filename, theta=theta, kwargs=kwargs) for filename in filenames]
+    return run_in_parallel(_extract_cross_sections, tasks, n_workers=n_workers)
+
+
+def _extract_cross_sections(filename, theta, kwargs):
+    return SampleAugmenter(filename, **kwargs).extract_cross_sections(theta)
+
+
+def importance_weights(thetas, prior, proposal):
+    """
+    Importance weights `w = p(theta) / q(theta)` that turn samples with parameter points drawn from a proposal prior q
+    into samples for another prior p. With these weights, training samples extracted once from a broad proposal can
+    be reused for any narrower prior (see `MLForge.train(w_filename=...)`).
+
+    Parameters
+    ----------
+    thetas : ndarray
+        Parameter points with shape `(n_samples, n_parameters)`, for instance theta0 of training samples.
+
+    prior : tuple or list
+        Target prior, either as output of `random_morphing_thetas()` or as list with one `('gaussian', mean, std)` or
+        `('flat', min, max)` per parameter.
+
+    proposal : tuple or list
+        Prior from which thetas were drawn, in the same format.
+
+    Returns
+    -------
+    weights : ndarray
+        Importance weights normalized to mean one with shape `(n_samples,)`.
+
+    """
+
+    thetas = np.asarray(thetas, dtype=np.float64).reshape((len(thetas), -1))
+
+    log_q = _log_prior_density(proposal, thetas)
+    if not np.all(np.isfinite(log_q)):
+        raise ValueError('Some parameter points have zero density under the proposal')
+
+    log_weights = _log_prior_density(prior, thetas) - log_q
+    if not np.any(np.isfinite(log_weights)):
+        raise ValueError('No parameter point has a positive density under the target prior')
+
+    weights = np.exp(log_weights - np.max(log_weights))
+    weights /= np.mean(weights)
+
+    logger.debug(
+        'Importance weights for %s samples: effective sample size %s',
+        len(weights),
+        len(weights) / np.mean(weights ** 2),
+    )
+
+    return weights
+
+
+def _log_prior_density(prior, thetas):
+    """ Log density of a prior (see `importance_weights()`) at thetas with shape (n_samples, n_parameters) """
+
+    if prior[0] == 'random':
+        _, priors = prior[1]
+    else:
+        priors = prior
+
+    if len(priors) != thetas.shape[1]:
+        raise ValueError('Prior with {} parameters for thetas with {} parameters'.format(len(priors), thetas.shape[1]))
+
+    log_density = np.zeros(len(thetas))
+    for theta, parameter_prior in zip(thetas.T, priors):
+        if parameter_prior[0] == 'gaussian':
+            _, mean, std = parameter_prior
+            log_density += -0.5 * ((theta - mean) / std) ** 2 - np.log(std * (2. * np.pi) ** 0.5)
+        elif parameter_prior[0] == 'flat':
+            _, prior_min, prior_max = parameter_prior
+            inside = (theta >= prior_min) & (theta <= prior_max)
+            log_density += np.where(inside, -np.log(prior_max - prior_min), -np.inf)
+        else:
+            raise ValueError('Unknown prior {}'.format(parameter_prior))
+
+    return log_density
+
+
+class SampleAugmenter(MadMinerSampleAugmenter):
+    """
+    SampleAugmenter that can extract several independent training samples ("splits") in one call.
+
+    With `n_splits`, `extract_samples_train_local()`, `extract_samples_train_global()`, and
+    `extract_samples_train_ratio()` load the events only once, calculate the event weights (and the nuisance scores)
+    for each parameter point only once, and draw the samples for all splits from these weights. The splits are saved
+    as `<filename>_0`, `<filename>_1`, etc. If the parameter points are drawn from a prior, all splits share the same
+    parameter points, but the events are drawn independently for each split. Events are drawn with alias tables,
+    which are built together for batches of parameter points and shared between sets with the same sampling theta.
+
+    With `chunk_size`, the samples are written to the .npy files chunk by chunk instead of being built in memory,
+    which also works for a single sample.
+
+    With `index_only`, the observables and parameter points are not copied into every sample. Instead, the events
+    and parameter points are saved once as tables (`x_table_<filename>.npy`, `theta_table_<filename>.npy`, ...) and
+    each split only stores which row of the tables every sample uses (`x_index_<filename>_<i>.npy`, ...), next to the
+    per-sample labels. `diboson_mining.datasets.load_samples()` loads such samples and resolves the rows lazily.
+
+    With `container`, each split is saved as a single HDF5 file `<filename>.h5` (or `<filename>_<i>.h5`) with chunked
+    arrays and a manifest that lists the arrays with their dtypes and shapes and records the provenance of the
+    samples (source file, theta sampler, event range, plus the provenance argument, for instance the cuts). The
+    samples in a container are shuffled. `diboson_mining.datasets.load_container()` loads containers lazily, and
+    `diboson_mining.ml.MLForge.train()` accepts them directly.
+
+    `stream_samples_train_local()` and `stream_samples_train_ratio()` do not save anything, but yield an unlimited
+    stream of freshly drawn minibatches, which `diboson_mining.ml.MLForge.train()` can train on directly.
+
+    With `selection`, only the events passing a selection on the cut bits stored in the file (see
+    `ColumnarDelphesProcessor.add_cut_bit()`) are used, so that for instance tight and anti-tight samples can be
+    extracted from one loose sample file. This applies to all methods, including the ones inherited from MadMiner.
+
+    Without `n_splits`, `chunk_size`, `index_only`, `container`, and `selection`, everything works exactly like in
+    MadMiner's `SampleAugmenter`.
+
+    Parameters
+    ----------
+    filename : str
+        Path to MadMiner file (for instance the output of `ColumnarDelphesProcessor.save()`).
+
+    disable_morphing : bool, optional
+        If True, the morphing setup is not loaded from the file. Default value: False.
+
+    include_nuisance_parameters : bool, optional
+        If True, nuisance parameters are taken into account. Default value: True.
+
+    morphing_cache : MorphingWeightCache or None, optional
+        If not None, `extract_raw_data()` calculates the event weights at morphing parameter points from the morphing
+        component weights stored in this cache, without reading the benchmark weights. Default value: None.
+
+    memory_budget : float, optional
+        Approximate memory (in bytes) for the alias tables of the sampling thetas that are processed together.
+        Default value: 2.e9.
+
+    provenance : dict or None, optional
+        Additional provenance information stored in sample containers, for instance `{'cuts': 'tight'}`. Default
+        value: None.
+
+    selection : str or None, optional
+        If not None, only the events passing this selection are used. A selection stored in the file, a cut bit, or
+        an expression of them, see `diboson_mining.cut_bits.selection_mask()`. Default value: None.
+
+    """
+
+    def __init__(
+        self,
+        filename,
+        disable_morphing=False,
+        include_nuisance_parameters=True,
+        morphing_cache=None,
+        memory_budget=2.e9,
+        provenance=None,
+        selection=None,
+    ):
+        super(SampleAugmenter, self).__init__(
+            filename, disable_morphing=disable_morphing, include_nuisance_parameters=include_nuisance_parameters
+        )
+        self.morphing_cache = morphing_cache
+        self.memory_budget = memory_budget
+        self.provenance = provenance if provenance is not None else {}
+        self._benchmark_sums = None
+
+        self.selection = selection
+        self.selection_mask = None
+        if selection is not None:
+            self.selection_mask = selection_mask(filename, selection)
+            logger.info(
+                'Using the %s / %s events passing selection %s', np.sum(self.selection_mask), self.n_samples, selection
+            )
+
+    def extract_samples_train_plain(self, *args, **kwargs):
+        """ MadMiner's `SampleAugmenter.extract_samples_train_plain()`, restricted to the selected events """
+
+        with self._selected_events():
+            return super(SampleAugmenter, self).extract_samples_train_plain(*args, **kwargs)
+
+    def extract_samples_train_local(
+        self,
+        theta,
+        n_samples,
+        folder,
+        filename,
+        nuisance_score=False,
+        test_split=0.5,
+        switch_train_test_events=False,
+        log_message=True,
+        n_splits=None,
+        chunk_size=None,
+        index_only=False,
+        container=False,
+        target_prior=None,
+    ):
+        """
+        Extracts training samples x ~ p(x|theta) as well as the joint score t(x, z|theta). See MadMiner's
+        `SampleAugmenter.extract_samples_train_local()` for the other parameters.
+
+        Parameters
+        ----------
+        n_splits : int or None, optional
+            If not None, this many independent samples with n_samples events each are extracted in one pass and
+            saved with filenames `<filename>_<i>`. Default value: None.
+
+        chunk_size : int or None, optional
+            If not None, the samples are built and written to the .npy files in chunks of this many samples, so that
+            the memory use does not grow with n_samples (apart from the indices of the drawn events). The returned
+            arrays are then read-only memory maps of the files. Default value: None.
+
+        index_only : bool, optional
+            If True, only the indices of the drawn events and parameter points are saved for each sample, together
+            with shared tables of the events and parameter points (see the class documentation). The returned
+            observables and parameter points are then `IndexedArray` instances. Default value: False.
+
+        container : bool, optional
+            If True, each sample is saved as a single HDF5 container `<folder>/<filename>.h5` (see the class
+            documentation) instead of separate .npy files, and the returned arrays are read lazily from it. Default
+            value: False.
+
+        target_prior : tuple or list or None, optional
+            If not None, theta has to be sampled from a prior (the proposal), and the importance weights
+            `p(theta) / q(theta)` of each sample for this target prior are saved as `w_<filename>.npy` (or as array
+            'w' in containers), see `importance_weights()`. Default value: None.
+
+        Returns
+        -------
+        x, theta, t_xz : ndarray
+            If n_splits is None, observables, parameter points, and joint score. Otherwise a list with one tuple
+            (x, theta, t_xz) per split. With target_prior, the tuples also contain the importance weights w.
+
+        """
+
+        if n_splits is None and chunk_size is None and not index_only and not container and target_prior is None:
+            with self._selected_events():
+                return super(SampleAugmenter, self).extract_samples_train_local(
+                    theta,
+                    n_samples,
+                    folder,
+                    filename,
+                    nuisance_score=nuisance_score,
+                    test_split=test_split,
+                    switch_train_test_events=switch_train_test_events,
+                    log_message=log_message,
+                )
+
+        if log_message:
+            logger.info(
+                'Extracting %s training sample(s) for local score regression. Sampling and score evaluation according '
+                'to %s',
+                n_splits or 1,
+                theta,
+            )
+
+        if (index_only or container) and (folder is None or filename is None):
+            raise ValueError('Samples with index_only=True or container=True have to be saved to a folder')
+        if target_prior is not None and theta[0] != 'random':
+            raise ValueError('Importance weights need parameter points sampled from a prior')
+
+        create_missing_folders([folder])
+
+        if self.morpher is None:
+            raise RuntimeError('No morphing setup loaded. Cannot calculate score.')
+        if self.nuisance_morpher is None and nuisance_score:
+            raise RuntimeError('No nuisance parameters defined. Cannot calculate nuisance score.')
+
+        theta_types, theta_values, n_samples_per_theta = parse_theta(theta, n_samples)
+
+        augmented_data_definitions = [('score', 0)]
+        if nuisance_score:
+            augmented_data_definitions += [('nuisance_score',)]
+
+        start_event, end_event = self._train_test_split(not switch_train_test_events, test_split)
+
+        source, indices = self._extract_splits(
+            n_splits=n_splits or 1,
+            theta_sets_types=[theta_types],
+            theta_sets_values=[theta_values],
+            n_samples_per_theta=n_samples_per_theta,
+            augmented_data_definitions=augmented_data_definitions,
+            start_event=start_event,
+            end_event=end_event,
+        )
+        sets = _set_labels(indices)
+        set_weights = None
+        if target_prior is not None:
+            set_weights = importance_weights(source.thetas[0], target_prior, theta)
+
+        if index_only:
+            tables = _save_tables(
+                folder, filename, OrderedDict([('theta', source.thetas[0]), ('x', source.x_events)]), container
+            )
+
+        provenance = self._provenance(
+            'train_local',
+            theta=theta,
+            n_samples=n_samples,
+            nuisance_score=nuisance_score,
+            events=[start_event, end_event],
+            target_prior=target_prior,
+        )
+
+        results = []
+        for i_split, (split_filename, split_indices) in enumerate(zip(_split_filenames(filename, n_splits), indices)):
+            split_indices = split_indices.flatten()
+
+            # The samples are ordered by set, containers are read in chunks during training and should be shuffled
+            permutation = np.random.permutation(len(split_indices)) if container else None
+
+            def make_chunk(rows):
+                if permutation is not None:
+                    rows = permutation[rows]
+
+                if index_only:
+                    augmented_data = source.augmented_data(split_indices[rows], sets[rows])
+                    chunk = OrderedDict(
+                        [
+                            ('theta_index', sets[rows]),
+                            ('x_index', split_indices[rows]),
+                            ('t_xz', np.hstack(augmented_data)),
+                        ]
+                    )
+                else:
+                    x, augmented_data, (thetas,) = source.samples(split_indices[rows], sets[rows])
+                    chunk = OrderedDict([('theta', thetas), ('x', x), ('t_xz', np.hstack(augmented_data))])
+
+                if set_weights is not None:
+                    chunk['w'] = set_weights[sets[rows]].reshape((-1, 1))
+                return chunk
+
+            samples = _save_samples(
+                folder,
+                split_filename,
+                len(split_indices),
+                make_chunk,
+                chunk_size,
+                container=container,
+                provenance=_split_provenance(provenance, i_split, n_splits),
+                tables_filename=filename if index_only else None,
+            )
+            if index_only and not container:
+                samples = _resolve_indices(samples, tables)
+            if target_prior is not None:
+                results.append((samples['x'], samples['theta'], samples['t_xz'], samples['w']))
+            else:
+                results.append((samples['x'], samples['theta'], samples['t_xz']))
+
+        return results[0] if n_splits is None else results
+
+    def extract_samples_train_global(
+        self,
+        theta,
+        n_samples,
+        folder,
+        filename,
+        test_split=0.5,
+        switch_train_test_events=False,
+        n_splits=None,
+        chunk_size=None,
+        index_only=False,
+        container=False,
+        target_prior=None,
+    ):
+        """
+        Extracts training samples x ~ p(x|theta) as well as the joint score t(x, z|theta), where theta is sampled
+        from a prior. See `extract_samples_train_local()` for n_splits, chunk_size, index_only, container, and
+        target_prior and MadMiner's `SampleAugmenter.extract_samples_train_global()` for the other parameters.
+        """
+
+        if n_splits is None and chunk_size is None and not index_only and not container and target_prior is None:
+            with self._selected_events():
+                return super(SampleAugmenter, self).extract_samples_train_global(
+                    theta,
+                    n_samples,
+                    folder,
+                    filename,
+                    test_split=test_split,
+                    switch_train_test_events=switch_train_test_events,
+                )
+
+        logger.info(
+            'Extracting %s training sample(s) for non-local score-based methods. Sampling and score evaluation '
+            'according to %s',
+            n_splits or 1,
+            theta,
+        )
+
+        return self.extract_samples_train_local(
+            theta,
+            n_samples,
+            folder,
+            filename,
+            test_split=test_split,
+            switch_train_test_events=switch_train_test_events,
+            log_message=False,
+            n_splits=n_splits,
+            chunk_size=chunk_size,
+            index_only=index_only,
+            container=container,
+            target_prior=target_prior,
+        )
+
+    def extract_samples_train_ratio(
+        self,
+        theta0,
+        theta1,
+        n_samples,
+        folder,
+        filename,
+        test_split=0.5,
+        switch_train_test_events=False,
+        n_splits=None,
+        chunk_size=None,
+        index_only=False,
+        container=False,
+        target_prior=None,
+    ):
+        """
+        Extracts training samples `x ~ p(x|theta0)` and `x ~ p(x|theta1)` together with the class label `y`, the joint
+        likelihood ratio `r(x,z|theta0, theta1)`, and, if morphing is set up, the joint score `t(x,z|theta0)`. See
+        MadMiner's `SampleAugmenter.extract_samples_train_ratio()` for the other parameters.
+
+        Parameters
+        ----------
+        n_splits : int or None, optional
+            If not None, this many independent samples with n_samples events each are extracted in one pass and
+            saved with filenames `<filename>_<i>`. Default value: None.
+
+        chunk_size : int or None, optional
+            If not None, the samples are built and written to the .npy files in chunks of this many samples, so that
+            the memory use does not grow with n_samples (apart from the indices of the drawn events). The returned
+            arrays are then read-only memory maps of the files. Default value: None.
+
+        index_only : bool, optional
+            If True, only the indices of the drawn events and parameter points are saved for each sample, together
+            with shared tables of the events and parameter points (see the class documentation). The returned
+            observables and parameter points are then `IndexedArray` instances. Default value: False.
+
+        container : bool, optional
+            If True, each sample is saved as a single HDF5 container `<folder>/<filename>.h5` (see the class
+            documentation) instead of separate .npy files, and the returned arrays are read lazily from it. Default
+            value: False.
+
+        target_prior : tuple or list or None, optional
+            If not None, theta0 has to be sampled from a prior (the proposal), and the importance weights
+            `p(theta0) / q(theta0)` of each sample for this target prior are saved as `w_<filename>.npy` (or as array
+            'w' in containers), see `importance_weights()`. Default value: None.
+
+        Returns
+        -------
+        x, theta0, theta1, y, r_xz, t_xz : ndarray
+            If n_splits is None, observables, numerator and denominator parameter points, class label, joint
+            likelihood ratio, and joint score (or None). Otherwise a list with one such tuple per split. With
+            target_prior, the tuples also contain the importance weights w.
+
+        """
+
+        if n_splits is None and chunk_size is None and not index_only and not container and target_prior is None:
+            with self._selected_events():
+                return super(SampleAugmenter, self).extract_samples_train_ratio(
+                    theta0,
+                    theta1,
+                    n_samples,
+                    folder,
+                    filename,
+                    test_split=test_split,
+                    switch_train_test_events=switch_train_test_events,
+                )
+
+        logger.info(
+            'Extracting %s training sample(s) for ratio-based methods. Numerator hypothesis: %s, denominator '
+            'hypothesis: %s',
+            n_splits or 1,
+            theta0,
+            theta1,
+        )
+
+        if self.morpher is None:
+            logger.warning('No morphing setup loaded. Cannot calculate joint score.')
+        if (index_only or container) and (folder is None or filename is None):
+            raise ValueError('Samples with index_only=True or container=True have to be saved to a folder')
+        if target_prior is not None and theta0[0] != 'random':
+            raise ValueError('Importance weights need parameter points theta0 sampled from a prior')
+
+        create_missing_folders([folder])
+
+        augmented_data_definitions = [('ratio', 0, 1)]
+        if self.morpher is not None:
+            augmented_data_definitions.append(('score', 0))
+
+        start_event, end_event = self._train_test_split(not switch_train_test_events, test_split)
+
+        sources, part_indices = self._extract_ratio_parts(
+            theta0,
+            theta1,
+            n_samples,
+            n_splits or 1,
+            augmented_data_definitions,
+            start_event,
+            end_event,
+            events=self._load_events(start_event, end_event),
+        )
+
+        sets0, sets1 = [_set_labels(indices) for indices in part_indices]
+        source0, source1 = sources
+
+        # Both parts use the same events, the parameter points of the second part follow those of the first part
+        n_sets0 = len(source0.thetas[0])
+        set_weights = None
+        if target_prior is not None:
+            weights = importance_weights(np.vstack((source0.thetas[0], source1.thetas[0])), target_prior, theta0)
+            set_weights = (weights[:n_sets0], weights[n_sets0:])
+        if index_only:
+            tables = _save_tables(
+                folder,
+                filename,
+                OrderedDict(
+                    [
+                        ('theta0', np.vstack((source0.thetas[0], source1.thetas[0]))),
+                        ('theta1', np.vstack((source0.thetas[1], source1.thetas[1]))),
+                        ('x', source0.x_events),
+                    ]
+                ),
+                container,
+            )
+
+        provenance = self._provenance(
+            'train_ratio',
+            theta0=theta0,
+            theta1=theta1,
+            n_samples=n_samples,
+            events=[start_event, end_event],
+            target_prior=target_prior,
+        )
+
+        results = []
+        for i_split, (split_filename, indices0, indices1) in enumerate(
+            zip(_split_filenames(filename, n_splits), *part_indices)
+        ):
+            indices0, indices1 = indices0.flatten(), indices1.flatten()
+            n0, n_split_samples = len(indices0), len(indices0) + len(indices1)
+
+            # Same as stacking the samples from theta0 and theta1 and shuffling them
+            permutation = np.random.permutation(n_split_samples)
+
+            def make_chunk(rows):
+                return _ratio_chunk(
+                    permutation[rows],
+                    n0,
+                    sources,
+                    (indices0, indices1),
+                    (sets0, sets1),
+                    with_score=self.morpher is not None,
+                    index_only=index_only,
+                    n_sets0=n_sets0,
+                    set_weights=set_weights,
+                )
+
+            samples = _save_samples(
+                folder,
+                split_filename,
+                n_split_samples,
+                make_chunk,
+                chunk_size,
+                container=container,
+                provenance=_split_provenance(provenance, i_split, n_splits),
+                tables_filename=filename if index_only else None,
+            )
+            if index_only and not container:
+                samples = _resolve_indices(samples, tables)
+            result = (
+                samples['x'],
+                samples['theta0'],
+                samples['theta1'],
+                samples['y'],
+                samples['r_xz'],
+                samples.get('t_xz'),
+            )
+            if target_prior is not None:
+                result += (samples['w'],)
+            results.append(result)
+
+        return results[0] if n_splits is None else results
+
+    def extract_samples_train_more_ratios(self, *args, **kwargs):
+        """ MadMiner's `SampleAugmenter.extract_samples_train_more_ratios()`, restricted to the selected events """
+
+        with self._selected_events():
+            return super(SampleAugmenter, self).extract_samples_train_more_ratios(*args, **kwargs)
+
+    def extract_samples_test(self, *args, **kwargs):
+        """ MadMiner's `SampleAugmenter.extract_samples_test()`, restricted to the selected events """
+
+        with self._selected_events():
+            return super(SampleAugmenter, self).extract_samples_test(*args, **kwargs)
+
+    def extract_raw_data(self, theta=None, derivative=False):
+        """
+        MadMiner's `SampleAugmenter.extract_raw_data()`, restricted to the selected events. With a morphing cache,
+        the weights at a morphing parameter point theta are calculated from the cached morphing component weights.
+        """
+
+        if self.morphing_cache is not None and self.morpher is not None and _is_morphing_point(theta, derivative):
+            x, weights = cached_observables_and_weights(
+                self.morphing_cache,
+                self.madminer_filename,
+                self.morpher,
+                np.asarray(theta, dtype=np.float64).reshape((1, -1)),
+                mask=self.selection_mask,
+            )
+            return x, weights[0]
+
+        with self._selected_events():
+            return super(SampleAugmenter, self).extract_raw_data(theta, derivative)
+
+    def extract_cross_sections(self, theta):
+        """
+        Calculates the total cross sections for all specified thetas, like MadMiner's
+        `SampleAugmenter.extract_cross_sections()`.
+
+        The sums of the weights and of the squared weights of all benchmarks (including the nuisance benchmarks) are
+        calculated in one pass over the events when they are first needed and then reused. For morphing parameter
+        points, the benchmark coefficients of all thetas are a single product of the morphing components with shape
+        `(n_thetas, n_components)` and the morphing matrix, so that any number of thetas costs about as much as one.
+
+        Parameters
+        ----------
+        theta : tuple
+            Tuple (type, value) that defines the parameter point or prior over parameter points at which the cross
+            section is calculated. Pass the output of the functions `constant_benchmark_theta()`,
+            `multiple_benchmark_thetas()`, `constant_morphing_theta()`, `multiple_morphing_thetas()`, or
+            `random_morphing_thetas()`.
+
+        Returns
+        -------
+        thetas : ndarray
+            Parameter points with shape `(n_thetas, n_parameters)`.
+
+        xsecs : ndarray
+            Total cross sections in pb with shape `(n_thetas, )`.
+
+        xsec_uncertainties : ndarray
+            Statistical uncertainties on the total cross sections in pb with shape `(n_thetas, )`.
+
+        """
+
+        logger.info('Starting cross-section calculation')
+
+        xsecs_benchmarks, squared_weight_sum_benchmarks = self._calculate_benchmark_sums()
+
+        theta_types, theta_values, _ = parse_theta(theta, 1)
+        if self.morpher is None and 'morphing' in theta_types:
+            raise RuntimeError('Theta defined through morphing, but no morphing setup has been loaded.')
+
+        thetas = np.array([get_theta_value(t, v, self.benchmarks) for t, v in zip(theta_types, theta_values)])
+
+        # Benchmark coefficients of all thetas, shape (n_thetas, n_benchmarks)
+        theta_matrices = np.zeros((len(theta_types), len(self.benchmarks)))
+        is_morphing = np.array([theta_type == 'morphing' for theta_type in theta_types], dtype=bool)
+        for i, (theta_type, theta_value) in enumerate(zip(theta_types, theta_values)):
+            if theta_type != 'morphing':
+                theta_matrices[i] = get_theta_benchmark_matrix(theta_type, theta_value, self.benchmarks)
+        if np.any(is_morphing):
+            morphing_matrix = self.morpher.morphing_matrix  # Shape (n_components, n_benchmarks_phys)
+            factors = morphing_component_factors(self.morpher, thetas[is_morphing])
+            theta_matrices[is_morphing, : morphing_matrix.shape[1]] = factors.dot(morphing_matrix)
+
+        xsecs = mdot(theta_matrices, xsecs_benchmarks)
+        xsec_uncertainties = mdot(theta_matrices ** 2, squared_weight_sum_benchmarks) ** 0.5
+
+        logger.debug('Calculated cross sections for %s thetas', len(thetas))
+
+        return thetas, xsecs, xsec_uncertainties
+
+    def stream_samples_train_local(
+        self,
+        theta,
+        batch_size=128,
+        buffer_size=100000,
+        n_batches=None,
+        nuisance_score=False,
+        test_split=0.5,
+        switch_train_test_events=False,
+    ):
+        """
+        Generator that yields fresh minibatches of the samples of `extract_samples_train_local()` (or, with a prior
+        for theta, of `extract_samples_train_global()`) without saving them.
+
+        The events are loaded once. The samples are then drawn in rounds of buffer_size samples, which are shuffled
+        and split into minibatches. Every round draws new events and, if theta is sampled from a prior, new parameter
+        points, so the generator never repeats itself. See MadMiner's `SampleAugmenter.extract_samples_train_local()`
+        for the other parameters.
+
+        Parameters
+        ----------
+        batch_size : int, optional
+            Number of samples per minibatch. Default value: 128.
+
+        buffer_size : int, optional
+            Number of samples drawn in each round. Larger rounds amortize the cost of building the alias tables for
+            all parameter points. Samples at the end of a round that do not fill a minibatch are used in the next
+            round. Default value: 100000.
+
+        n_batches : int or None, optional
+            Number of minibatches after which the generator stops. If None, it never stops. Default value: None.
+
+        Yields
+        ------
+        batch : OrderedDict
+            Minibatch with the arrays 'theta', 'x', and 't_xz', as in the sample containers.
+
+        """
+
+        logger.info('Streaming training samples for local score regression, sampling according to %s', theta)
+
+        if self.morpher is None:
+            raise RuntimeError('No morphing setup loaded. Cannot calculate score.')
+        if self.nuisance_morpher is None and nuisance_score:
+            raise RuntimeError('No nuisance parameters defined. Cannot calculate nuisance score.')
+
+        augmented_data_definitions = [('score', 0)]
+        if nuisance_score:
+            augmented_data_definitions += [('nuisance_score',)]
+
+        start_event, end_event = self._train_test_split(not switch_train_test_events, test_split)
+        events = self._load_events(start_event, end_event)
+
+        def draw_round():
+            theta_types, theta_values, n_samples_per_theta = parse_theta(theta, buffer_size)
+            source, indices = self._extract_splits(
+                n_splits=1,
+                theta_sets_types=[theta_types],
+                theta_sets_values=[theta_values],
+                n_samples_per_theta=n_samples_per_theta,
+                augmented_data_definitions=augmented_data_definitions,
+                start_event=start_event,
+                end_event=end_event,
+                events=events,
+            )
+            sets, indices = _set_labels(indices), indices.flatten()
+            rows = np.random.permutation(len(indices))
+            x, augmented_data, (thetas,) = source.samples(indices[rows], sets[rows])
+            return OrderedDict([('theta', thetas), ('x', x), ('t_xz', np.hstack(augmented_data))])
+
+        return _stream_batches(draw_round, batch_size, n_batches)
+
+    def stream_samples_train_ratio(
+        self,
+        theta0,
+        theta1,
+        batch_size=128,
+        buffer_size=100000,
+        n_batches=None,
+        test_split=0.5,
+        switch_train_test_events=False,
+    ):
+        """
+        Generator that yields fresh minibatches of the samples of `extract_samples_train_ratio()` without saving
+        them. See `stream_samples_train_local()` for how the samples are drawn and for batch_size, buffer_size, and
+        n_batches, and MadMiner's `SampleAugmenter.extract_samples_train_ratio()` for the other parameters.
+
+        Yields
+        ------
+        batch : OrderedDict
+            Minibatch with the arrays 'theta0', 'theta1', 'x', 'y', 'r_xz', and, if morphing is set up, 't_xz', as in
+            the sample containers.
+
+        """
+
+        logger.info(
+            'Streaming training samples for ratio-based methods. Numerator hypothesis: %s, denominator hypothesis: %s',
+            theta0,
+            theta1,
+        )
+
+        if self.morpher is None:
+            logger.warning('No morphing setup loaded. Cannot calculate joint score.')
+
+        augmented_data_definitions = [('ratio', 0, 1)]
+        if self.morpher is not None:
+            augmented_data_definitions.append(('score', 0))
+
+        start_event, end_event = self._train_test_split(not switch_train_test_events, test_split)
+        events = self._load_events(start_event, end_event)
+
+        def draw_round():
+            sources, (indices0, indices1) = self._extract_ratio_parts(
+                theta0, theta1, buffer_size, 1, augmented_data_definitions, start_event, end_event, events=events
+            )
+            sets = (_set_labels(indices0), _set_labels(indices1))
+            indices0, indices1 = indices0.flatten(), indices1.flatten()
+            rows = np.random.permutation(len(indices0) + len(indices1))
+            return _ratio_chunk(
+                rows, len(indices0), sources, (indices0, indices1), sets, with_score=self.morpher is not None
+            )
+
+        return _stream_batches(draw_round, batch_size, n_batches)
+
+    def _calculate_benchmark_sums(self):
+        """ Sums of the weights and of the squared weights of all benchmarks, calculated once per instance """
+
+        if self._benchmark_sums is None:
+            xsecs_benchmarks, squared_weight_sum_benchmarks = 0., 0.
+            for _, weights in self._event_loader():
+                xsecs_benchmarks = xsecs_benchmarks + np.sum(weights, axis=0)
+                squared_weight_sum_benchmarks = squared_weight_sum_benchmarks + np.sum(weights ** 2, axis=0)
+            self._benchmark_sums = (xsecs_benchmarks, squared_weight_sum_benchmarks)
+
+        return self._benchmark_sums
+
+    def _load_events(self, start_event, end_event):
+        """ Loads observables and benchmark weights of the events between start_event and end_event """
+
+        return next(self._event_loader(start=start_event, end=end_event, batch_size=None))
+
+    def _event_loader(self, **kwargs):
+        """ MadMiner's event loader for this file, restricted to the selected events """
+
+        if self.selection_mask is None:
+            return madminer_event_loader(self.madminer_filename, **kwargs)
+        return selected_event_loader(self.madminer_filename, self.selection_mask, **kwargs)
+
+    def _selected_events(self):
+        """ Context in which MadMiner's SampleAugmenter code only sees the selected events """
+
+        return selected_events(madminer_sampling, self.madminer_filename, self.selection_mask)
+
+    def _extract_ratio_parts(
+        self, theta0, theta1, n_samples, n_splits, augmented_data_definitions, start_event, end_event, events=None
+    ):
+        """
+        Draws the two halves of ratio samples: half of the events are sampled from theta0, the other half from theta1
+        (with new random thetas). Returns the sources and indices of both parts, see `_extract_splits()`.
+        """
+
+        sources, part_indices = [], []
+        for sampling_theta_index in [0, 1]:
+            theta0_types, theta0_values, n_samples_per_theta0 = parse_theta(theta0, n_samples // 2)
+            theta1_types, theta1_values, n_samples_per_theta1 = parse_theta(theta1, n_samples // 2)
+
+            source, indices = self._extract_splits(
+                n_splits=n_splits,
+                theta_sets_types=[theta0_types, theta1_types],
+                theta_sets_values=[theta0_values, theta1_values],
+                n_samples_per_theta=min(n_samples_per_theta0, n_samples_per_theta1),
+                sampling_theta_index=sampling_theta_index,
+                augmented_data_definitions=augmented_data_definitions,
+                start_event=start_event,
+                end_event=end_event,
+                events=events,
+            )
+            sources.append(source)
+            part_indices.append(indices)
+
+        return sources, part_indices
+
+    def _provenance(self, sampling, **info):
+        """ Provenance information for sample containers """
+
+        provenance = OrderedDict(
+            [
+                ('source_file', os.path.abspath(self.madminer_filename)),
+                ('sampling', sampling),
+                ('observables', list(self.observables.keys())),
+            ]
+        )
+        if self.selection is not None:
+            provenance['selection'] = self.selection
+        provenance.update(info)
+        provenance.update(self.provenance)
+        return provenance
+
+    def _extract_splits(
+        self,
+        n_splits,
+        theta_sets_types,
+        theta_sets_values,
+        n_samples_per_theta,
+        sampling_theta_index=0,
+        augmented_data_definitions=None,
+        start_event=0,
+        end_event=None,
+        events=None,
+    ):
+        """
+        Like MadMiner's `SampleAugmenter._extract_sample()`, but draws n_splits independent samples at once.
+
+        The events (with all benchmark weights) are loaded into memory once. Sets that share the same sampling theta
+        share one alias table, and the alias tables for batches of sampling thetas are built and sampled from together,
+        so that each event is drawn in constant time. The nuisance scores do not depend on theta and are calculated
+        once for all events. The events can be passed as `events=(x_events, weights_events)` if they are already
+        loaded.
+
+        Returns
+        -------
+        source : _EventSource
+            Events and parameter points, which turn event indices and set labels into samples with augmented data.
+
+        indices : ndarray
+            Indices of the drawn events with shape `(n_splits, n_sets, n_samples_per_theta)`.
+
+        """
+
+        logger.debug('Starting extraction of %s splits', n_splits)
+
+        assert n_samples_per_theta > 0, 'Requested {} samples per theta!'.format(n_samples_per_theta)
+
+        if augmented_data_definitions is None:
+            augmented_data_definitions = []
+
+        # Load events and calculate total xsecs for benchmarks
+        if events is None:
+            events = self._load_events(start_event, end_event)
+        x_events, weights_events = events
+        xsecs_benchmarks = np.sum(weights_events, axis=0)
+        squared_weight_sum_benchmarks = np.sum(weights_events ** 2, axis=0)
+        n_events, n_observables = x_events.shape
+
+        if n_observables != len(self.observables):
+            raise ValueError(
+                'Inconsistent numbers of observables: {} in observations, {} in observable list'.format(
+                    n_observables, len(self.observables)
+                )
+            )
+
+        logger.debug('Loaded %s events, benchmark cross sections [pb]: %s', n_events, xsecs_benchmarks)
+
+        # Augmented data that does not depend on theta
+        needs_gradients = False
+        event_augmented_data = {}
+        for i, definition in enumerate(augmented_data_definitions):
+            if definition[0] == 'score':
+                needs_gradients = True
+                if self.morpher is None:
+                    raise RuntimeError('Cannot calculate score without morphing setup!')
+            elif definition[0] == 'nuisance_score':
+                (event_augmented_data[i],) = calculate_augmented_data(
+                    [definition], weights_events, xsecs_benchmarks, [], [], nuisance_morpher=self.nuisance_morpher
+                )
+
+        # Parameter points and morphing matrices for all sets, shape (n_sets, ...) for each theta
+        theta_sets_types, theta_sets_values = balance_thetas(theta_sets_types, theta_sets_values)
+        n_sets = len(theta_sets_types[sampling_theta_index])
+
+        for theta_types in theta_sets_types:
+            if self.morpher is None and 'morphing' in theta_types:
+                raise RuntimeError('Theta defined through morphing, but no morphing setup has been loaded.')
+
+        thetas, theta_matrices, theta_gradient_matrices = [], [], []
+        for theta_types, theta_values in zip(theta_sets_types, theta_sets_values):
+            thetas.append(np.array([get_theta_value(t, v, self.benchmarks) for t, v in zip(theta_types, theta_values)]))
+            theta_matrices.append(
+                np.array(
+                    [
+                        get_theta_benchmark_matrix(t, v, self.benchmarks, self.morpher)
+                        for t, v in zip(theta_types, theta_values)
+                    ]
+                )
+            )
+            if needs_gradients:
+                theta_gradient_matrices.append(
+                    np.array(
+                        [
+                            get_dtheta_benchmark_matrix(t, v, self.benchmarks, self.morpher)
+                            for t, v in zip(theta_types, theta_values)
+                        ]
+                    )
+                )
+
+        # Draw events for all splits
+        indices, effective_n_samples = self._draw_sets(
+            n_splits,
+            n_samples_per_theta,
+            theta_sets_types[sampling_theta_index],
+            thetas[sampling_theta_index],
+            theta_matrices[sampling_theta_index],
+            weights_events,
+            xsecs_benchmarks,
+            squared_weight_sum_benchmarks,
+        )
+
+        if n_sets > 1:
+            logger.info(
+                'Effective number of samples: mean %s, with individual thetas ranging from %s to %s',
+                np.mean(effective_n_samples),
+                np.min(effective_n_samples),
+                np.max(effective_n_samples),
+            )
+        else:
+            logger.info('Effective number of samples: %s', effective_n_samples[0])
+
+        source = _EventSource(
+            x_events,
+            weights_events,
+            xsecs_benchmarks,
+            thetas,
+            theta_matrices,
+            theta_gradient_matrices,
+            augmented_data_definitions,
+            event_augmented_data,
+        )
+
+        return source, indices
+
+    def _draw_sets(
+        self,
+        n_splits,
+        n_samples_per_theta,
+        theta_types,
+        thetas,
+        theta_matrices,
+        weights_events,
+        xsecs_benchmarks,
+        squared_weight_sum_benchmarks,
+    ):
+        """
+        Draws n_samples_per_theta events for each split and each set from the distribution at the sampling theta of
+        the set.
+
+        Returns
+        -------
+        indices : ndarray
+            Event indices with shape `(n_splits, n_sets, n_samples_per_theta)`.
+
+        effective_n_samples : ndarray
+            Effective number of samples for each set with shape `(n_sets,)`.
+
+        """
+
+        n_sets = len(theta_types)
+        n_events = weights_events.shape[0]
+
+        # Sets with the same sampling theta share an alias table
+        unique_sets = OrderedDict()
+        for i_set, (theta_type, theta) in enumerate(zip(theta_types, thetas)):
+            unique_sets.setdefault((theta_type, tuple(np.ravel(theta))), []).append(i_set)
+        unique_sets = list(unique_sets.values())
+
+        indices = np.empty((n_splits, n_sets, n_samples_per_theta), dtype=np.int64)
+        effective_n_samples = np.empty(n_sets)
+
+        n_statistics_warnings = 0
+        n_negative_weights_warnings = 0
+
+        # About eight arrays of float64 or int64 per table entry are needed while the tables are built
+        batch_size = max(1, int(self.memory_budget // (64 * max(n_events, 1))))
+        logger.debug(
+            'Drawing events for %s sets with %s different sampling thetas in batches of %s',
+            n_sets,
+            len(unique_sets),
+            batch_size,
+        )
+
+        for batch_start in range(0, len(unique_sets), batch_size):
+            batch_sets = unique_sets[batch_start : batch_start + batch_size]
+            first_sets = [sets[0] for sets in batch_sets]
+
+            # Event weights for all sampling thetas in the batch, shape (n_batch, n_events)
+            matrices = theta_matrices[first_sets]
+            weights_theta = mdot(matrices, weights_events)
+
+            xsecs = mdot(matrices, xsecs_benchmarks)
+            rms_xsecs = mdot(matrices ** 2, squared_weight_sum_benchmarks) ** 0.5
+            for theta, xsec, rms_xsec in zip(thetas[first_sets], xsecs, rms_xsecs):
+                if rms_xsec > 0.1 * xsec:
+                    n_statistics_warnings += 1
+                    if n_statistics_warnings <= 1:
+                        logger.warning(
+                            'Large statistical uncertainty on the total cross section for theta = %s: '
+                            '(%4f +/- %4f) pb. Skipping these warnings in the future...',
+                            theta,
+                            xsec,
+                            rms_xsec,
+                        )
+
+            for n_negative_weights in np.sum(weights_theta < 0., axis=1):
+                if n_negative_weights > 0:
+                    n_negative_weights_warnings += 1
+                    if n_negative_weights_warnings <= 3:
+                        logger.warning(
+                            'For this value of theta, %s / %s events have negative weight and will be ignored',
+                            n_negative_weights,
+                            n_events,
+                        )
+                        if n_negative_weights_warnings == 3:
+                            logger.warning('Skipping warnings about negative weights in the future...')
+            weights_theta[weights_theta < 0.] = 0.
+
+            p_theta = weights_theta / xsecs[:, np.newaxis]
+            for sets, largest_p in zip(batch_sets, np.max(p_theta, axis=1)):
+                effective_n_samples[sets] = 1. / max(1.e-12, largest_p)
+
+            # Alias tables and draws for the whole batch
+            prob, alias = _build_alias_tables(weights_theta)
+            n_draws = np.array([n_splits * len(sets) * n_samples_per_theta for sets in batch_sets])
+            rows = np.repeat(np.arange(len(batch_sets)), n_draws)
+            draws = _draw_from_alias_tables(prob, alias, rows)
+
+            for sets, row_draws in zip(batch_sets, np.split(draws, np.cumsum(n_draws)[:-1])):
+                indices[:, sets, :] = row_draws.reshape((n_splits, len(sets), n_samples_per_theta))
+
+        return indices, effective_n_samples
+
+
+class _EventSource(object):
+    """ Events, benchmark weights, and parameter points of all sets, from which samples are built """
+
+    def __init__(
+        self,
+        x_events,
+        weights_events,
+        xsecs_benchmarks,
+        thetas,
+        theta_matrices,
+        theta_gradient_matrices,
+        augmented_data_definitions,
+        event_augmented_data,
+    ):
+        self.x_events = x_events
+        self.weights_events = weights_events
+        self.xsecs_benchmarks = xsecs_benchmarks
+        self.thetas = thetas
+        self.theta_matrices = theta_matrices
+        self.theta_gradient_matrices = theta_gradient_matrices
+        self.augmented_data_definitions = augmented_data_definitions
+        self.event_augmented_data = event_augmented_data
+
+    def samples(self, indices, sets):
+        """ Returns observables, augmented data, and parameter points for the events indices drawn for sets """
+
+        thetas = [theta[sets] for theta in self.thetas]
+        return self.x_events[indices], self.augmented_data(indices, sets), thetas
+
+    def augmented_data(self, indices, sets):
+        """ Returns the augmented data for the events indices drawn for sets """
+
+        return _calculate_augmented_data(
+            self.augmented_data_definitions,
+            indices,
+            sets,
+            self.weights_events,
+            self.xsecs_benchmarks,
+            self.theta_matrices,
+            self.theta_gradient_matrices,
+            self.event_augmented_data,
+        )
+
+
+def _stream_batches(draw_round, batch_size, n_batches=None):
+    """
+    Yields minibatches from the shuffled rounds of samples returned by draw_round(). Samples that do not fill a
+    complete minibatch at the end of a round are carried over into the next one, so rounds can also be smaller than
+    batch_size.
+    """
+
+    i_batch = 0
+    leftover = None
+    while n_batches is None or i_batch < n_batches:
+        samples = draw_round()
+        if len(samples['x']) == 0:
+            raise RuntimeError('No samples drawn in streaming round')
+        if leftover is not None:
+            samples = OrderedDict(
+                [(name, np.concatenate((leftover[name], array))) for name, array in six.iteritems(samples)]
+            )
+        n_samples = len(samples['x'])
+
+        start = 0
+        while start + batch_size <= n_samples and (n_batches is None or i_batch < n_batches):
+            yield OrderedDict([(name, array[start : start + batch_size]) for name, array in six.iteritems(samples)])
+            start += batch_size
+            i_batch += 1
+
+        leftover = OrderedDict([(name, array[start:]) for name, array in six.iteritems(samples)])
+
+
+def _is_morphing_point(theta, derivative=False):
+    """ Whether extract_raw_data() is asked for the weights (not the gradients) at a morphing parameter point """
+
+    return theta is not None and not isinstance(theta, six.string_types) and not derivative
+
+
+def _split_filenames(filename, n_splits):
+    if n_splits is None or filename is None:
+        return [filename] * (n_splits or 1)
+    return ['{}_{}'.format(filename, i_split) for i_split in range(n_splits)]
+
+
+def _split_provenance(provenance, i_split, n_splits):
+    provenance = OrderedDict(provenance)
+    if n_splits is not None:
+        provenance['split'] = i_split
+        provenance['n_splits'] = n_splits
+    return provenance
+
+
+def _set_labels(indices):
+    """ Set of each sample in a split, for indices with shape (n_splits, n_sets, n_samples_per_theta) """
+
+    return np.repeat(np.arange(indices.shape[1]), indices.shape[2])
+
+
+def _merge(is_second, first, second):
+    """ Inverse of splitting an array into first = array[~is_second] and second = array[is_second] """
+
+    merged = np.empty((len(is_second),) + first.shape[1:], dtype=first.dtype)
+    merged[~is_second] = first
+    merged[is_second] = second
+    return merged
+
+
+def _ratio_chunk(rows, n0, sources, indices, sets, with_score, index_only=False, n_sets0=0, set_weights=None):
+    """
+    Builds the ratio samples for rows, where the first n0 samples are drawn from theta0 (indices[0] and sets[0] with
+    sources[0]) and the others from theta1. With index_only, the parameter points of the second part are labelled
+    after the n_sets0 ones of the first part. set_weights are the importance weights of the sets of both parts.
+    """
+
+    source0, source1 = sources
+    indices0, indices1 = indices
+    sets0, sets1 = sets
+
+    y = rows >= n0
+    rows0, rows1 = rows[~y], rows[y] - n0
+
+    if index_only:
+        augmented_data0 = source0.augmented_data(indices0[rows0], sets0[rows0])
+        augmented_data1 = source1.augmented_data(indices1[rows1], sets1[rows1])
+        theta_index = _merge(y, sets0[rows0], sets1[rows1] + n_sets0)
+        chunk = OrderedDict(
+            [
+                ('theta0_index', theta_index),
+                ('theta1_index', theta_index),
+                ('x_index', _merge(y, indices0[rows0], indices1[rows1])),
+            ]
+        )
+    else:
+        x0, augmented_data0, thetas0 = source0.samples(indices0[rows0], sets0[rows0])
+        x1, augmented_data1, thetas1 = source1.samples(indices1[rows1], sets1[rows1])
+        chunk = OrderedDict(
+            [
+                ('theta0', _merge(y, thetas0[0], thetas1[0])),
+                ('theta1', _merge(y, thetas0[1], thetas1[1])),
+                ('x', _merge(y, x0, x1)),
+            ]
+        )
+
+    chunk['y'] = y.astype(np.float64).reshape((-1, 1))
+    chunk['r_xz'] = _merge(y, augmented_data0[0], augmented_data1[0])
+    if with_score:
+        chunk['t_xz'] = _merge(y, augmented_data0[1], augmented_data1[1])
+    if set_weights is not None:
+        chunk['w'] = _merge(y, set_weights[0][sets0[rows0]], set_weights[1][sets1[rows1]]).reshape((-1, 1))
+    return chunk
+
+
+def _save_samples(
+    folder, filename, n_samples, make_chunk, chunk_size=None, container=False, provenance=None, tables_filename=None
+):
+    """
+    Builds samples with make_chunk(rows), which returns an OrderedDict {name: ndarray} for a slice of rows, and saves
+    them as `<folder>/<name>_<filename>.npy`. With chunk_size, the samples are built and written chunk by chunk with
+    NpyWriter and read-only memory maps are returned, otherwise everything is built in memory at once.
+
+    With container, the samples are saved in the sample container `<folder>/<filename>.h5` instead and returned as
+    lazy arrays. Arrays `<name>_index` then refer to the table container written by `_save_tables()` for
+    tables_filename.
+    """
+
+    save = folder is not None and filename is not None
+
+    if container and save:
+        container_filename = folder + '/' + filename + '.h5'
+        step = n_samples if chunk_size is None else chunk_size
+
+        with ContainerWriter(container_filename, n_samples, provenance=provenance) as writer:
+            for start in range(0, n_samples, step):
+                writer.write(make_chunk(slice(start, min(start + step, n_samples))))
+
+            for name, info in six.iteritems(writer.arrays):
+                if name.endswith('_index') and tables_filename is not None:
+                    info['table'] = name[: -len('_index')]
+                    info['table_file'] = tables_filename + '_tables.h5'
+
+        logger.debug('Wrote %s samples to %s', n_samples, container_filename)
+
+        return load_container(container_filename)
+
+    if chunk_size is None or not save:
+        samples = make_chunk(slice(0, n_samples))
+        if save:
+            for name, array in six.iteritems(samples):
+                np.save(folder + '/' + name + '_' + filename + '.npy', array)
+        return samples
+
+    writers = OrderedDict()
+    for start in range(0, n_samples, chunk_size):
+        chunk = make_chunk(slice(start, min(start + chunk_size, n_samples)))
+        for name, array in six.iteritems(chunk):
+            if name not in writers:
+                writers[name] = NpyWriter(
+                    folder + '/' + name + '_' + filename + '.npy', (n_samples,) + array.shape[1:], dtype=array.dtype
+                )
+            writers[name].write(array)
+
+    for writer in writers.values():
+        writer.close()
+    logger.debug('Wrote %s samples to %s in chunks of %s', n_samples, folder, chunk_size)
+
+    return OrderedDict([(name, np.load(writer.filename, mmap_mode='r')) for name, writer in six.iteritems(writers)])
+
+
+def _save_tables(folder, filename, tables, container=False):
+    """
+    Saves the tables {name: ndarray} shared by index_only samples as `<folder>/<name>_table_<filename>.npy`, or with
+    container in the container `<folder>/<filename>_tables.h5`
+    """
+
+    if container:
+        with ContainerWriter(folder + '/' + filename + '_tables.h5', 0) as writer:
+            for name, table in six.iteritems(tables):
+                writer.add_array(name, table)
+        return tables
+
+    for name, table in six.iteritems(tables):
+        np.save(folder + '/' + name + '_table_' + filename + '.npy', table)
+    return tables
+
+
+def _resolve_indices(samples, tables):
+    """ Replaces the arrays `<name>_index` in samples by IndexedArray instances for the tables """
+
+    resolved = OrderedDict()
+    for name, array in six.iteritems(samples):
+        if name.endswith('_index'):
+            name = name[: -len('_index')]
+            array = IndexedArray(tables[name], array)
+        resolved[name] = array
+    return resolved
+
+
+def _calculate_augmented_data(
+    definitions, indices, sets, weights_events, xsecs_benchmarks, theta_matrices, theta_gradient_matrices, event_data
+):
+    """
+    Vectorized version of MadMiner's `calculate_augmented_data()` for samples from many sets at once: sample i is
+    event indices[i] and belongs to set sets[i]. theta_matrices and theta_gradient_matrices have one entry per set.
+    event_data contains per-event augmented data (such as the nuisance score) for some definitions.
+    """
+
+    augmented_data = []
+
+    for i, definition in enumerate(definitions):
+        if i in event_data:
+            augmented_data.append(event_data[i][indices])
+
+        elif definition[0] == 'ratio':
+            matrix_num, matrix_den = theta_matrices[definition[1]], theta_matrices[definition[2]]
+            n_benchmarks = matrix_num.shape[1]
+            weights = weights_events[indices, :n_benchmarks]
+
+            xsecs = xsecs_benchmarks[:n_benchmarks]
+
+            p_num = np.einsum('ib,ib->i', matrix_num[sets], weights) / matrix_num.dot(xsecs)[sets]
+            p_den = np.einsum('ib,ib->i', matrix_den[sets], weights) / matrix_den.dot(xsecs)[sets]
+            augmented_data.append((p_num / p_den).reshape((-1, 1)))
+
+        elif definition[0] == 'score':
+            matrix, gradient_matrix = theta_matrices[definition[1]], theta_gradient_matrices[definition[1]]
+            n_benchmarks = matrix.shape[1]
+            weights = weights_events[indices, :n_benchmarks]
+            xsecs = xsecs_benchmarks[:n_benchmarks]
+
+            dsigma = np.einsum('ib,ib->i', matrix[sets], weights)
+            gradient_dsigma = np.einsum('ipb,ib->ip', gradient_matrix[sets], weights)
+            sigma = matrix.dot(xsecs)
+            gradient_sigma = gradient_matrix.dot(xsecs)
+
+            score = gradient_dsigma / dsigma[:, np.newaxis] - (gradient_sigma / sigma[:, np.newaxis])[sets]
+            augmented_data.append(score)
+
+        else:
+            raise ValueError('Unknown augmented data type {}'.format(definition[0]))
+
+    return augmented_data
+
+
+def _build_alias_tables(weights):
+    """
+    Builds Walker alias tables for several discrete distributions at once.
+
+    Instead of the usual sequential pairing of light and heavy entries, the tables are built in a vectorized way:
+    the deficits of the light entries and the excesses of the heavy entries are laid out on two cumulative scales.
+    Each light entry gets the heavy entry as alias whose excess covers the start of its deficit. Each heavy entry gets
+    the next heavy entry as alias and keeps the probability that is left when its excess is used up.
+
+    Parameters
+    ----------
+    weights : ndarray
+        Non-negative weights with shape `(n_tables, n_entries)`.
+
+    Returns
+    -------
+    prob : ndarray
+        Probability to keep the drawn entry with shape `(n_tables, n_entries)`.
+
+    alias : ndarray
+        Alias entries with shape `(n_tables, n_entries)`.
+
+    """
+
+    n_tables, n_entries = weights.shape
+    totals = np.sum(weights, axis=1)
+    if np.any(totals <= 0.):
+        raise RuntimeError('Cannot sample from a distribution without positive weights')
+
+    # Scale to mean 1, the largest entry of each table is always heavy
+    q = weights * (n_entries / totals[:, np.newaxis])
+    heavy = q >= 1.
+    heavy[np.arange(n_tables), np.argmax(q, axis=1)] = True
+
+    prob = np.where(heavy, 1., q)
+    alias = np.tile(np.arange(n_entries), (n_tables, 1))
+
+    # Cumulative deficits and excesses, shifted per table so that all tables can be searched at once
+    offsets = (n_entries + 1.) * np.arange(n_tables)[:, np.newaxis]
+    deficit_ends = np.cumsum(np.where(heavy, 0., 1. - q), axis=1) + offsets
+    excess_ends = np.cumsum(np.where(heavy, q - 1., 0.), axis=1) + offsets
+
+    light_rows, light_cols = np.nonzero(~heavy)
+    heavy_rows, heavy_cols = np.nonzero(heavy)
+    light_ends = deficit_ends[light_rows, light_cols]
+    light_starts = light_ends - (1. - q[light_rows, light_cols])
+    heavy_ends = excess_ends[heavy_rows, heavy_cols]
+
+    # Light entries: alias is the heavy entry whose excess covers the start of the deficit
+    last_heavy = np.cumsum(np.bincount(heavy_rows, minlength=n_tables)) - 1
+    covering = np.searchsorted(heavy_ends, light_starts, side='right')
+    covering = np.minimum(covering, last_heavy[light_rows])
+    alias[light_rows, light_cols] = heavy_cols[covering]
+
+    # Heavy entries: keep what is left when the excess is used up, alias is the next heavy entry
+    if len(light_ends) > 0:
+        next_light = np.searchsorted(light_ends, heavy_ends, side='left')
+        has_next_light = next_light < len(light_ends)
+        next_light = np.minimum(next_light, len(light_ends) - 1)
+        has_next_light &= light_rows[next_light] == heavy_rows
+        has_next_heavy = np.append(heavy_rows[1:] == heavy_rows[:-1], False)
+
+        partial = has_next_light & has_next_heavy
+        prob[heavy_rows[partial], heavy_cols[partial]] = np.clip(
+            1. - (light_ends[next_light[partial]] - heavy_ends[partial]), 0., 1.
+        )
+        alias[heavy_rows[partial], heavy_cols[partial]] = heavy_cols[np.flatnonzero(partial) + 1]
+
+    return prob, alias
+
+
+def _draw_from_alias_tables(prob, alias, rows):
+    """ Draws one entry from the alias table in the given row for each element of rows """
+
+    cols = np.random.randint(prob.shape[1], size=len(rows))
+    keep = np.random.rand(len(rows)) < prob[rows, cols]
+    return np.where(keep, cols, alias[rows, cols])
@@ -0,0 +1,762 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import sys
+import random
+import logging
+import resource
+import threading
+from collections import OrderedDict, deque
+from multiprocessing.pool import ThreadPool
+import six
+from six.moves import queue
+import numpy as np
+import torch
+from torch import optim
+from torch.nn.utils import clip_grad_norm_
+
+from madminer.utils.ml.utils import check_for_nans_in_parameters
+
+logger = logging.getLogger(__name__)
+
+
+class BatchLoader(object):
+    """
+    Iterates over minibatches of training data that is read lazily, for instance from sample containers.
+
+    The samples are loaded in buffers of about buffer_size samples, which are read with sorted indices and then
+    split into minibatches. If the arrays are stored in chunks (`ContainerArray`), whole chunks are read: the order
+    of the chunks is random, and the samples are shuffled within each buffer. Otherwise the samples are shuffled
+    globally. For arrays in memory and buffer_size >= the number of samples, this is the same as the usual random
+    minibatches.
+
+    With n_workers > 0, the buffers are read by that many background threads, which stay up to n_workers buffers
+    ahead of the training, so that reading the data overlaps with the training steps. The order of the samples does
+    not depend on n_workers.
+
+    Parameters
+    ----------
+    data : OrderedDict
+        Maps names to arrays (ndarray, memmap, ContainerArray, or IndexedArray) with the same number of rows.
+
+    indices : ndarray
+        Indices of the samples in this subset (for instance the training or validation samples).
+
+    batch_size : int
+        Number of samples per minibatch.
+
+    shuffle : bool, optional
+        Whether the samples are shuffled in every epoch. Default value: True.
+
+    buffer_size : int, optional
+        Approximate number of samples that are loaded into memory at once. Default value: 100000.
+
+    transform : callable or None, optional
+        Function that is applied to each minibatch (an OrderedDict {name: ndarray}), for instance the input
+        scaling. Default value: None.
+
+    n_workers : int, optional
+        Number of background threads that read the buffers. With 0, the buffers are read when they are needed.
+        Default value: 0.
+
+    """
+
+    def __init__(self, data, indices, batch_size, shuffle=True, buffer_size=100000, transform=None, n_workers=0):
+        self.data = data
+        self.indices = np.sort(np.asarray(indices, dtype=np.int64))
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.buffer_size = max(buffer_size, batch_size)
+        self.transform = transform
+        self.n_workers = n_workers
+
+        chunk_rows = [_chunk_rows(array) for array in data.values()]
+        chunk_rows = [rows for rows in chunk_rows if rows is not None]
+        self.chunk_rows = min(chunk_rows) if chunk_rows else None
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / self.batch_size))
+
+    def __iter__(self):
+        remainder = None
+
+        for buffer_indices, buffer in self._loaded_buffers():
+            if remainder is not None:
+                buffer = OrderedDict(
+                    [(name, np.concatenate((remainder[name], array))) for name, array in six.iteritems(buffer)]
+                )
+
+            n_buffer = len(buffer_indices) if remainder is None else len(buffer_indices) + _n_rows(remainder)
+            n_complete = (n_buffer // self.batch_size) * self.batch_size
+            for start in range(0, n_complete, self.batch_size):
+                yield self._batch(buffer, slice(start, start + self.batch_size))
+
+            remainder = OrderedDict([(name, array[n_complete:]) for name, array in six.iteritems(buffer)])
+            if _n_rows(remainder) == 0:
+                remainder = None
+
+        if remainder is not None:
+            yield self._batch(remainder, slice(None))
+
+    def _buffers(self):
+        """ Yields the sample indices of each buffer, in the order in which they are used """
+
+        if self.chunk_rows is None:
+            order = np.random.permutation(self.indices) if self.shuffle else self.indices
+            for start in range(0, len(order), self.buffer_size):
+                yield order[start : start + self.buffer_size]
+            return
+
+        # Groups of whole chunks
+        chunks = self.indices // self.chunk_rows
+        unique_chunks, chunk_starts = np.unique(chunks, return_index=True)
+        chunk_ends = np.append(chunk_starts[1:], len(self.indices))
+        chunk_order = np.random.permutation(len(unique_chunks)) if self.shuffle else np.arange(len(unique_chunks))
+
+        buffer = []
+        n_buffer = 0
+        for i in chunk_order:
+            buffer.append(self.indices[chunk_starts[i] : chunk_ends[i]])
+            n_buffer += chunk_ends[i] - chunk_starts[i]
+            if n_buffer >= self.buffer_size:
+                buffer = np.concatenate(buffer)
+                yield np.random.permutation(buffer) if self.shuffle else buffer
+                buffer, n_buffer = [], 0
+
+        if buffer:
+            buffer = np.concatenate(buffer)
+            yield np.random.permutation(buffer) if self.shuffle else buffer
+
+    def _loaded_buffers(self):
+        """ Yields the sample indices and the loaded arrays of each buffer, read ahead in background threads """
+
+        if self.n_workers <= 0:
+            for buffer_indices in self._buffers():
+                yield buffer_indices, self._load(buffer_indices)
+            return
+
+        pool = ThreadPool(self.n_workers)
+        try:
+            pending = deque()
+            for buffer_indices in self._buffers():
+                pending.append((buffer_indices, pool.apply_async(self._load, (buffer_indices,))))
+                if len(pending) > self.n_workers:
+                    buffer_indices, result = pending.popleft()
+                    yield buffer_indices, result.get()
+            while pending:
+                buffer_indices, result = pending.popleft()
+                yield buffer_indices, result.get()
+        finally:
+            pool.terminate()
+
+    def _load(self, buffer_indices):
+        """ Reads the rows buffer_indices of all arrays (in sorted order) and puts them into the order of the buffer """
+
+        order = np.argsort(buffer_indices, kind='mergesort')
+        sorted_indices = buffer_indices[order]
+
+        buffer = OrderedDict()
+        for name, array in six.iteritems(self.data):
+            rows = np.asarray(array[sorted_indices])
+            loaded = np.empty_like(rows)
+            loaded[order] = rows
+            buffer[name] = loaded
+        return buffer
+
+    def _batch(self, buffer, rows):
+        batch = OrderedDict([(name, array[rows]) for name, array in six.iteritems(buffer)])
+        if self.transform is not None:
+            batch = self.transform(batch)
+        return batch
+
+
+class StreamLoader(object):
+    """
+    Iterates over minibatches from a generator, for instance `SampleAugmenter.stream_samples_train_ratio()`.
+
+    The generator runs in a background thread and keeps up to prefetch minibatches ready, so that drawing new samples
+    overlaps with the training steps. Each iteration (epoch) yields the next n_batches minibatches of the stream, so
+    no minibatch is used twice.
+
+    Parameters
+    ----------
+    stream : iterable
+        Yields minibatches as OrderedDict {name: ndarray}.
+
+    n_batches : int
+        Number of minibatches per iteration.
+
+    transform : callable or None, optional
+        Function that is applied to each minibatch, for instance the input scaling. Default value: None.
+
+    prefetch : int, optional
+        Maximal number of minibatches that are drawn in advance. Default value: 16.
+
+    """
+
+    def __init__(self, stream, n_batches, transform=None, prefetch=16):
+        self.stream = stream
+        self.n_batches = n_batches
+        self.transform = transform
+        self.prefetch = prefetch
+
+        self._queue = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._exhausted = False
+
+    def __len__(self):
+        return self.n_batches
+
+    def __iter__(self):
+        if self._thread is None:
+            self._start()
+
+        for _ in range(self.n_batches):
+            if self._exhausted:
+                return
+
+            item = self._queue.get()
+            if item is None:
+                logger.info('Sample stream is exhausted')
+                self._exhausted = True
+                return
+            if isinstance(item, _StreamError):
+                self._exhausted = True
+                six.reraise(*item.exc_info)
+
+            yield item if self.transform is None else self.transform(item)
+
+    def close(self):
+        """ Stops the background thread """
+
+        self._stop.set()
+        if self._thread is not None:
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self._thread = None
+
+    def _start(self):
+        self._queue = queue.Queue(maxsize=self.prefetch)
+        self._thread = threading.Thread(target=self._produce, name='StreamLoader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self):
+        try:
+            for batch in self.stream:
+                if not self._put(batch):
+                    return
+        except Exception:
+            self._put(_StreamError(sys.exc_info()))
+            return
+        self._put(None)
+
+    def _put(self, item):
+        """ Puts item into the queue unless the loader is closed, returns False if it is """
+
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+class _StreamError(object):
+    """ Exception raised by the stream in the background thread """
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+def train_model(
+    model,
+    method_type,
+    loss_functions,
+    train_loader,
+    validation_loader=None,
+    loss_weights=None,
+    loss_labels=None,
+    calculate_model_score=True,
+    trainer='amsgrad',
+    initial_learning_rate=0.001,
+    final_learning_rate=0.0001,
+    nesterov_momentum=None,
+    n_epochs=50,
+    clip_gradient=100.,
+    run_on_gpu=True,
+    double_precision=False,
+    early_stopping=True,
+    early_stopping_patience=None,
+    grad_x_regularization=None,
+    return_first_loss=False,
+    verbose='some',
+    checkpoint_filename=None,
+    checkpoint_every=1,
+    checkpoint=None,
+    checkpoint_extra=None,
+):
+    """
+    Training loop for all MadMiner estimators, which gets its minibatches from BatchLoader or StreamLoader instances
+    instead of tensors in memory. Otherwise it follows MadMiner's `train_ratio_model()`,
+    `train_local_score_model()`, and `train_flow_model()`: the same optimizers, exponential learning rate decay,
+    gradient clipping, and early stopping.
+
+    Parameters
+    ----------
+    model : Module
+        The estimator.
+
+    method_type : {'parameterized', 'doubly_parameterized', 'local_score', 'nde'}
+        Type of the estimator.
+
+    loss_functions : list of function
+        Loss functions (with the signatures of MadMiner's `ratio_losses` or `flow_losses` functions, or the weighted
+        ones in `diboson_mining.losses`).
+
+    train_loader : BatchLoader or StreamLoader
+        Training minibatches with keys from 'theta0', 'theta1', 'x', 'y', 'r_xz', 't_xz0', 't_xz1', and 'w'. The
+        per-sample weights 'w' are passed to the loss functions (which then have to accept a weights keyword
+        argument, like the ones in `diboson_mining.losses`).
+
+    validation_loader : BatchLoader or None, optional
+        Validation minibatches. If None, there is no validation and no early stopping. Default value: None.
+
+    checkpoint_filename : str or None, optional
+        If not None, the complete training state (model, optimizer, learning rate schedule, early stopping, losses,
+        and the random states of numpy, torch, and Python) is saved to this file after every checkpoint_every epochs
+        and at the end of the training, see `save_checkpoint()`. Default value: None.
+
+    checkpoint_every : int, optional
+        Number of epochs between checkpoints. Default value: 1.
+
+    checkpoint : dict or None, optional
+        A checkpoint loaded with `load_checkpoint()`. If not None, the training continues from the state saved in it
+        (which has to be for the same model and settings). With the same training data, the results are then the
+        same as without the interruption. Default value: None.
+
+    checkpoint_extra : dict or None, optional
+        Additional information saved in every checkpoint under the key 'extra'. Default value: None.
+
+    See MadMiner's `train_ratio_model()` for the other parameters.
+
+    Returns
+    -------
+    total_losses_train, total_losses_val : list of float
+        Training and validation loss after each epoch. If return_first_loss is True, the loss of the first minibatch
+        and the model parameters instead.
+
+    """
+
+    # CPU or GPU?
+    run_on_gpu = run_on_gpu and torch.cuda.is_available()
+    device = torch.device('cuda' if run_on_gpu else 'cpu')
+    dtype = torch.double if double_precision else torch.float
+
+    logger.debug(
+        'Training on %s with %s precision', 'GPU' if run_on_gpu else 'CPU', 'double' if double_precision else 'single'
+    )
+
+    model = model.to(device, dtype)
+
+    # Optimizer
+    logger.debug('Preparing optimizer %s', trainer)
+    optimizer = _make_optimizer(model, trainer, initial_learning_rate, nesterov_momentum)
+
+    # Early stopping
+    early_stopping = early_stopping and (validation_loader is not None) and (n_epochs > 1)
+    early_stopping_best_val_loss = None
+    early_stopping_best_model = None
+    early_stopping_epoch = None
+
+    # Losses
+    loss_weights = [1.] * len(loss_functions) if loss_weights is None else list(loss_weights)
+    if loss_labels is None:
+        loss_labels = ['loss_{}'.format(i) for i in range(len(loss_functions))]
+    if grad_x_regularization is not None:
+        if method_type == 'nde':
+            raise NotImplementedError('Flow training does not support grad_x regularization yet!')
+        loss_weights.append(grad_x_regularization)
+        loss_labels.append('l2_grad_x')
+    n_losses = len(loss_weights)
+
+    total_losses_train, total_losses_val = [], []
+    total_val_loss = None
+
+    # Verbosity
+    n_epochs_verbose = None
+    if verbose == 'all':  # Print output after every epoch
+        n_epochs_verbose = 1
+    elif verbose == 'some':  # Print output after 10%, 20%, ..., 100% progress
+        n_epochs_verbose = max(int(round(n_epochs / 10, 0)), 1)
+
+    # Resume from checkpoint
+    first_epoch = 0
+    if checkpoint is not None:
+        if checkpoint['n_epochs'] != n_epochs:
+            logger.warning(
+                'Checkpoint is for %s epochs, not %s, so the learning rate schedule changes',
+                checkpoint['n_epochs'],
+                n_epochs,
+            )
+        model.load_state_dict(checkpoint['model'])
+        optimizer.load_state_dict(checkpoint['optimizer'])
+        first_epoch = checkpoint['epoch']
+        total_losses_train, total_losses_val = list(checkpoint['losses_train']), list(checkpoint['losses_val'])
+        total_val_loss = total_losses_val[-1] if total_losses_val else None
+        early_stopping_best_val_loss = checkpoint['early_stopping_best_val_loss']
+        early_stopping_best_model = checkpoint['early_stopping_best_model']
+        early_stopping_epoch = checkpoint['early_stopping_epoch']
+        set_rng_state(checkpoint['rng_state'])
+        if checkpoint['finished']:
+            first_epoch = n_epochs
+        logger.info('Resuming training after epoch %s', checkpoint['epoch'])
+
+    def save(epoch, finished=False):
+        if checkpoint_filename is None:
+            return
+        state = OrderedDict(
+            [
+                ('epoch', epoch),
+                ('finished', finished),
+                ('n_epochs', n_epochs),
+                ('model', model.state_dict()),
+                ('optimizer', optimizer.state_dict()),
+                ('losses_train', total_losses_train),
+                ('losses_val', total_losses_val),
+                ('early_stopping_best_val_loss', early_stopping_best_val_loss),
+                ('early_stopping_best_model', early_stopping_best_model),
+                ('early_stopping_epoch', early_stopping_epoch),
+                ('rng_state', get_rng_state()),
+                ('extra', {} if checkpoint_extra is None else checkpoint_extra),
+            ]
+        )
+        save_checkpoint(checkpoint_filename, state)
+
+    logger.debug('Beginning main training loop')
+
+    for epoch in range(first_epoch, n_epochs):
+
+        # Learning rate decay
+        if n_epochs > 1:
+            lr = initial_learning_rate * (final_learning_rate / initial_learning_rate) ** float(epoch / (n_epochs - 1.))
+            for param_group in optimizer.param_groups:
+                param_group['lr'] = lr
+
+        # Training
+        model.train()
+        individual_train_loss = np.zeros(n_losses)
+        total_train_loss = 0.
+        n_batches = 0
+
+        for batch in train_loader:
+            batch = _to_tensors(batch, device, dtype)
+            optimizer.zero_grad()
+
+            losses = _losses(
+                model, method_type, loss_functions, batch, calculate_model_score, grad_x_regularization, training=True
+            )
+            loss = _weighted_sum(losses, loss_weights)
+
+            individual_train_loss += [individual_loss.item() for individual_loss in losses]
+            total_train_loss += loss.item()
+            n_batches += 1
+
+            # For debugging, perhaps stop here
+            if return_first_loss:
+                logger.info('As requested, cancelling training and returning first loss')
+                return loss, dict(model.named_parameters())
+
+            loss.backward()
+            if clip_gradient is not None:
+                clip_grad_norm_(model.parameters(), clip_gradient)
+
+            if method_type == 'nde' and check_for_nans_in_parameters(model):
+                logger.warning('NaNs in parameters or gradients, stopping training!')
+                break
+
+            optimizer.step()
+
+        if n_batches == 0:
+            logger.warning('No training samples left in epoch %s, stopping training', epoch + 1)
+            break
+
+        total_losses_train.append(total_train_loss / max(n_batches, 1))
+        individual_train_loss /= max(n_batches, 1)
+
+        # Validation
+        individual_val_loss = None
+        if validation_loader is not None:
+            model.eval()
+            individual_val_loss = np.zeros(n_losses)
+            total_val_loss = 0.
+            n_batches = 0
+
+            for batch in validation_loader:
+                batch = _to_tensors(batch, device, dtype)
+                losses = _losses(
+                    model, method_type, loss_functions, batch, calculate_model_score, None, training=False
+                )
+                loss = _weighted_sum(losses, loss_weights)
+
+                individual_val_loss[: len(losses)] += [individual_loss.item() for individual_loss in losses]
+                total_val_loss += loss.item()
+                n_batches += 1
+
+            total_val_loss /= max(n_batches, 1)
+            individual_val_loss /= max(n_batches, 1)
+            total_losses_val.append(total_val_loss)
+
+            # Early stopping: best epoch so far?
+            is_best = early_stopping_best_val_loss is None or total_val_loss < early_stopping_best_val_loss
+            if early_stopping and is_best:
+                early_stopping_best_val_loss = total_val_loss
+                early_stopping_best_model = _copy_state_dict(model)
+                early_stopping_epoch = epoch
+
+        # Print out information
+        verbose_epoch = n_epochs_verbose is not None and (epoch + 1) % n_epochs_verbose == 0
+        _report_epoch(
+            epoch,
+            loss_labels,
+            total_losses_train[-1],
+            individual_train_loss,
+            total_val_loss,
+            individual_val_loss,
+            is_best=early_stopping and epoch == early_stopping_epoch,
+            verbose=verbose_epoch,
+        )
+
+        if checkpoint_filename is not None and (epoch + 1) % checkpoint_every == 0:
+            save(epoch + 1)
+
+        # Early stopping: actually stop training
+        if early_stopping and early_stopping_patience is not None:
+            if epoch - early_stopping_epoch >= early_stopping_patience > 0:
+                logger.info('No improvement for %s epochs, stopping training', epoch - early_stopping_epoch)
+                break
+
+    logger.debug('Main training loop finished')
+
+    save(len(total_losses_train), finished=True)
+
+    # Early stopping: back to best state
+    if early_stopping and early_stopping_best_model is not None:
+        if early_stopping_best_val_loss < total_val_loss:
+            logger.info(
+                'Early stopping after epoch %s, with loss %.2f compared to final loss %.2f',
+                early_stopping_epoch + 1,
+                early_stopping_best_val_loss,
+                total_val_loss,
+            )
+            model.load_state_dict(early_stopping_best_model)
+        else:
+            logger.info('Early stopping did not improve performance')
+
+    logger.info('Finished training')
+
+    return total_losses_train, total_losses_val
+
+
+def save_checkpoint(filename, state):
+    """
+    Saves a training checkpoint (a dict with tensors, numbers, lists, and tuples). The file is written under a
+    temporary name and then renamed, so an interruption while saving leaves the previous checkpoint intact.
+    """
+
+    tmp_filename = filename + '.tmp'
+    torch.save(state, tmp_filename)
+    os.rename(tmp_filename, filename)
+    logger.debug('Saved checkpoint after epoch %s to %s', state.get('epoch'), filename)
+
+
+def load_checkpoint(filename):
+    """ Loads a training checkpoint saved with `save_checkpoint()` onto the CPU """
+
+    return torch.load(filename, map_location='cpu')
+
+
+def get_rng_state():
+    """ The states of numpy's, torch's (including CUDA), and Python's global random number generators """
+
+    name, keys, position, has_gauss, cached_gaussian = np.random.get_state()
+    state = OrderedDict(
+        [
+            ('numpy', (name, torch.from_numpy(keys.astype(np.int64)), position, has_gauss, cached_gaussian)),
+            ('torch', torch.get_rng_state()),
+            ('python', random.getstate()),
+        ]
+    )
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    """ Restores the random number generators from `get_rng_state()` """
+
+    name, keys, position, has_gauss, cached_gaussian = state['numpy']
+    np.random.set_state((name, keys.numpy().astype(np.uint32), position, has_gauss, cached_gaussian))
+    torch.set_rng_state(state['torch'])
+    random.setstate(state['python'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def peak_memory_usage():
+    """
+    Peak resident set size of this process in bytes. Note that this includes the pages of memory-mapped files that
+    have been read, which the OS can reclaim when memory is needed, see `anonymous_memory_usage()`.
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else 1024 * peak
+
+
+def log_memory_usage():
+    """ Logs the peak memory use and, if known, the current memory use that is not backed by files """
+
+    anonymous = anonymous_memory_usage()
+    if anonymous is None:
+        logger.info('Peak memory use: %.2f GB', peak_memory_usage() / 1.e9)
+    else:
+        logger.info(
+            'Peak memory use: %.2f GB including memory-mapped files, %.2f GB not backed by files at the end',
+            peak_memory_usage() / 1.e9,
+            anonymous / 1.e9,
+        )
+
+
+def anonymous_memory_usage():
+    """ Current resident memory of this process in bytes that is not backed by files, or None if unknown (non-Linux) """
+
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('RssAnon:'):
+                    return 1024 * int(line.split()[1])
+    except IOError:
+        pass
+    return None
+
+
+def _make_optimizer(model, trainer, learning_rate, nesterov_momentum=None):
+    if trainer == 'adam':
+        return optim.Adam(model.parameters(), lr=learning_rate)
+    if trainer == 'amsgrad':
+        return optim.Adam(model.parameters(), lr=learning_rate, amsgrad=True)
+    if trainer == 'sgd':
+        if nesterov_momentum is None:
+            return optim.SGD(model.parameters(), lr=learning_rate)
+        return optim.SGD(model.parameters(), lr=learning_rate, nesterov=True, momentum=nesterov_momentum)
+    raise ValueError('Unknown trainer {}'.format(trainer))
+
+
+def _losses(model, method_type, loss_functions, batch, calculate_model_score, grad_x_regularization, training):
+    """ Forward pass and individual losses for one minibatch, like in MadMiner's trainers """
+
+    theta0, theta1, x = batch.get('theta0'), batch.get('theta1'), batch['x']
+    y, r_xz, t_xz0, t_xz1 = batch.get('y'), batch.get('r_xz'), batch.get('t_xz0'), batch.get('t_xz1')
+    weights = {} if batch.get('w') is None else {'weights': batch['w']}
+    return_grad_x = training and grad_x_regularization is not None
+    x_gradient = None
+
+    if method_type in ['parameterized', 'doubly_parameterized']:
+        thetas = [theta0] if method_type == 'parameterized' else [theta0, theta1]
+        kwargs = {'track_score': calculate_model_score}
+        if return_grad_x:
+            kwargs['return_grad_x'] = True
+        elif not training:
+            kwargs['create_gradient_graph'] = False
+
+        outputs = list(model(*(thetas + [x]), **kwargs))
+        if return_grad_x:
+            x_gradient = outputs.pop()
+        if method_type == 'parameterized':
+            outputs.append(None)
+        s_hat, log_r_hat, t_hat0, t_hat1 = outputs
+
+        losses = [fn(s_hat, log_r_hat, t_hat0, t_hat1, y, r_xz, t_xz0, t_xz1, **weights) for fn in loss_functions]
+        if x_gradient is not None:
+            losses.append(torch.mean(x_gradient ** 2))
+
+    elif method_type == 'local_score':
+        if return_grad_x:
+            t_hat, x_gradient = model(x, return_grad_x=True)
+        else:
+            t_hat = model(x)
+
+        losses = [fn(t_hat, t_xz0, **weights) for fn in loss_functions]
+        if x_gradient is not None:
+            losses.append(torch.mean(torch.sum(x_gradient ** 2, dim=1)))
+
+    elif method_type == 'nde':
+        if t_xz0 is not None:
+            _, log_likelihood, score = model.log_likelihood_and_score(theta0, x)
+        else:
+            _, log_likelihood = model.log_likelihood(theta0, x)
+            score = None
+
+        losses = [fn(log_likelihood, score, t_xz0, **weights) for fn in loss_functions]
+
+    else:
+        raise ValueError('Unknown method type {}'.format(method_type))
+
+    return losses
+
+
+def _weighted_sum(losses, loss_weights):
+    loss = loss_weights[0] * losses[0]
+    for weight, individual_loss in zip(loss_weights[1:], losses[1:]):
+        loss = loss + weight * individual_loss
+    return loss
+
+
+def _to_tensors(batch, device, dtype):
+    return OrderedDict(
+        [
+            (name, torch.from_numpy(np.ascontiguousarray(array)).to(device, dtype))
+            for name, array in six.iteritems(batch)
+        ]
+    )
+
+
+def _copy_state_dict(model):
+    return OrderedDict([(key, value.detach().clone()) for key, value in six.iteritems(model.state_dict())])
+
+
+def _report_epoch(
+    epoch, loss_labels, total_train_loss, individual_train_loss, total_val_loss, individual_val_loss, is_best, verbose
+):
+    logging_fn = logger.info if verbose else logger.debug
+
+    def summary(values):
+        return ', '.join('{}: {:.4f}'.format(label, value) for label, value in zip(loss_labels, values))
+
+    logging_fn('  Epoch %-2.2d: train loss %.4f (%s)', epoch + 1, total_train_loss, summary(individual_train_loss))
+    if individual_val_loss is not None:
+        logging_fn(
+            '            val. loss  %.4f (%s)%s',
+            total_val_loss,
+            summary(individual_val_loss),
+            ' (*)' if is_best else '',
+        )
+
+
+def _chunk_rows(array):
+    """ Number of rows per storage chunk of a lazy array, or None for arrays without chunks """
+
+    if hasattr(array, 'chunk_rows'):
+        return array.chunk_rows
+    if hasattr(array, 'indices') and hasattr(array, 'table'):
+        return _chunk_rows(array.indices)
+    return None
+
+
+def _n_rows(batch):
+    return len(next(iter(batch.values())))
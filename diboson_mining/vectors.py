@@ -0,0 +1,221 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import numpy as np
+
+
+def _unit(x, y, z):
+    mag = (x ** 2 + y ** 2 + z ** 2) ** 0.5
+    rescale = (mag > 0.) & (mag != 1.)
+    safe_mag = np.where(rescale, mag, 1.)
+    return x / safe_mag, y / safe_mag, z / safe_mag
+
+
+class Vector3Array(object):
+    """
+    Array of spatial three-vectors with the interface of scikit-hep's Vector3D (as far as it is used in our
+    observables), where every component is an ndarray with shape `(n_events,)`.
+    """
+
+    def __init__(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
+
+    def __add__(self, other):
+        return Vector3Array(self.x + other.x, self.y + other.y, self.z + other.z)
+
+    def __sub__(self, other):
+        return Vector3Array(self.x - other.x, self.y - other.y, self.z - other.z)
+
+    def __mul__(self, factor):
+        return Vector3Array(self.x * factor, self.y * factor, self.z * factor)
+
+    __rmul__ = __mul__
+
+    @property
+    def mag2(self):
+        return self.x ** 2 + self.y ** 2 + self.z ** 2
+
+    @property
+    def mag(self):
+        return self.mag2 ** 0.5
+
+    def unit(self):
+        return Vector3Array(*_unit(self.x, self.y, self.z))
+
+    def dot(self, other):
+        return self.x * other.x + self.y * other.y + self.z * other.z
+
+    def cross(self, other):
+        return Vector3Array(
+            self.y * other.z - self.z * other.y,
+            self.z * other.x - self.x * other.z,
+            self.x * other.y - self.y * other.x,
+        )
+
+    def phi(self):
+        return np.arctan2(self.y, self.x)
+
+
+class LorentzArray(object):
+    """
+    Array of four-momenta, one per event, with the interface of `MadMinerParticle` (and thus scikit-hep's
+    LorentzVector). All kinematic properties return ndarrays with shape `(n_events,)`.
+
+    Parameters
+    ----------
+    x, y, z, t : ndarray
+        Momentum components and energy with shape `(n_events,)`.
+
+    valid : ndarray or None, optional
+        Boolean mask marking the events in which this particle exists. Operations on several particles propagate
+        the combined mask. None means that the particle exists in every event. Default value: None.
+
+    pdgid, charge : ndarray or None, optional
+        PDG ids and charges with shape `(n_events,)`. Default value: None.
+
+    """
+
+    def __init__(self, x, y, z, t, valid=None, pdgid=None, charge=None):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.z = np.asarray(z, dtype=np.float64)
+        self.t = np.asarray(t, dtype=np.float64)
+        self.valid = np.ones(self.x.shape, dtype=np.bool_) if valid is None else valid
+        self.pdgid = pdgid
+        self.charge = charge
+
+    @classmethod
+    def from_ptetaphim(cls, pt, eta, phi, m, **kwargs):
+        px, py, pz = pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta)
+        p2 = px ** 2 + py ** 2 + pz ** 2
+        t = np.where(m > 0., p2 + m ** 2, p2 - m ** 2) ** 0.5
+        return cls(px, py, pz, t, **kwargs)
+
+    @classmethod
+    def from_ptetaphie(cls, pt, eta, phi, e, **kwargs):
+        return cls(pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta), e, **kwargs)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, rows):
+        """ Selects a subset of events (not a momentum component, unlike LorentzVector) """
+        return LorentzArray(
+            self.x[rows],
+            self.y[rows],
+            self.z[rows],
+            self.t[rows],
+            valid=self.valid[rows],
+            pdgid=None if self.pdgid is None else self.pdgid[rows],
+            charge=None if self.charge is None else self.charge[rows],
+        )
+
+    def __add__(self, other):
+        charge = None if self.charge is None or other.charge is None else self.charge + other.charge
+        return LorentzArray(
+            self.x + other.x,
+            self.y + other.y,
+            self.z + other.z,
+            self.t + other.t,
+            valid=self.valid & other.valid,
+            charge=charge,
+        )
+
+    def __sub__(self, other):
+        charge = None if self.charge is None or other.charge is None else self.charge - other.charge
+        return LorentzArray(
+            self.x - other.x,
+            self.y - other.y,
+            self.z - other.z,
+            self.t - other.t,
+            valid=self.valid & other.valid,
+            charge=charge,
+        )
+
+    @property
+    def px(self):
+        return self.x
+
+    @property
+    def py(self):
+        return self.y
+
+    @property
+    def pz(self):
+        return self.z
+
+    @property
+    def e(self):
+        return self.t
+
+    @property
+    def vector(self):
+        return Vector3Array(self.x, self.y, self.z)
+
+    @property
+    def boostvector(self):
+        return Vector3Array(self.x / self.t, self.y / self.t, self.z / self.t)
+
+    @property
+    def p(self):
+        return (self.x ** 2 + self.y ** 2 + self.z ** 2) ** 0.5
+
+    @property
+    def perp2(self):
+        return self.x ** 2 + self.y ** 2
+
+    @property
+    def pt(self):
+        return self.perp2 ** 0.5
+
+    perp = pt
+
+    @property
+    def et(self):
+        return self.e * (self.pt / self.p)
+
+    @property
+    def m2(self):
+        return self.t ** 2 - (self.x ** 2 + self.y ** 2 + self.z ** 2)
+
+    @property
+    def m(self):
+        m2 = self.m2
+        return np.sign(m2) * np.abs(m2) ** 0.5
+
+    mass = m
+    mass2 = m2
+
+    @property
+    def eta(self):
+        p = self.p
+        costheta = np.where(p == 0., 1., self.z / np.where(p == 0., 1., p))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            eta = -0.5 * np.log((1. - costheta) / (1. + costheta))
+        eta = np.where(np.abs(costheta) < 1., eta, np.where(self.z > 0, 10e10, -10e10))
+        return np.where(np.isnan(costheta), np.nan, eta)
+
+    pseudorapidity = eta
+
+    def phi(self):
+        return np.arctan2(self.y, self.x)
+
+    def boost(self, boostvector):
+        """ Same convention as LorentzVector.boost(): boosting with p.boostvector goes into the rest frame of p """
+
+        bx, by, bz = boostvector.x, boostvector.y, boostvector.z
+        b2 = bx ** 2 + by ** 2 + bz ** 2
+        gamma = 1. / (1. - b2) ** 0.5
+        bp = bx * self.x + by * self.y + bz * self.z
+        gamma2 = np.where(b2 > 0., (gamma - 1.) / np.where(b2 > 0., b2, 1.), 0.)
+
+        return LorentzArray(
+            self.x + gamma2 * bp * bx - gamma * bx * self.t,
+            self.y + gamma2 * bp * by - gamma * by * self.t,
+            self.z + gamma2 * bp * bz - gamma * bz * self.t,
+            gamma * (self.t - bp),
+            valid=self.valid,
+            pdgid=self.pdgid,
+            charge=self.charge,
+        )
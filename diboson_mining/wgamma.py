@@ -0,0 +1,165 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import six
+
+from diboson_mining.delphes import ColumnarDelphesProcessor
+from diboson_mining.observables import calculate_wgamma_observables, WGAMMA_OBSERVABLES
+
+logger = logging.getLogger(__name__)
+
+TIGHT_CUTS = [
+    'pt_a1 >= 300.',
+    'pt_l1 >= 80.',
+    'et_miss >= 80.',
+    '(deltaphi_la**2 + deltaeta_la**2)**0.5 >= 3.',
+    'eta_l1**2 < 2.4**2',
+]
+# Names of the tight cuts when they are stored as cut bits
+TIGHT_CUT_BITS = ['tight_pt_a1', 'tight_pt_l1', 'tight_et_miss', 'tight_deltar_la', 'tight_eta_l1']
+ANTITIGHT_CUTS = [
+    'pt_a1 >= 20.',
+    'pt_l1 >= 20.',
+    'et_miss >= 20.',
+    'int(pt_a1 < 300.) + int(pt_l1 < 80.) + int(et_miss < 80.)'
+    + ' + int((deltaphi_la**2 + deltaeta_la**2)**0.5 < 3.) + int(eta_l1**2 > 2.4**2) > 0',
+]
+LOOSE_CUTS = [
+    'pt_a1 >= 20.',
+    'pt_l1 >= 20.',
+    'et_miss >= 20.',
+]
+
+
+def setup_observables(delphesprocessor):
+    """ Defines the observables of the Wgamma analysis """
+
+    delphesprocessor.reset_observables()
+
+    # Default observables (four-momenta of a, l, j, and met)
+    delphesprocessor.add_default_observables(
+        n_leptons_max=1, n_photons_max=1, n_jets_max=1, include_charge=False, include_numbers=False, include_met=True
+    )
+    # Lepton flavour
+    delphesprocessor.add_observable('pdgid_l1', 'l[0].pdgid', required=True)
+
+    # Two-particle systems
+    delphesprocessor.add_observable('m_la', '(l[0] + a[0]).m', required=True)
+    delphesprocessor.add_observable('m_lmet', '(l[0] + met).m', required=True)
+    delphesprocessor.add_observable('m_amet', '(a[0] + met).m', required=True)
+    delphesprocessor.add_observable('pt_la', '(l[0] + a[0]).pt', required=True)
+    delphesprocessor.add_observable('pt_lmet', '(l[0] + met).pt', required=True)
+    delphesprocessor.add_observable('pt_amet', '(a[0] + met).pt', required=True)
+    delphesprocessor.add_observable('deltaphi_la', 'l[0].phi() - a[0].phi()', required=True)
+    delphesprocessor.add_observable('deltaphi_lmet', 'l[0].phi() - met.phi()', required=True)
+    delphesprocessor.add_observable('deltaphi_amet', 'a[0].phi() - met.phi()', required=True)
+    delphesprocessor.add_observable('deltaeta_la', 'l[0].eta - a[0].eta', required=True)
+
+    # Three-particle system
+    delphesprocessor.add_observable('m_almet', '(a[0] + l[0] + met).m', required=True)
+    delphesprocessor.add_observable('pt_almet', '(a[0] + l[0] + met).pt', required=True)
+
+    # mT(W) and ressurrection phi (sharing one neutrino reconstruction)
+    delphesprocessor.add_observables_from_function(WGAMMA_OBSERVABLES, calculate_wgamma_observables, required=True)
+
+
+def setup_selections(delphesprocessor):
+    """
+    Defines the tight, anti-tight, and loose selections. The tight cuts are also stored as cut bits, together with the
+    cut bit selections 'tight' and 'antitight', so the tight and anti-tight subsets can be selected from the loose
+    sample with `SampleAugmenter(..., selection='tight')` or `FisherInformation(..., selection='antitight')`.
+    """
+
+    delphesprocessor.reset_cuts()
+    delphesprocessor.reset_selections()
+    delphesprocessor.reset_cut_bits()
+
+    delphesprocessor.add_selection('tight', TIGHT_CUTS)
+    delphesprocessor.add_selection('antitight', ANTITIGHT_CUTS)
+    delphesprocessor.add_selection('loose', LOOSE_CUTS)
+
+    for name, cut in zip(TIGHT_CUT_BITS, TIGHT_CUTS):
+        delphesprocessor.add_cut_bit(name, cut)
+    delphesprocessor.add_cut_bit_selection('tight', ' and '.join(TIGHT_CUT_BITS))
+    delphesprocessor.add_cut_bit_selection('antitight', 'not tight')
+
+
+def analyse_run(
+    setup_filename,
+    event_folder,
+    output_filenames,
+    delphes_directory,
+    delphes_card,
+    log_file=None,
+    initial_command=None,
+    sampled_from_benchmark='sm',
+    chunk_size=None,
+    n_workers=1,
+):
+    """
+    Runs Delphes on the events of one MadGraph run and extracts the observables for all selections in one pass.
+    Module-level function, so it can be used as task with `run_in_parallel()`.
+
+    Parameters
+    ----------
+    setup_filename : str
+        MadMiner setup file.
+
+    event_folder : str
+        MadGraph event folder (e.g. `.../Events/run_01`) with the HepMC and LHE files.
+
+    output_filenames : dict
+        Maps selection names ('tight', 'antitight', 'loose') to the MadMiner files the events are saved in.
+
+    delphes_directory : str
+        Delphes directory.
+
+    delphes_card : str
+        Delphes card.
+
+    log_file : str or None, optional
+        Log file for the Delphes run. Default value: None.
+
+    initial_command : str or None, optional
+        Command executed before Delphes. Default value: None.
+
+    sampled_from_benchmark : str, optional
+        Benchmark the events were sampled from. Default value: 'sm'.
+
+    chunk_size : int or None, optional
+        If not None, the Delphes file is analysed in chunks of this many events. Default value: None.
+
+    n_workers : int, optional
+        Number of worker processes for the chunks (only used when this function is not itself run in a worker of
+        `run_in_parallel()`). Default value: 1.
+
+    Returns
+    -------
+        None
+
+    """
+
+    logger.info('Starting analysis of %s', event_folder)
+
+    dp = ColumnarDelphesProcessor(setup_filename)
+    dp.add_sample(
+        event_folder + '/tag_1_pythia8_events.hepmc.gz',
+        delphes_filename=event_folder + '/tag_1_pythia8_events_delphes.root',
+        lhe_filename=event_folder + '/unweighted_events.lhe.gz',
+        sampled_from_benchmark=sampled_from_benchmark,
+        weights='lhe',
+    )
+
+    dp.run_delphes(
+        delphes_directory=delphes_directory,
+        delphes_card=delphes_card,
+        log_file=log_file,
+        initial_command=initial_command,
+    )
+
+    setup_observables(dp)
+    setup_selections(dp)
+
+    dp.analyse_delphes_samples(delete_delphes_files=False, chunk_size=chunk_size, n_workers=n_workers)
+    for selection, filename in six.iteritems(output_filenames):
+        dp.save(filename, selection=selection)